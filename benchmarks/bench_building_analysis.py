@@ -0,0 +1,83 @@
+'''Measures the rooftop, section and superstructure merging of analyze_rooftops().
+
+Dense urban tiles are generated as random rectangular rooftops, each
+split into two sections and with a few superstructures, and merged
+with the spatial index and by testing all pairs. Tilts are drawn from
+a constant stand-in distribution so that only the merging is measured.
+
+Usage:
+  python benchmarks/bench_building_analysis.py [--buildings 100 300 1000]
+'''
+import passion
+import argparse
+import time
+import numpy as np
+import shapely
+import shapely.geometry
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--buildings', type=int, nargs='+', default=[ 100, 300, 1000 ])
+args = parser.parse_args()
+
+class ConstantTilt:
+  '''Stand-in tilt distribution always sampling the same tilt.'''
+  def resample(self, size, seed=None):
+    return np.full((1, size), 31.0)
+
+tilt_distribution = ConstantTilt()
+
+class AllPairs:
+  '''Stand-in spatial index returning every geometry as a candidate.'''
+  def __init__(self, geoms):
+    self.n = len(geoms)
+
+  def query(self, geom):
+    return np.arange(self.n)
+
+def random_buildings(rng, n_buildings, size=(2000, 1475)):
+  rooftops, sections, section_classes, supersts, superst_classes = [], [], [], [], []
+  for _ in range(n_buildings):
+    x, y = rng.uniform(0, size[0] - 40), rng.uniform(0, size[1] - 40)
+    w, h = rng.uniform(15, 40, size=2)
+    rooftops.append(shapely.geometry.box(x, y, x + w, y + h))
+    split = x + w * rng.uniform(0.3, 0.7)
+    sections.append(shapely.geometry.box(x - 1, y, split, y + h + 1))
+    sections.append(shapely.geometry.box(split, y - 1, x + w + 1, y + h))
+    section_classes.extend(rng.integers(1, 18, size=2).tolist())
+    for _ in range(rng.integers(0, 4)):
+      sx, sy = rng.uniform(x, x + w), rng.uniform(y, y + h)
+      supersts.append(shapely.geometry.box(sx, sy, sx + rng.uniform(2, 6), sy + rng.uniform(2, 6)))
+      superst_classes.append(int(rng.integers(1, 9)))
+  return rooftops, sections, section_classes, supersts, superst_classes
+
+def run(rooftops, sections, section_classes, supersts, superst_classes):
+  start = time.perf_counter()
+  partial_sections = passion.buildings.building_analysis.merge_rooftops_sections(
+    rooftops, sections, section_classes, 0, 'union', tilt_distribution, (50.77, 6.08), 19)
+  sections_time = time.perf_counter() - start
+  start = time.perf_counter()
+  partial_supersts = passion.buildings.building_analysis.merge_superstructures(
+    partial_sections, supersts, superst_classes, (50.77, 6.08), 19)
+  supersts_time = time.perf_counter() - start
+  return partial_sections, partial_supersts, sections_time, supersts_time
+
+strtree = shapely.STRtree
+rng = np.random.default_rng(0)
+print('{0:>10} {1:>10} {2:>10} {3:>12} {4:>22} {5:>22} {6:>10}'.format(
+  'rooftops', 'sections', 'supersts', 'index', 'sections merge (s)', 'supersts merge (s)', 'identical'))
+for n_buildings in args.buildings:
+  polygons = random_buildings(rng, n_buildings)
+  results = {}
+  for index, tree in [ ('all pairs', AllPairs), ('STRtree', strtree) ]:
+    shapely.STRtree = tree
+    results[index] = run(*polygons)
+  shapely.STRtree = strtree
+
+  reference_sections, reference_supersts = results['all pairs'][:2]
+  for index, (partial_sections, partial_supersts, sections_time, supersts_time) in results.items():
+    identical = (list(partial_sections) == list(reference_sections) and
+                 list(partial_supersts) == list(reference_supersts) and
+                 all(v['polygon_xy'].equals_exact(reference_sections[k]['polygon_xy'], 0)
+                     for k, v in partial_sections.items()))
+    print('{0:>10} {1:>10} {2:>10} {3:>12} {4:>22.3f} {5:>22.3f} {6:>10}'.format(
+      n_buildings, len(polygons[1]), len(polygons[3]), index, sections_time, supersts_time, str(identical)))
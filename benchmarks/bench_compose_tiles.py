@@ -0,0 +1,62 @@
+'''Measures the cost of overlapping tile prediction and blending.
+
+For every stride and merging policy, segments a random image and
+reports the wall time, the peak memory allocated while composing the
+image and the fraction of pixels that change with respect to the
+non overlapping prediction (stride equal to the tile size).
+
+Usage:
+  python benchmarks/bench_compose_tiles.py [--model model.pth] [--height 1500] [--width 2000]
+'''
+import passion
+import argparse
+import time
+import tracemalloc
+import numpy as np
+import torch
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--model', type=str, default=None, help='Model path, a small random network is used if not given')
+parser.add_argument('--height', type=int, default=1500)
+parser.add_argument('--width', type=int, default=2000)
+parser.add_argument('--tile-size', type=int, default=512)
+parser.add_argument('--classes', type=int, default=18, help='Number of classes of the random network')
+parser.add_argument('--batch-size', type=int, default=8)
+args = parser.parse_args()
+
+if args.model:
+  model = torch.load(args.model, map_location='cpu')
+else:
+  torch.manual_seed(0)
+  model = torch.nn.Sequential(torch.nn.Conv2d(3, 16, 5, padding=2),
+                              torch.nn.ReLU(),
+                              torch.nn.Conv2d(16, args.classes, 5, padding=2))
+model, device = passion.segmentation.prediction.prepare_model(model)
+
+rng = np.random.default_rng(0)
+image = rng.integers(0, 255, (args.height, args.width, 3), dtype=np.uint8)
+tile_size = args.tile_size
+
+def run(stride, merge_mode, blending):
+  tracemalloc.start()
+  start = time.perf_counter()
+  seg_image = passion.segmentation.prediction.segment_img(image, model, tile_size, stride, 0,
+                                                          args.batch_size, device, merge_mode, blending)
+  elapsed = time.perf_counter() - start
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return seg_image, elapsed, peak
+
+reference, _, _ = run(tile_size, passion.segmentation.prediction.MERGE_MODE.PROBABILITIES, 'gaussian')
+
+print('{0:>8} {1:>14} {2:>10} {3:>8} {4:>10} {5:>10}'.format('stride', 'merge', 'blending', 'tiles', 'time (s)', 'peak (MB)'), end='')
+print(' {0:>10}'.format('changed'))
+for stride in [ tile_size, tile_size * 3 // 4, tile_size // 2 ]:
+  for merge_mode in passion.segmentation.prediction.MERGE_MODE:
+    for blending in [ 'gaussian', 'cosine', 'uniform' ]:
+      if stride == tile_size and blending != 'gaussian': continue
+      seg_image, elapsed, peak = run(stride, merge_mode, blending)
+      n_tiles = len(passion.segmentation.prediction.get_tile_positions(image.shape, stride))
+      changed = (seg_image != reference).mean()
+      print('{0:>8} {1:>14} {2:>10} {3:>8} {4:>10.2f} {5:>10.1f} {6:>10.2%}'.format(
+        stride, merge_mode.name.lower(), blending, n_tiles, elapsed, peak / 2**20, changed))
@@ -0,0 +1,72 @@
+'''Measures filter_polygon_holes() from 10 to 10000 polygons.
+
+Random superstructure-like boxes, some of them containing smaller ones,
+are filtered with the spatial index and with the pairwise reference
+implementation, which tests every polygon against every other one. The
+reference is skipped above --max-reference polygons.
+
+Usage:
+  python benchmarks/bench_filter_polygon_holes.py [--sizes 10 100 1000 10000] [--max-reference 2000]
+'''
+import passion
+import argparse
+import time
+import numpy as np
+import shapely
+import shapely.geometry
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000])
+parser.add_argument('--max-reference', type=int, default=2000)
+args = parser.parse_args()
+
+def filter_polygon_holes_reference(classes, polygons):
+  filter_polygons = []
+  final_polygons = []
+  for i, p_a in enumerate(polygons):
+    holes = []
+    for j, p_b in enumerate(polygons):
+      if i != j:
+        if p_a.contains(p_b):
+          filter_polygons.append(j)
+          holes.append(p_b.exterior.coords)
+    new_poly = shapely.geometry.Polygon(p_a.exterior.coords, [ interior.coords for interior in p_a.interiors ] + holes)
+    final_polygons.append(new_poly.buffer(0))
+  final_polygons = [p for i, p in enumerate(final_polygons) if i not in filter_polygons]
+  final_classes = [c for i, c in enumerate(classes) if i not in filter_polygons]
+  return final_classes, final_polygons
+
+def random_polygons(rng, n_polygons):
+  '''Small boxes spread over an image area growing with n_polygons, a tenth of them
+  containing a smaller box.'''
+  side = 60 * np.sqrt(n_polygons)
+  polygons = []
+  while len(polygons) < n_polygons:
+    x, y = rng.uniform(0, side, size=2)
+    w, h = rng.uniform(4, 30, size=2)
+    polygons.append(shapely.geometry.box(x, y, x + w, y + h))
+    if rng.uniform() < 0.1 and len(polygons) < n_polygons:
+      polygons.append(shapely.geometry.box(x + w / 4, y + h / 4, x + w / 2, y + h / 2))
+  classes = rng.integers(1, 9, size=n_polygons).tolist()
+  return classes, polygons
+
+rng = np.random.default_rng(0)
+print('{0:>10} {1:>15} {2:>12} {3:>10}'.format('polygons', 'reference (s)', 'indexed (s)', 'identical'))
+for n_polygons in args.sizes:
+  classes, polygons = random_polygons(rng, n_polygons)
+
+  start = time.perf_counter()
+  indexed = passion.util.shapes.filter_polygon_holes(classes, polygons)
+  indexed_time = time.perf_counter() - start
+
+  if n_polygons > args.max_reference:
+    print('{0:>10} {1:>15} {2:>12.3f} {3:>10}'.format(n_polygons, '-', indexed_time, '-'))
+    continue
+  start = time.perf_counter()
+  reference = filter_polygon_holes_reference(classes, polygons)
+  reference_time = time.perf_counter() - start
+
+  identical = (indexed[0] == reference[0] and
+               all(a.wkb == b.wkb for a, b in zip(indexed[1], reference[1])) and
+               len(indexed[1]) == len(reference[1]))
+  print('{0:>10} {1:>15.3f} {2:>12.3f} {3:>10}'.format(n_polygons, reference_time, indexed_time, str(identical)))
@@ -0,0 +1,59 @@
+'''Measures the parsing of an Overpass response into building outlines.
+
+A synthetic Overpass JSON response with rectangular buildings is parsed
+with json, and its ways are assembled with get_buildings(), which indexes
+the nodes once, and with the reference implementation, which scans the
+list of nodes for every node of every way. The reference only assembles
+--reference-ways ways spread over the response, and its time is extrapolated.
+
+Usage:
+  python benchmarks/bench_osm_buildings.py [--buildings 200000] [--reference-ways 200]
+'''
+import passion
+import argparse
+import json
+import time
+import numpy as np
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--buildings', type=int, default=200000)
+parser.add_argument('--reference-ways', type=int, default=200)
+args = parser.parse_args()
+
+def get_buildings_reference(ways, nodes):
+  def get_node_latlon(id, nodes):
+    return next((node['lat'], node['lon']) for node in nodes if (node['id'] == id))
+  return [ [ get_node_latlon(id, nodes) for id in way['nodes'] ] for way in ways ]
+
+rng = np.random.default_rng(0)
+elements = []
+for way_id in range(args.buildings):
+  lat, lon = rng.uniform(50.7, 50.8), rng.uniform(6.0, 6.1)
+  node_ids = []
+  for node_lat, node_lon in [ (lat, lon), (lat + 0.0001, lon), (lat + 0.0001, lon + 0.0001), (lat, lon + 0.0001) ]:
+    node_ids.append(len(elements) + 10**9)
+    elements.append({ 'type': 'node', 'id': node_ids[-1], 'lat': node_lat, 'lon': node_lon })
+  elements.append({ 'type': 'way', 'id': way_id, 'nodes': node_ids + node_ids[:1], 'tags': { 'building': 'yes' } })
+# Overpass returns the ways before their nodes
+elements = elements[4::5] + [ e for e in elements if e['type'] == 'node' ]
+response = json.dumps({ 'elements': elements })
+
+start = time.perf_counter()
+results = json.loads(response)
+parse_time = time.perf_counter() - start
+
+start = time.perf_counter()
+ways, nodes = passion.util.osm.get_ways_nodes(results)
+buildings = passion.util.osm.get_buildings(ways, nodes)
+indexed_time = time.perf_counter() - start
+
+sample = np.linspace(0, len(ways) - 1, args.reference_ways).astype(int)
+start = time.perf_counter()
+reference = get_buildings_reference([ ways[i] for i in sample ], nodes)
+reference_time = (time.perf_counter() - start) * len(ways) / args.reference_ways
+
+identical = [ buildings[i] for i in sample ] == reference
+print('{0:>10} {1:>10} {2:>10} {3:>12} {4:>22} {5:>10}'.format('buildings', 'MB', 'json (s)', 'indexed (s)',
+                                                               'reference (s, extrap.)', 'identical'))
+print('{0:>10} {1:>10.1f} {2:>10.2f} {3:>12.2f} {4:>22.0f} {5:>10}'.format(len(ways), len(response) / 1e6, parse_time,
+                                                                          indexed_time, reference_time, str(identical)))
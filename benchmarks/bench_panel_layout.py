@@ -0,0 +1,80 @@
+'''Measures get_panel_layout() with the panel settings of config.yml.
+
+Random convex sections of a few hundred square meters are laid out
+with the vectorized engine and with the cell by cell reference
+implementation, which rotates and tests every cell on its own.
+
+Usage:
+  python benchmarks/bench_panel_layout.py [--config workflow/config.yml] [--sections 50] [--gr 0.3]
+'''
+import passion
+import argparse
+import time
+import yaml
+import numpy as np
+import shapely
+import shapely.geometry
+from shapely import affinity
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--config', type=str, default='workflow/config.yml')
+parser.add_argument('--sections', type=int, default=50)
+parser.add_argument('--gr', type=float, default=0.3, help='ground resolution in meters per pixel')
+args = parser.parse_args()
+
+with open(args.config, "r") as stream:
+  config = yaml.safe_load(stream)['TechnicalAnalysis']
+
+def get_layout_reference(outline, panel_size, azimuth, spacing_factor, border_spacing, offset):
+  panel_width, panel_height = panel_size
+  cell_width, cell_height = panel_width * spacing_factor, panel_height * spacing_factor
+  xmin, ymin, xmax, ymax = [ bound + offset for bound in outline.bounds ]
+  bbox = shapely.geometry.Polygon([(xmin,ymin),(xmin,ymax),(xmax,ymax),(xmax,ymin),(xmin,ymin)])
+  outline = outline.buffer(-border_spacing)
+  panel_cells = []
+  for x0 in np.arange(xmin, xmax, cell_width):
+    for y0 in np.arange(ymin, ymax, cell_height):
+      new_cell = shapely.geometry.box(x0, y0, x0+cell_width, y0+cell_height)
+      new_cell = affinity.rotate(new_cell, -azimuth, origin=bbox.centroid)
+      panel_x0, panel_y0 = x0+((cell_width - panel_width)/2), y0+((cell_height - panel_height)/2)
+      panel_cell = shapely.geometry.box(panel_x0, panel_y0, panel_x0+panel_width, panel_y0+panel_height)
+      panel_cell = affinity.rotate(panel_cell, -azimuth, origin=bbox.centroid)
+      if new_cell.within(outline):
+        panel_cells.append(panel_cell)
+  return panel_cells
+
+def get_panel_layout_reference(outline, panel_size, azimuth, spacing_factor, border_spacing, n_offset):
+  panel_width, panel_height = panel_size
+  cell_length = max(panel_width, panel_height) * spacing_factor
+  panel_cells = []
+  for offset in np.arange(0, cell_length, cell_length / n_offset):
+    for size in [ (panel_width, panel_height), (panel_height, panel_width) ]:
+      layout = get_layout_reference(outline, size, azimuth, spacing_factor, border_spacing, offset)
+      if len(layout) > len(panel_cells):
+        panel_cells = layout
+  return shapely.geometry.MultiPolygon(panel_cells)
+
+rng = np.random.default_rng(0)
+sections = []
+for _ in range(args.sections):
+  angles = np.sort(rng.uniform(0, 2 * np.pi, rng.integers(4, 9)))
+  radius = rng.uniform(10, 25) / args.gr
+  outline = shapely.geometry.Polygon(np.c_[radius * np.cos(angles), radius * np.sin(angles)]).convex_hull
+  sections.append((outline, float(rng.uniform(0, 360))))
+
+panel_size = (config['pv_model_width'] / args.gr, config['pv_model_height'] / args.gr)
+layout_args = (config['pv_spacing_factor'], config['pv_border_spacing'] / args.gr, config['pv_n_offset'])
+
+times = {}
+layouts = {}
+for name, get_panel_layout in [ ('reference', get_panel_layout_reference),
+                                ('vectorized', passion.util.shapes.get_panel_layout) ]:
+  start = time.perf_counter()
+  layouts[name] = [ get_panel_layout(outline, panel_size, azimuth, *layout_args) for outline, azimuth in sections ]
+  times[name] = time.perf_counter() - start
+
+identical = all(a.wkb == b.wkb for a, b in zip(layouts['reference'], layouts['vectorized']))
+n_panels = sum(len(layout.geoms) for layout in layouts['vectorized'])
+print('{0:>10} {1:>8} {2:>15} {3:>16} {4:>10}'.format('sections', 'panels', 'reference (s)', 'vectorized (s)', 'identical'))
+print('{0:>10} {1:>8} {2:>15.3f} {3:>16.3f} {4:>10}'.format(len(sections), n_panels, times['reference'],
+                                                             times['vectorized'], str(identical)))
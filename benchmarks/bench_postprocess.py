@@ -0,0 +1,92 @@
+'''Measures postprocess_output() with the class counts and kernels of config.yml.
+
+Synthetic segmentations are generated as random class regions with
+noise, either scattered over the whole image or clustered in a part of
+it, and the results are compared to the class by class reference
+implementation, which processes every class in the full image.
+
+Usage:
+  python benchmarks/bench_postprocess.py [--config workflow/config.yml] [--height 1475] [--width 2000]
+'''
+import passion
+import argparse
+import itertools
+import os
+import time
+import yaml
+import numpy as np
+import cv2
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--config', type=str, default='workflow/config.yml')
+parser.add_argument('--height', type=int, default=1475)
+parser.add_argument('--width', type=int, default=2000)
+parser.add_argument('--repeat', type=int, default=5)
+args = parser.parse_args()
+
+with open(args.config, "r") as stream:
+  config = yaml.safe_load(stream)
+
+def postprocess_reference(image, opening_closing_kernel, erosion_kernel, background_class):
+  out_image = np.full(image.shape, background_class)
+  opening_closing_kernel = np.ones((opening_closing_kernel, opening_closing_kernel), np.uint8)
+  erosion_kernel = np.ones((erosion_kernel, erosion_kernel), np.uint8)
+  seg_classes = np.unique(image)[np.unique(image) != background_class]
+  for seg_class in seg_classes:
+    image_class = (image == seg_class).astype(np.uint8)
+    image_class = cv2.morphologyEx(image_class, cv2.MORPH_OPEN, opening_closing_kernel)
+    image_class = cv2.morphologyEx(image_class, cv2.MORPH_CLOSE, opening_closing_kernel)
+    image_class = cv2.erode(image_class, erosion_kernel)
+    out_image[image_class == 1] = seg_class
+  return out_image
+
+def random_segmentation(rng, num_classes, background_class, clustered):
+  '''Random class regions over the background, with pixel noise.
+  If clustered, the regions of every class are in a small part of the image.
+  '''
+  image = np.full((args.height, args.width), background_class, dtype=np.uint8)
+  for _ in range(200):
+    seg_class = rng.integers(0, num_classes)
+    if clustered:
+      center_y = args.height * (seg_class % 4 + 0.5) / 4
+      center_x = args.width * (seg_class // 4 % 4 + 0.5) / 4
+      y, x = int(rng.normal(center_y, args.height / 20)), int(rng.normal(center_x, args.width / 20))
+      y, x = np.clip(y, 0, args.height - 1), np.clip(x, 0, args.width - 1)
+    else:
+      y, x = rng.integers(0, args.height), rng.integers(0, args.width)
+    h, w = rng.integers(10, 120, size=2)
+    region = image[y:y+h, x:x+w]
+    region[:] = seg_class
+    noise = rng.random(region.shape) < 0.05
+    region[noise] = rng.integers(0, num_classes, size=noise.sum())
+  return image
+
+steps = [ ('RooftopSegmentation', 'RooftopSegmentationTraining'),
+          ('SectionSegmentation', 'SectionSegmentationTraining'),
+          ('SuperstructureSegmentation', 'SuperstructureSegmentationTraining') ]
+
+rng = np.random.default_rng(0)
+print('{0:>28} {1:>8} {2:>10} {3:>8} {4:>15} {5:>15} {6:>10}'.format(
+  'step', 'classes', 'layout', 'threads', 'reference (s)', 'postprocess (s)', 'identical'))
+for (step, training_step), clustered, num_threads in itertools.product(steps, [ False, True ], [ 1, None ]):
+  num_classes = config[training_step]['num_classes']
+  background_class = config[step]['background_class']
+  opening_closing_kernel = int(config[step]['opening_closing_kernel'])
+  erosion_kernel = int(config[step]['erosion_kernel'])
+  image = random_segmentation(rng, num_classes, background_class, clustered)
+
+  # Best time of the repetitions
+  times = { 'reference': np.inf, 'postprocess': np.inf }
+  for _ in range(args.repeat):
+    start = time.perf_counter()
+    reference = postprocess_reference(image, opening_closing_kernel, erosion_kernel, background_class)
+    times['reference'] = min(times['reference'], time.perf_counter() - start)
+    start = time.perf_counter()
+    output = passion.segmentation.prediction.postprocess_output(image, opening_closing_kernel, erosion_kernel,
+                                                                background_class, num_threads)
+    times['postprocess'] = min(times['postprocess'], time.perf_counter() - start)
+
+  identical = output.dtype == reference.dtype and (output == reference).all()
+  print('{0:>28} {1:>8} {2:>10} {3:>8} {4:>15.3f} {5:>15.3f} {6:>10}'.format(
+    step, num_classes, 'clustered' if clustered else 'scattered', num_threads or os.cpu_count(),
+    times['reference'], times['postprocess'], str(identical)))
@@ -2,7 +2,6 @@ from flask import Flask
 import flask
 import geopandas as gpd
 import shapely
-import shapely.wkt
 import pathlib
 import folium
 import xarray
@@ -16,6 +15,13 @@ from util import rooftop_popup_html
 app = Flask(__name__)
 
 
+def load_geometries(ds: xarray.Dataset, name: str):
+    '''Decodes the WKB geometries stored as name in a dataset into a geometry series
+    indexed by their dimension.'''
+    index = ds[f'{name}_length'].to_index()
+    return pd.Series(passion.util.io.decode_geometries(ds, name), index=index, name='geometry')
+
+
 @app.route('/')
 def index():
     region = flask.request.args.get('region', default = 'sample', type = str)
@@ -73,25 +79,17 @@ def index():
     
     with xarray.open_dataset(str(results_path / 'economic/lcoe.nc')) as economic_ds:
         print(f'Loaded dataset.')
-        # Transform sections WKT to polygons
-        wkt_latlon_df = economic_ds.section_wkt_latlon.to_dataframe()
-        section_poly_latlon_df = wkt_latlon_df['section_wkt_latlon'].apply(lambda x: shapely.wkt.loads(x))
-        section_poly_latlon_df = section_poly_latlon_df.rename('geometry')
+        # Transform sections WKB to polygons
+        section_poly_latlon_df = load_geometries(economic_ds, 'section_wkb_latlon')
         section_poly_lonlat_df = section_poly_latlon_df.apply(lambda x: reverse_geom(x))
-        # Transform filtered sections WKT to polygons
-        filtered_wkt_latlon_df = economic_ds.filtered_wkt_latlon.to_dataframe()
-        filtered_poly_latlon_df = filtered_wkt_latlon_df['filtered_wkt_latlon'].apply(lambda x: shapely.wkt.loads(x))
-        filtered_poly_latlon_df = filtered_poly_latlon_df.rename('geometry')
+        # Transform filtered sections WKB to polygons
+        filtered_poly_latlon_df = load_geometries(economic_ds, 'filtered_wkb_latlon')
         filtered_poly_lonlat_df = filtered_poly_latlon_df.apply(lambda x: reverse_geom(x))
-        # Transform panels WKT to polygons
-        pv_wkt_latlon_df = economic_ds.section_pv_layout_wkt.to_dataframe()
-        pv_poly_latlon_df = pv_wkt_latlon_df['section_pv_layout_wkt'].apply(lambda x: shapely.wkt.loads(x))
-        pv_poly_latlon_df = pv_poly_latlon_df.rename('geometry')
+        # Transform panels WKB to polygons
+        pv_poly_latlon_df = load_geometries(economic_ds, 'section_pv_layout_wkb')
         pv_poly_lonlat_df = pv_poly_latlon_df.apply(lambda x: reverse_geom(x))
-        # Transform superstructures WKT to polygons
-        superst_wkt_latlon_df = economic_ds.superst_wkt_latlon.to_dataframe()
-        superst_poly_latlon_df = superst_wkt_latlon_df['superst_wkt_latlon'].apply(lambda x: shapely.wkt.loads(x))
-        superst_poly_latlon_df = superst_poly_latlon_df.rename('geometry')
+        # Transform superstructures WKB to polygons
+        superst_poly_latlon_df = load_geometries(economic_ds, 'superst_wkb_latlon')
         superst_poly_lonlat_df = superst_poly_latlon_df.apply(lambda x: reverse_geom(x))
         superst_area_df = economic_ds.superst_area.to_dataframe()
 
@@ -129,17 +127,14 @@ def index():
             superst_poly_lonlat_df, seg_class_df, superst_area_df
         ], axis=1)
         
-        # Transform panels WKT to polygons
-        show_existing_panels = (economic_ds.get('panel_pv_layout_wkt') is not None)
+        # Transform panels WKB to polygons
+        show_existing_panels = (economic_ds.get('panel_pv_layout_wkb') is not None)
         if show_existing_panels:
             existing_yearly_system_generation_df = economic_ds.panel_yearly_system_generation.to_dataframe()
             existing_panel_area_df = economic_ds.panel_area.to_dataframe()
             existing_n_panels_df = economic_ds.panel_n_panels.to_dataframe()
 
-            existing_pv_wkt_latlon_df = economic_ds.panel_pv_layout_wkt.to_dataframe()
-            existing_pv_wkt_latlon_df = existing_pv_wkt_latlon_df[existing_pv_wkt_latlon_df != ''].dropna()
-            existing_pv_poly_latlon_df = existing_pv_wkt_latlon_df['panel_pv_layout_wkt'].apply(lambda x: shapely.wkt.loads(x))
-            existing_pv_poly_latlon_df = existing_pv_poly_latlon_df.rename('geometry')
+            existing_pv_poly_latlon_df = load_geometries(economic_ds, 'panel_pv_layout_wkb').dropna()
             existing_pv_poly_lonlat_df = existing_pv_poly_latlon_df.apply(lambda x: reverse_geom(x))
 
             existing_panels_df = pd.concat([
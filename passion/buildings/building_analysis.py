@@ -1,6 +1,8 @@
 import pathlib
+import concurrent.futures
 import cv2
 import numpy as np
+import scipy.special
 import tqdm
 import shapely
 import xarray
@@ -15,6 +17,9 @@ def analyze_rooftops(rooftop_predictions_path: pathlib.Path,
                      tilt_distribution_path: pathlib.Path,
                      simplification_distance: float,
                      merge_style: str = 'union',
+                     n_workers: int = 1,
+                     seed: int = None,
+                     tilt_sampling: str = 'kde',
 ):
   '''Generates a NetCDF file containing the detected sections of the input segmentations.
 
@@ -28,6 +33,9 @@ def analyze_rooftops(rooftop_predictions_path: pathlib.Path,
   tilt_distribution_path          -- Path, location of the tilt distribution pickle file.
   simplification_distance         -- float, factor of simplification for the polygons. Between 0 and 1.
   merge_style                     -- str, merging strategy for the sections and rooftops segmentations. Must be one of 'union' 'prioritize-rooftops' or 'intersection'.
+  n_workers                       -- int, number of processes analyzing images in parallel.
+  seed                            -- int, seed for the tilt sampling. Each image uses its own generator seeded with (seed, image index).
+  tilt_sampling                   -- str, 'kde' to sample tilts from the distribution, or 'table' to sample them from its precomputed inverse CDF.
   '''
   output_path.mkdir(parents=True, exist_ok=True)
 
@@ -37,180 +45,28 @@ def analyze_rooftops(rooftop_predictions_path: pathlib.Path,
   zip_paths = zip(rooftop_paths, section_paths, superstructure_paths)
 
   tilt_distribution = passion.util.io.load_pickle(tilt_distribution_path)
+  if tilt_sampling == 'table': tilt_distribution = get_tilt_table(tilt_distribution)
 
   if merge_style not in ['union', 'prioritize-rooftops', 'intersection']: merge_style = 'union'
 
+  # Forked workers share the state of numpy's global generator, so draw a seed for them
+  if seed is None and n_workers > 1: seed = np.random.SeedSequence().entropy
+
   final_sections = {}
   final_supersts = {}
-  for img_i, (rooftop_path, section_path, superst_path) in tqdm.tqdm(enumerate(zip_paths)):
-    print(f'Analyzing image {img_i}...')
-    partial_sections = {}
-    partial_supersts = {}
-
-    rooftop_filename = rooftop_path.stem.replace('_MASK','')
-    rooftop_folder = rooftop_path.parents[0]
-    rooftop_extension = rooftop_path.suffix
-
-    # Load all three segmented images
-    
-    rooftop_src = passion.util.io.read_geotiff(rooftop_path)
-    rooftop_img = rooftop_src.ReadAsArray()
-    #rooftop_img = np.moveaxis(rooftop_img, 0, -1)
-
-    section_src = passion.util.io.read_geotiff(section_path)
-    section_img = section_src.ReadAsArray()
-    #section_img = np.moveaxis(section_img, 0, -1)
-
-    superst_src = passion.util.io.read_geotiff(superst_path)
-    superst_img = superst_src.ReadAsArray()
-    #superst_img = np.moveaxis(superst_img, 0, -1)
-
-    zoom = int(rooftop_src.GetMetadata().get('zoom_level'))
-
-    west, xres, xskew, north, yskew, yres  = rooftop_src.GetGeoTransform()
-    east = west + (rooftop_src.RasterXSize * xres)
-    south = north + (rooftop_src.RasterYSize * yres)
-    img_center_x = (west + east) // 2
-    img_center_y = (south + north) // 2
-
-    img_center_lat, img_center_lon = passion.util.gis.xy_tolatlon(img_center_x, img_center_y, zoom)
-
-    # Extract all of the polygons
-    rooftop_classes, rooftops = passion.util.shapes.get_image_classes_xy(rooftop_img, simplification_distance)
-    section_classes, sections = passion.util.shapes.get_image_classes_xy(section_img, simplification_distance)
-    superst_classes, supersts = passion.util.shapes.get_image_classes_xy(superst_img, simplification_distance)
-    if rooftops:
-      rooftops_tuple = tuple(zip(*[(c, poly) for (c, poly) in zip(rooftop_classes, rooftops) if not poly.is_empty]))
-      if len(rooftops_tuple) == 2: rooftop_classes, rooftops = rooftops_tuple
-    if sections:
-      sections_tuple = tuple(zip(*[(c, poly) for (c, poly) in zip(section_classes, sections) if not poly.is_empty]))
-      if len(sections_tuple) == 2: section_classes, sections = sections_tuple
-    if supersts:
-      superst_tuple = tuple(zip(*[(c, poly) for (c, poly) in zip(superst_classes, supersts) if not poly.is_empty]))
-      if len(superst_tuple) == 2: superst_classes, supersts = superst_tuple
-
-    print(f'Retrieved {len(rooftops)} rooftops.')
-    print(f'Retrieved {len(sections)} sections.')
-    print(f'Retrieved {len(supersts)} superstructures.')
-
-    if rooftops: rooftop_classes, rooftops = passion.util.shapes.filter_polygon_holes(rooftop_classes, rooftops)
-    if sections: section_classes, sections = passion.util.shapes.filter_polygon_holes(section_classes, sections)
-    if supersts: superst_classes, supersts = passion.util.shapes.filter_polygon_holes(superst_classes, supersts)
-
-    print(f'Retrieved {len(rooftops)} rooftops after filtering holes.')
-    print(f'Retrieved {len(sections)} sections after filtering holes.')
-    print(f'Retrieved {len(supersts)} superstructures after filtering holes.')
-
-    # - Sections that are outside of detected rooftops will be filtered out
-    # - Sections that intersect with rooftops will be filtered from the rooftop available area
-    # - Rooftops that do not have any sections will be treated as flat rooftops
-    optimal_tilt = 31
-    for i, rooftop in enumerate(rooftops):
-      if not rooftop.is_valid: print(f'Invalid rooftop: {i}')
-      for j, (section, section_class) in enumerate(zip(sections, section_classes)):
-        if not section.is_valid: print(f'Invalid section: {j}')
-        try:
-          if rooftop.intersects(section):
-            try:
-              if merge_style != 'union': section = section.intersection(rooftop)
-              # Filter the section area from the rooftop
-              rooftop = rooftop.difference(section)
-              # If it has not been added before (intersects with another rooftop), add it
-              if f'i{img_i}s{j}' not in partial_sections:
-                flat = 1 if section_class==17 else 0
-                azimuth = get_azimuth_from_segmentation(section_class)
-                tilt = optimal_tilt if flat else get_tilt(tilt_distribution)
-
-                partial_sections[f'i{img_i}s{j}'] = {'polygon_xy': section,
-                                        'azimuth': azimuth,
-                                        'tilt': tilt,
-                                        'flat': flat,
-                                        'original_img_center_latlon': (img_center_lat, img_center_lon),
-                                        'area': passion.util.shapes.get_area(section, (img_center_lat, img_center_lon), zoom)
-                                        }
-            except:
-              print(f'Exception with intersecting processing polygons:')
-              print(type(section))
-              print(type(rooftop))
-              print(section.wkt)
-              print(rooftop.wkt)
-        except:
-          print(rooftop)
-          print(type(rooftop))
-          print(section)
-          print(type(section))
-      # After filtering its sections, add it if it is not empty
-      if merge_style != 'intersection' and not rooftop.is_empty:
-        partial_sections[f'i{img_i}r{i}'] = {'polygon_xy': rooftop,
-                                  'azimuth': 180,
-                                  'tilt': optimal_tilt,
-                                  'flat': 1,
-                                  'original_img_center_latlon': (img_center_lat, img_center_lon),
-                                  'area': passion.util.shapes.get_area(rooftop, (img_center_lat, img_center_lon), zoom)
-                                }
-    # - Superstructures that are outside of detected rooftops will be filtered out
-    # - Superstructures that intersect with rooftops/sections will be filtered from the available area
-    for k, v in list(partial_sections.items()):
-      poly = v['polygon_xy']
-      v['superstructures'] = []
-      for i, (superst, superst_class) in enumerate(zip(supersts, superst_classes)):
-        intersects = False
-        try:
-          intersects = poly.intersects(superst)
-        except Exception as e:
-          print(f'Exception with intersecting processing polygons:')
-          print(type(poly))
-          print(type(superst))
-          print(poly.wkt)
-          print(superst.wkt)
-
-        if intersects:
-          # Filter the superstructure area from the section
-          try:
-            # Keep only the part of the superstructure inside of the section
-            superst = superst.intersection(poly)
-            poly = poly.difference(superst)
-          except:
-            print(f'Encountered exception processing polygons:')
-            print(type(poly))
-            print(type(superst))
-            print(poly.wkt)
-            print(superst.wkt)
-          if i not in partial_supersts and superst.is_valid and (superst.geom_type == 'Polygon' or superst.geom_type == 'MultiPolygon'):
-            # TODO: add area and other info
-            partial_supersts[i] = {
-              'class': superst_class,
-              'polygon_xy': superst,
-              'original_img_center_latlon': (img_center_lat, img_center_lon),
-              'area': passion.util.shapes.get_area(superst, (img_center_lat, img_center_lon), zoom)
-            }
-      # If polygon has become a Geometrycollection, remove non polygons
-      if poly.geom_type == 'GeometryCollection':
-        polys = []
-        [polys.append(p) for p in poly.geoms if p.geom_type == 'Polygon']
-        poly = shapely.geometry.MultiPolygon(polys)
-
-      if poly.geom_type == 'Polygon' or poly.geom_type == 'MultiPolygon':
-        partial_sections[k].update({'polygon_xy': poly})
-      else:
-        # Debug why the poly is not a (multi)poly
-        print(f'Found non polygon shape:')
-        print(poly.geom_type)
-        del partial_sections[k]
-
-    # Convert polygons to latlon
-    for section_k, section_v in partial_sections.items():
-      latlon_poly = passion.util.shapes.xy_poly_to_latlon(section_v['polygon_xy'],
-                                                          (img_center_lat, img_center_lon),
-                                                          section_img.shape,
-                                                          zoom)
-      partial_sections[section_k].update({'polygon_latlon': latlon_poly})
-    for superst_k, superst_v in partial_supersts.items():
-      latlon_poly = passion.util.shapes.xy_poly_to_latlon(superst_v['polygon_xy'],
-                                                          (img_center_lat, img_center_lon),
-                                                          superst_img.shape,
-                                                          zoom)
-      partial_supersts[superst_k].update({'polygon_latlon': latlon_poly})
+  tasks = [ (img_i, rooftop_path, section_path, superst_path, tilt_distribution,
+             simplification_distance, merge_style, seed)
+            for img_i, (rooftop_path, section_path, superst_path) in enumerate(zip_paths) ]
+  if n_workers > 1:
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+      futures = [ executor.submit(analyze_image, *task) for task in tasks ]
+      for _ in tqdm.tqdm(concurrent.futures.as_completed(futures), total=len(futures)): pass
+      results = [ future.result() for future in futures ]
+  else:
+    results = ( analyze_image(*task) for task in tqdm.tqdm(tasks) )
+
+  # Merge in image order, so that the output does not depend on the workers
+  for partial_sections, partial_supersts, zoom, img_shape in results:
     final_sections.update(partial_sections)
     final_supersts.update(partial_supersts)
   
@@ -218,8 +74,8 @@ def analyze_rooftops(rooftop_predictions_path: pathlib.Path,
   section_ids, section_polygons_xy, section_polygons_latlon, section_centers_lat, section_centers_lon, section_azimuths, section_tilts, section_flats, section_areas = [], [], [], [], [], [], [], [], []
   for section_k, section_v in final_sections.items():
     section_ids.append(section_k)
-    section_polygons_xy.append(section_v['polygon_xy'].wkt)
-    section_polygons_latlon.append(section_v['polygon_latlon'].wkt)
+    section_polygons_xy.append(section_v['polygon_xy'])
+    section_polygons_latlon.append(section_v['polygon_latlon'])
     section_centers_lat.append(section_v['original_img_center_latlon'][0])
     section_centers_lon.append(section_v['original_img_center_latlon'][1])
     section_azimuths.append(section_v['azimuth'])
@@ -230,8 +86,8 @@ def analyze_rooftops(rooftop_predictions_path: pathlib.Path,
   superst_ids, superst_polygons_xy, superst_polygons_latlon, superst_centers_lat, superst_centers_lon, superst_classes, superst_areas = [], [], [], [], [], [], []
   for superst_k, superst_v in final_supersts.items():
     superst_ids.append(superst_k)
-    superst_polygons_xy.append(superst_v['polygon_xy'].wkt)
-    superst_polygons_latlon.append(superst_v['polygon_latlon'].wkt)
+    superst_polygons_xy.append(superst_v['polygon_xy'])
+    superst_polygons_latlon.append(superst_v['polygon_latlon'])
     superst_centers_lat.append(superst_v['original_img_center_latlon'][0])
     superst_centers_lon.append(superst_v['original_img_center_latlon'][1])
     superst_classes.append(superst_v['class'])
@@ -240,19 +96,11 @@ def analyze_rooftops(rooftop_predictions_path: pathlib.Path,
   sections_ds = xarray.Dataset(
     data_vars=dict(
         zoom_level=([], zoom),
-        original_image_width=([], rooftop_img.shape[0]),
-        original_image_height=([], rooftop_img.shape[1]),
+        original_image_width=([], img_shape[0]),
+        original_image_height=([], img_shape[1]),
         # Sections
-        section_wkt_latlon=(['section_id'], section_polygons_latlon, 
-                    {
-                        'type': 'str',
-                        'str_format': 'wkt'
-                    }),
-        section_wkt_xy=(['section_id'], section_polygons_xy, 
-                    {
-                        'type': 'str',
-                        'str_format': 'wkt'
-                    }),
+        **passion.util.io.encode_geometries(section_polygons_latlon, 'section_id', 'section_wkb_latlon'),
+        **passion.util.io.encode_geometries(section_polygons_xy, 'section_id', 'section_wkb_xy'),
         section_img_center_lat=(['section_id'], section_centers_lat, 
                     {
                         'type': 'float'
@@ -292,16 +140,8 @@ def analyze_rooftops(rooftop_predictions_path: pathlib.Path,
                     {
                         'type': 'float'
                     }),
-        superst_wkt_latlon=(['superst_id'], superst_polygons_latlon, 
-                    {
-                        'type': 'str',
-                        'str_format': 'wkt'
-                    }),
-        superst_wkt_xy=(['superst_id'], superst_polygons_xy, 
-                    {
-                        'type': 'str',
-                        'str_format': 'wkt'
-                    }),
+        **passion.util.io.encode_geometries(superst_polygons_latlon, 'superst_id', 'superst_wkb_latlon'),
+        **passion.util.io.encode_geometries(superst_polygons_xy, 'superst_id', 'superst_wkb_xy'),
         superst_area=(['superst_id'], superst_areas, 
                     {
                         'type': 'float'
@@ -326,11 +166,306 @@ def analyze_rooftops(rooftop_predictions_path: pathlib.Path,
 
   return
 
-def get_tilt(tilt_distribution):
-  '''Extracts a new tilt value from a given distribution.'''
-  tilt = tilt_distribution.resample(1)[0][0]
+def analyze_image(img_i: int,
+                  rooftop_path: pathlib.Path,
+                  section_path: pathlib.Path,
+                  superst_path: pathlib.Path,
+                  tilt_distribution,
+                  simplification_distance: float,
+                  merge_style: str,
+                  seed: int = None
+):
+  '''Analyzes the rooftop, section and superstructure segmentations
+  of a single image. Returns the sections and superstructures of the
+  image, its zoom level and its shape.
+
+  If a seed is given, tilts are sampled from a generator seeded with
+  (seed, img_i), so that results do not depend on the order in which
+  images are analyzed.
+  '''
+  print(f'Analyzing image {img_i}...')
+  rng = np.random.default_rng([seed, img_i]) if seed is not None else None
+
+  rooftop_filename = rooftop_path.stem.replace('_MASK','')
+  rooftop_folder = rooftop_path.parents[0]
+  rooftop_extension = rooftop_path.suffix
+
+  # Load all three segmented images
+  
+  rooftop_src = passion.util.io.read_geotiff(rooftop_path)
+  rooftop_img = rooftop_src.ReadAsArray()
+  #rooftop_img = np.moveaxis(rooftop_img, 0, -1)
+
+  section_src = passion.util.io.read_geotiff(section_path)
+  section_img = section_src.ReadAsArray()
+  #section_img = np.moveaxis(section_img, 0, -1)
+
+  superst_src = passion.util.io.read_geotiff(superst_path)
+  superst_img = superst_src.ReadAsArray()
+  #superst_img = np.moveaxis(superst_img, 0, -1)
+
+  zoom = int(rooftop_src.GetMetadata().get('zoom_level'))
+
+  west, xres, xskew, north, yskew, yres  = rooftop_src.GetGeoTransform()
+  east = west + (rooftop_src.RasterXSize * xres)
+  south = north + (rooftop_src.RasterYSize * yres)
+  img_center_x = (west + east) // 2
+  img_center_y = (south + north) // 2
+
+  img_center_lat, img_center_lon = passion.util.gis.xy_tolatlon(img_center_x, img_center_y, zoom)
+
+  # Extract all of the polygons
+  rooftop_classes, rooftops = passion.util.shapes.get_image_classes_xy(rooftop_img, simplification_distance)
+  section_classes, sections = passion.util.shapes.get_image_classes_xy(section_img, simplification_distance)
+  superst_classes, supersts = passion.util.shapes.get_image_classes_xy(superst_img, simplification_distance)
+  if rooftops:
+    rooftops_tuple = tuple(zip(*[(c, poly) for (c, poly) in zip(rooftop_classes, rooftops) if not poly.is_empty]))
+    if len(rooftops_tuple) == 2: rooftop_classes, rooftops = rooftops_tuple
+  if sections:
+    sections_tuple = tuple(zip(*[(c, poly) for (c, poly) in zip(section_classes, sections) if not poly.is_empty]))
+    if len(sections_tuple) == 2: section_classes, sections = sections_tuple
+  if supersts:
+    superst_tuple = tuple(zip(*[(c, poly) for (c, poly) in zip(superst_classes, supersts) if not poly.is_empty]))
+    if len(superst_tuple) == 2: superst_classes, supersts = superst_tuple
+
+  print(f'Retrieved {len(rooftops)} rooftops.')
+  print(f'Retrieved {len(sections)} sections.')
+  print(f'Retrieved {len(supersts)} superstructures.')
+
+  if rooftops: rooftop_classes, rooftops = passion.util.shapes.filter_polygon_holes(rooftop_classes, rooftops)
+  if sections: section_classes, sections = passion.util.shapes.filter_polygon_holes(section_classes, sections)
+  if supersts: superst_classes, supersts = passion.util.shapes.filter_polygon_holes(superst_classes, supersts)
+
+  print(f'Retrieved {len(rooftops)} rooftops after filtering holes.')
+  print(f'Retrieved {len(sections)} sections after filtering holes.')
+  print(f'Retrieved {len(supersts)} superstructures after filtering holes.')
+
+  partial_sections = merge_rooftops_sections(rooftops, sections, section_classes, img_i, merge_style,
+                                             tilt_distribution, (img_center_lat, img_center_lon), zoom, rng)
+  partial_supersts = merge_superstructures(partial_sections, supersts, superst_classes,
+                                           (img_center_lat, img_center_lon), zoom)
+
+  # Convert polygons to latlon
+  sections_latlon = passion.util.shapes.xy_polys_to_latlon([v['polygon_xy'] for v in partial_sections.values()],
+                                                           (img_center_lat, img_center_lon),
+                                                           section_img.shape,
+                                                           zoom)
+  for section_v, latlon_poly in zip(partial_sections.values(), sections_latlon):
+    section_v.update({'polygon_latlon': latlon_poly})
+  supersts_latlon = passion.util.shapes.xy_polys_to_latlon([v['polygon_xy'] for v in partial_supersts.values()],
+                                                           (img_center_lat, img_center_lon),
+                                                           superst_img.shape,
+                                                           zoom)
+  for superst_v, latlon_poly in zip(partial_supersts.values(), supersts_latlon):
+    superst_v.update({'polygon_latlon': latlon_poly})
+
+  # The list of superstructures of each section is not used afterwards
+  for section_v in partial_sections.values():
+    section_v.pop('superstructures', None)
+
+  return partial_sections, partial_supersts, zoom, rooftop_img.shape
+
+def merge_rooftops_sections(rooftops: list,
+                            sections: list,
+                            section_classes: list,
+                            img_i: int,
+                            merge_style: str,
+                            tilt_distribution,
+                            img_center_latlon: tuple,
+                            zoom: int,
+                            rng: np.random.Generator = None
+):
+  '''Merges the rooftops and sections of an image, returning a
+  dictionary of sections with keys 'i<img_i>s<ID>' for sections and
+  'i<img_i>r<ID>' for the rooftop areas not covered by sections:
+
+  - Sections that are outside of detected rooftops will be filtered out
+  - Sections that intersect with rooftops will be filtered from the rooftop available area
+  - Rooftops that do not have any sections will be treated as flat rooftops
+
+  Only the sections whose bounding box intersects a rooftop are
+  tested, using a spatial index of the sections. Tilts of sloped
+  sections are sampled in a single batch after the geometric phase,
+  with the given random generator (see sample_tilts()).
+  '''
+  partial_sections = {}
+  sloped_sections = []
+  optimal_tilt = 31
+
+  for j, section in enumerate(sections):
+    if not section.is_valid: print(f'Invalid section: {j}')
+  section_tree = shapely.STRtree(sections)
+
+  for i, rooftop in enumerate(rooftops):
+    if not rooftop.is_valid: print(f'Invalid rooftop: {i}')
+    # Differences only shrink the rooftop, so its initial bounding box holds all candidates
+    for j in np.sort(section_tree.query(rooftop)).tolist():
+      section, section_class = sections[j], section_classes[j]
+      try:
+        if rooftop.intersects(section):
+          try:
+            if merge_style != 'union': section = section.intersection(rooftop)
+            # Filter the section area from the rooftop
+            rooftop = rooftop.difference(section)
+            # If it has not been added before (intersects with another rooftop), add it
+            if f'i{img_i}s{j}' not in partial_sections:
+              flat = 1 if section_class==17 else 0
+              azimuth = get_azimuth_from_segmentation(section_class)
+              tilt = optimal_tilt
+              if not flat: sloped_sections.append(f'i{img_i}s{j}')
+
+              partial_sections[f'i{img_i}s{j}'] = {'polygon_xy': section,
+                                      'azimuth': azimuth,
+                                      'tilt': tilt,
+                                      'flat': flat,
+                                      'original_img_center_latlon': img_center_latlon,
+                                      'area': passion.util.shapes.get_area(section, img_center_latlon, zoom)
+                                      }
+          except:
+            print(f'Exception with intersecting processing polygons:')
+            print(type(section))
+            print(type(rooftop))
+            print(section.wkt)
+            print(rooftop.wkt)
+      except:
+        print(rooftop)
+        print(type(rooftop))
+        print(section)
+        print(type(section))
+    # After filtering its sections, add it if it is not empty
+    if merge_style != 'intersection' and not rooftop.is_empty:
+      partial_sections[f'i{img_i}r{i}'] = {'polygon_xy': rooftop,
+                                'azimuth': 180,
+                                'tilt': optimal_tilt,
+                                'flat': 1,
+                                'original_img_center_latlon': img_center_latlon,
+                                'area': passion.util.shapes.get_area(rooftop, img_center_latlon, zoom)
+                              }
+
+  # Draw the tilts of the sloped sections in a single batch, in the order they were found
+  tilts = sample_tilts(tilt_distribution, len(sloped_sections), rng)
+  for section_key, tilt in zip(sloped_sections, tilts):
+    partial_sections[section_key]['tilt'] = tilt
+
+  return partial_sections
+
+def merge_superstructures(partial_sections: dict,
+                          supersts: list,
+                          superst_classes: list,
+                          img_center_latlon: tuple,
+                          zoom: int
+):
+  '''Merges the superstructures of an image with its sections,
+  updating the sections in place and returning a dictionary of
+  superstructures by their index in the image:
+
+  - Superstructures that are outside of detected rooftops will be filtered out
+  - Superstructures that intersect with rooftops/sections will be filtered from the available area
+
+  Only the superstructures whose bounding box intersects a section
+  are tested, using a spatial index of the superstructures.
+  '''
+  partial_supersts = {}
+  superst_tree = shapely.STRtree(supersts)
+
+  for k, v in list(partial_sections.items()):
+    poly = v['polygon_xy']
+    v['superstructures'] = []
+    # Differences only shrink the section, so its initial bounding box holds all candidates
+    for i in np.sort(superst_tree.query(poly)).tolist():
+      superst, superst_class = supersts[i], superst_classes[i]
+      intersects = False
+      try:
+        intersects = poly.intersects(superst)
+      except Exception as e:
+        print(f'Exception with intersecting processing polygons:')
+        print(type(poly))
+        print(type(superst))
+        print(poly.wkt)
+        print(superst.wkt)
+
+      if intersects:
+        # Filter the superstructure area from the section
+        try:
+          # Keep only the part of the superstructure inside of the section
+          superst = superst.intersection(poly)
+          poly = poly.difference(superst)
+        except:
+          print(f'Encountered exception processing polygons:')
+          print(type(poly))
+          print(type(superst))
+          print(poly.wkt)
+          print(superst.wkt)
+        if i not in partial_supersts and superst.is_valid and (superst.geom_type == 'Polygon' or superst.geom_type == 'MultiPolygon'):
+          # TODO: add area and other info
+          partial_supersts[i] = {
+            'class': superst_class,
+            'polygon_xy': superst,
+            'original_img_center_latlon': img_center_latlon,
+            'area': passion.util.shapes.get_area(superst, img_center_latlon, zoom)
+          }
+    # If polygon has become a Geometrycollection, remove non polygons
+    if poly.geom_type == 'GeometryCollection':
+      polys = []
+      [polys.append(p) for p in poly.geoms if p.geom_type == 'Polygon']
+      poly = shapely.geometry.MultiPolygon(polys)
+
+    if poly.geom_type == 'Polygon' or poly.geom_type == 'MultiPolygon':
+      partial_sections[k].update({'polygon_xy': poly})
+    else:
+      # Debug why the poly is not a (multi)poly
+      print(f'Found non polygon shape:')
+      print(poly.geom_type)
+      del partial_sections[k]
+
+  return partial_supersts
+
+def get_tilt(tilt_distribution, rng: np.random.Generator = None):
+  '''Extracts a new tilt value from a given distribution.
+  If no random generator is given, numpy's global one is used.
+  '''
+  tilt = sample_tilts(tilt_distribution, 1, rng)[0]
   return tilt
 
+def sample_tilts(tilt_distribution, n_tilts: int, rng: np.random.Generator = None):
+  '''Extracts n_tilts tilt values in a single batch from a given distribution,
+  which can be a scipy KDE or an inverse CDF table from get_tilt_table().
+  Sampling from a table costs a uniform draw and an interpolation per tilt.
+  If no random generator is given, numpy's global one is used.
+  '''
+  if n_tilts == 0: return np.zeros(0)
+  if isinstance(tilt_distribution, np.ndarray):
+    uniform = rng.random(n_tilts) if rng is not None else np.random.random(n_tilts)
+    return np.interp(uniform, np.linspace(0, 1, len(tilt_distribution)), tilt_distribution)
+  return tilt_distribution.resample(n_tilts, seed=rng)[0]
+
+def get_tilt_table(tilt_distribution, n_quantiles: int = 4096, n_grid: int = 4096):
+  '''Takes a one dimensional scipy KDE and returns its inverse CDF as a table
+  of n_quantiles tilts at evenly spaced probabilities between 0 and 1.
+
+  The CDF is evaluated on a grid of n_grid tilts covering the data and 5
+  bandwidths around it, with the data binned at a hundredth of the bandwidth.
+  '''
+  data = tilt_distribution.dataset[0]
+  bandwidth = np.sqrt(tilt_distribution.covariance[0, 0])
+  weights = tilt_distribution.weights
+
+  bin_edges = np.arange(data.min(), data.max() + bandwidth / 100, bandwidth / 100)
+  bin_weights, bin_edges = np.histogram(data, bins=bin_edges, weights=weights)
+  bin_centers = ((bin_edges[:-1] + bin_edges[1:]) / 2)[bin_weights > 0]
+  bin_weights = bin_weights[bin_weights > 0]
+
+  grid = np.linspace(data.min() - 5 * bandwidth, data.max() + 5 * bandwidth, n_grid)
+  cdf = np.zeros(n_grid)
+  for start in range(0, len(bin_centers), 1024):
+    centers = bin_centers[start:start + 1024]
+    cdf += scipy.special.ndtr((grid[:, None] - centers[None, :]) / bandwidth) @ bin_weights[start:start + 1024]
+  cdf = np.maximum.accumulate(cdf / cdf[-1])
+
+  # Keep the first grid point of every CDF value, so that the interpolation is well defined
+  cdf, unique_index = np.unique(cdf, return_index=True)
+  return np.interp(np.linspace(0, 1, n_quantiles), cdf, grid[unique_index])
+
 def get_azimuth_from_segmentation(predicted: int):
   '''TODO: docstring'''
   if predicted == 17: return 180
@@ -1 +1,2 @@
-from . import lcoe
\ No newline at end of file
+from . import lcoe
+from . import uncertainty
\ No newline at end of file
@@ -1,8 +1,19 @@
+import itertools
 import pathlib
+import numpy as np
 import xarray
 
 import passion.util
 
+DEFAULT_LCOE_PARAMS = {
+  'panel_lifespan': 25,
+  'inverter_lifespan': 13,
+  'inverter_price_rate': 0.2,
+  'other_costs': 200,
+  'discount_rate': 0.08,
+  'yearly_degradation': 0.005
+}
+
 def generate_economic(input_path: pathlib.Path,
                       output_path: pathlib.Path,
                       output_filename: str,
@@ -52,31 +63,102 @@ def generate_economic(input_path: pathlib.Path,
 
   return
 
+def generate_economic_scenarios(input_path: pathlib.Path,
+                                output_path: pathlib.Path,
+                                output_filename: str,
+                                scenarios: dict,
+                                lcoe_params: dict = None):
+  '''Generates a NetCDF file containing the Levelised Cost of Electricity of the input
+  sections for every combination of the given economic parameters.
+
+  The result is a section_lcoe cube over the sections and a scenario dimension, with
+  the value of every parameter of each scenario as a coordinate along it.
+
+  ---
+  
+  input_path          -- Path, path in which the technical potential NetCDF analysis is stored.
+  output_path         -- Path, folder in which the scenarios analysis will be stored.
+  output_filename     -- str, name for the scenarios analysis output.
+  scenarios           -- dict, list of values of every swept parameter. Besides the parameters
+                         of generate_economic, 'module_price' recomputes the modules cost
+                         from the number of panels of each section.
+  lcoe_params         -- dict, values of the parameters that are not swept.
+  '''
+  output_path.mkdir(parents=True, exist_ok=True)
+
+  lcoe_params = { **DEFAULT_LCOE_PARAMS, **(lcoe_params or {}) }
+  scenario_params = get_scenario_grid(scenarios)
+  lcoe_params.update(scenario_params)
+
+  with xarray.open_dataset(str(input_path)) as technical_ds:
+    modules_cost = technical_ds.section_modules_cost
+    if 'module_price' in lcoe_params:
+      modules_cost = technical_ds.section_n_panels * lcoe_params.pop('module_price')
+    lcoe = calculate_lcoe(technical_ds.section_yearly_system_generation,
+                          technical_ds.section_capacity,
+                          modules_cost,
+                          lcoe_params)
+    scenarios_ds = xarray.Dataset({ 'section_lcoe': lcoe.transpose(..., 'scenario') })
+    scenarios_ds = scenarios_ds.assign_coords({ name: values for name, values in scenario_params.items() })
+    scenarios_ds = scenarios_ds.load()
+
+  if not output_filename.endswith('.nc'):
+    output_filename += '.nc'
+  scenarios_ds.to_netcdf(str(output_path / output_filename))
+
+  return
+
+def get_scenario_grid(scenarios: dict):
+  '''Takes a list of values for every parameter and returns a DataArray per
+  parameter along a scenario dimension, covering all of their combinations.
+  '''
+  names = list(scenarios.keys())
+  grid = list(itertools.product(*[ np.atleast_1d(scenarios[name]) for name in names ]))
+  return { name: xarray.DataArray(np.array([ values[i] for values in grid ], dtype=float), dims='scenario')
+           for i, name in enumerate(names) }
+
 def calculate_lcoe(generation: float, capacity: float, modules_cost: float, lcoe_params: dict):
   '''Calculates the Levelised Cost of Electricity for a yearly electricity generation
   and installation properties.
 
   The formula takes into account the yearly costs and benefits, degradation factor
-  and discount rate.
+  and discount rate. The yearly sums are evaluated in closed form as geometric series,
+  so every argument and parameter can be a scalar, a numpy array or a DataArray, and
+  they are broadcast against each other.
 
   Returns the average price per Mega-Watt hour during the system lifespan.
   '''
+  costs, total_generation = get_lcoe_terms(generation, capacity, modules_cost, lcoe_params)
+  lcoe = costs / total_generation
+  lcoe_eur_MWh = lcoe * 1000 * 1000
+
+  return lcoe_eur_MWh
+
+def get_lcoe_terms(generation: float, capacity: float, modules_cost: float, lcoe_params: dict):
+  '''Returns the lifetime costs and the lifetime generation whose ratio is the
+  LCOE of calculate_lcoe. They can be summed over installations to get the
+  LCOE of a group of them.
+  '''
+  panel_lifespan = np.trunc(lcoe_params['panel_lifespan'])
+  inverter_lifespan = lcoe_params['inverter_lifespan']
+  discount_factor = 1 / (1 + lcoe_params['discount_rate'])
+
   inverter_price = lcoe_params['inverter_price_rate'] * capacity
   initial_investment = modules_cost + inverter_price + lcoe_params['other_costs']
 
-  maintenance_costs = 0
-  total_generation = 0
-  for year in range(0, int(lcoe_params['panel_lifespan'])):
-    m_costs_y = 0.01 * initial_investment / ((1 + lcoe_params['discount_rate']) ** year)
-    maintenance_costs += m_costs_y
+  # The inverter is replaced once if its lifespan is one of the years of the panels
+  inverter_replaced = (inverter_lifespan == np.trunc(inverter_lifespan)) & \
+                      (inverter_lifespan >= 0) & (inverter_lifespan < panel_lifespan)
+  maintenance_costs = 0.01 * initial_investment * geometric_sum(discount_factor, panel_lifespan) + \
+                      inverter_price * inverter_replaced
 
-    if year == lcoe_params['inverter_lifespan']:
-      maintenance_costs += inverter_price
+  total_generation = generation * panel_lifespan - \
+                     geometric_sum(lcoe_params['yearly_degradation'] * discount_factor, panel_lifespan)
 
-    generation_y = generation - (lcoe_params['yearly_degradation'] ** year) / ((1 + lcoe_params['discount_rate']) ** year)
-    total_generation += generation_y
+  return initial_investment + maintenance_costs, total_generation
 
-  lcoe = (initial_investment + maintenance_costs) / total_generation
-  lcoe_eur_MWh = lcoe * 1000 * 1000
-
-  return lcoe_eur_MWh
+def geometric_sum(ratio, n_terms):
+  '''Sum of ratio ** year for year in range(n_terms).'''
+  is_one = ratio == 1
+  series = (1 - ratio ** n_terms) / (1 - ratio + is_one)
+  return xarray.where(is_one, n_terms, series)
@@ -0,0 +1,202 @@
+import pathlib
+import numpy as np
+import pandas as pd
+import xarray
+
+import passion.util
+import passion.buildings.building_analysis
+from passion.economic.lcoe import DEFAULT_LCOE_PARAMS, get_lcoe_terms
+
+def generate_uncertainty(input_path: pathlib.Path,
+                         output_path: pathlib.Path,
+                         output_filename: str,
+                         tilt_distribution,
+                         parameter_ranges: dict = None,
+                         lcoe_params: dict = None,
+                         n_samples: int = 1000,
+                         percentiles: list = (5, 50, 95),
+                         profiles_path: pathlib.Path = None,
+                         pv_model_id: str = None,
+                         weather_cell_size: tuple = (0.5, 0.625),
+                         elev_bin: float = 100.0,
+                         chunk_size: int = 10000,
+                         seed: int = None):
+  '''Generates a NetCDF file containing percentile bands of the yearly generation
+  and the Levelised Cost of Electricity of every section and of the whole region.
+
+  Every one of the n_samples draws a tilt for each non-flat section from the
+  tilt distribution, and a value of every economic parameter in parameter_ranges
+  shared by all sections. Generation follows the tilt through the ratio between
+  the cached 1 kW profiles of the section orientation at the drawn tilt and at
+  the simulated one, interpolated between the cached tilt bins, which should cover
+  every tilt (see passion.technical.reskit.cache_tilt_profiles()). A ValueError is
+  raised if there are non-flat sections but no cached profiles. Sections without
+  cached profiles keep their simulated generation, and sampled tilts outside the
+  cached bins take the generation of the closest bin, both with a warning.
+
+  Sections are evaluated in blocks of chunk_size, so memory is bounded by
+  chunk_size * n_samples. The tilts of every block are drawn in a single batch,
+  so results are reproducible for the same seed and chunk_size, but change
+  with chunk_size.
+
+  ---
+
+  input_path          -- Path, path in which the technical potential NetCDF analysis is stored.
+  output_path         -- Path, folder in which the uncertainty analysis will be stored.
+  output_filename     -- str, name for the uncertainty analysis output.
+  tilt_distribution   -- scipy.stats.gaussian_kde or inverse CDF table, distribution of the tilt of non-flat sections.
+  parameter_ranges    -- dict, (low, high) range of the uniformly sampled parameters. Besides the
+                         parameters of generate_economic, 'module_price' recomputes the modules cost.
+  lcoe_params         -- dict, values of the parameters that are not sampled.
+  n_samples           -- int, number of samples per section.
+  percentiles         -- list, percentiles of the output bands.
+  profiles_path       -- Path, CSV of the simulation cache of the technical analysis.
+  pv_model_id         -- str, RESKit identifier of the panel model of the cached profiles.
+  weather_cell_size   -- tuple, size in degrees of the weather cells of the cached profiles.
+  elev_bin            -- float, size in meters of the elevation bins of the cached profiles.
+  chunk_size          -- int, number of sections evaluated at a time.
+  seed                -- int, seed of the samples, reproducible with the same chunk_size.
+  '''
+  output_path.mkdir(parents=True, exist_ok=True)
+
+  rng = np.random.default_rng(seed)
+  params = sample_lcoe_params(rng, n_samples, parameter_ranges or {}, lcoe_params)
+  module_price = params.pop('module_price', None)
+
+  with xarray.open_dataset(str(input_path)) as technical_ds:
+    location_dim = technical_ds.section_capacity.dims[0]
+    location = technical_ds[location_dim].values
+    sections = { var: technical_ds[f'section_{var}'].values for var in
+                 ['yearly_system_generation', 'capacity', 'n_panels', 'modules_cost',
+                  'tilt', 'azimuth', 'flat', 'lat', 'lon', 'elev'] }
+  n_sections = len(location)
+
+  profiles = load_profiles(profiles_path, pv_model_id)
+  if not profiles and not sections['flat'].astype(bool).all():
+    raise ValueError(f'No cached profiles found in {profiles_path}, the tilt uncertainty of the non-flat sections '
+                     f'cannot be evaluated. Run the technical analysis with the simulation cache.')
+  lat_cells, lon_cells = passion.util.gis.get_weather_cells(sections['lat'], sections['lon'], weather_cell_size)
+  elev_bins = np.round(sections['elev'].astype(float) / elev_bin) * elev_bin
+  azimuth_bins = np.round(sections['azimuth'].astype(float), 3)
+  n_missing, n_outside = 0, 0
+
+  section_generation = np.empty((n_sections, len(percentiles)))
+  section_lcoe = np.empty((n_sections, len(percentiles)))
+  region_generation = np.zeros(n_samples)
+  region_costs = np.zeros(n_samples)
+  region_total_generation = np.zeros(n_samples)
+  for start in range(0, n_sections, chunk_size):
+    chunk = slice(start, start + chunk_size)
+    print(f'Sampling sections {start}-{min(start + chunk_size, n_sections)} of {n_sections}...')
+
+    tilts = sample_tilts(rng, tilt_distribution, sections['tilt'][chunk], sections['flat'][chunk], n_samples)
+    sloped = ~sections['flat'][chunk].astype(bool)
+    tilt_factors, missing, outside = get_tilt_factors(profiles, lat_cells[chunk], lon_cells[chunk], elev_bins[chunk],
+                                                      azimuth_bins[chunk], sections['tilt'][chunk], tilts)
+    n_missing += int((missing & sloped).sum())
+    n_outside += int(outside[sloped].sum())
+    generation = sections['yearly_system_generation'][chunk, None] * tilt_factors
+
+    modules_cost = sections['modules_cost'][chunk, None]
+    if module_price is not None:
+      modules_cost = sections['n_panels'][chunk, None] * module_price
+    costs, total_generation = get_lcoe_terms(generation, sections['capacity'][chunk, None], modules_cost, params)
+    costs = np.broadcast_to(costs, generation.shape)
+    lcoe = costs / total_generation * 1000 * 1000
+
+    section_generation[chunk] = np.percentile(generation, percentiles, axis=1).T
+    section_lcoe[chunk] = np.percentile(lcoe, percentiles, axis=1).T
+    region_generation += generation.sum(axis=0)
+    region_costs += costs.sum(axis=0)
+    region_total_generation += total_generation.sum(axis=0)
+
+  if n_missing:
+    print(f'Warning: {n_missing} non-flat sections have no cached profiles, their tilt uncertainty is not evaluated.')
+  if n_outside:
+    print(f'Warning: {n_outside} sampled tilts are outside the cached tilt bins of their section, '
+          f'they take the generation of the closest bin.')
+
+  region_lcoe = region_costs / region_total_generation * 1000 * 1000
+  uncertainty_ds = xarray.Dataset({
+    'section_yearly_system_generation': ((location_dim, 'percentile'), section_generation),
+    'section_lcoe': ((location_dim, 'percentile'), section_lcoe),
+    'region_yearly_system_generation': ('percentile', np.percentile(region_generation, percentiles)),
+    'region_lcoe': ('percentile', np.percentile(region_lcoe, percentiles))
+  }, coords={ location_dim: location, 'percentile': np.asarray(percentiles, dtype=float) })
+  uncertainty_ds = uncertainty_ds.assign_attrs(n_samples=n_samples)
+
+  if not output_filename.endswith('.nc'):
+    output_filename += '.nc'
+  uncertainty_ds.to_netcdf(str(output_path / output_filename))
+
+  return
+
+def sample_lcoe_params(rng: np.random.Generator, n_samples: int, parameter_ranges: dict, lcoe_params: dict = None):
+  '''Returns the LCOE parameters with an array of n_samples uniform samples
+  for the ones in parameter_ranges, and the given or default value for the rest.
+  '''
+  params = { **DEFAULT_LCOE_PARAMS, **(lcoe_params or {}) }
+  for name, (low, high) in parameter_ranges.items():
+    params[name] = rng.uniform(float(low), float(high), n_samples)
+  return params
+
+def sample_tilts(rng: np.random.Generator, tilt_distribution, tilts: np.ndarray, flats: np.ndarray, n_samples: int):
+  '''Returns a (sections, n_samples) array of tilts drawn in a single batch from
+  the tilt distribution for non-flat sections, and their own tilt for flat ones.
+  '''
+  flats = np.asarray(flats).astype(bool)
+  sampled_tilts = np.repeat(np.asarray(tilts, dtype=float)[:, None], n_samples, axis=1)
+  n_sloped = int((~flats).sum())
+  if n_sloped:
+    samples = passion.buildings.building_analysis.sample_tilts(tilt_distribution, n_sloped * n_samples, rng)
+    sampled_tilts[~flats] = np.clip(samples, 0, 90).reshape(n_sloped, n_samples)
+  return sampled_tilts
+
+def load_profiles(profiles_path: pathlib.Path, pv_model_id: str = None):
+  '''Loads the simulation cache of the technical analysis, and returns a dictionary
+  from (lat_cell, lon_cell, elev_bin, azimuth_bin) to the sorted tilt bins and their
+  yearly generation per kW.
+  '''
+  if profiles_path is None or not pathlib.Path(profiles_path).exists(): return {}
+
+  profiles_df = pd.read_csv(profiles_path, float_precision='round_trip')
+  if pv_model_id is not None:
+    profiles_df = profiles_df[profiles_df['pv_model'] == pv_model_id]
+  profiles = {}
+  for (lat_cell, lon_cell, elev_bin, azimuth_bin), group in profiles_df.groupby(['lat_cell', 'lon_cell', 'elev_bin',
+                                                                                  'azimuth_bin']):
+    group = group.groupby('tilt_bin')['generation_per_kw'].mean()
+    profiles[(lat_cell, lon_cell, elev_bin, azimuth_bin)] = (group.index.values.astype(float), group.values.astype(float))
+  return profiles
+
+def get_tilt_factors(profiles: dict,
+                     lat_cells: np.ndarray,
+                     lon_cells: np.ndarray,
+                     elev_bins: np.ndarray,
+                     azimuth_bins: np.ndarray,
+                     tilts: np.ndarray,
+                     sampled_tilts: np.ndarray):
+  '''Returns the ratio between the generation of the profile of every section at
+  its sampled tilts and at its own tilt, or 1 if it has no cached profiles.
+  Also returns whether every section has no cached profiles, and the number of its
+  sampled tilts outside its cached tilt bins, which take the closest bin.
+  '''
+  tilt_factors = np.ones(sampled_tilts.shape)
+  missing = np.ones(len(tilts), dtype=bool)
+  outside = np.zeros(len(tilts), dtype=np.int64)
+  if not profiles: return tilt_factors, missing, outside
+
+  keys = np.stack([lat_cells, lon_cells, elev_bins, azimuth_bins], axis=1)
+  unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+  for key_i, (lat_cell, lon_cell, elev_bin, azimuth_bin) in enumerate(unique_keys):
+    profile = profiles.get((int(lat_cell), int(lon_cell), elev_bin, azimuth_bin))
+    if profile is None: continue
+    profile_tilts, profile_generation = profile
+    rows = np.flatnonzero(inverse.ravel() == key_i)
+    missing[rows] = False
+    outside[rows] = ((sampled_tilts[rows] < profile_tilts[0]) | (sampled_tilts[rows] > profile_tilts[-1])).sum(axis=1)
+    reference = np.interp(tilts[rows], profile_tilts, profile_generation)
+    valid = reference > 0
+    rows = rows[valid]
+    tilt_factors[rows] = np.interp(sampled_tilts[rows], profile_tilts, profile_generation) / reference[valid, None]
+  return tilt_factors, missing, outside
@@ -6,9 +6,16 @@ import PIL.Image
 import numpy as np
 import tqdm
 import math
+import os
 import traceback
+import hashlib
+import time
+import threading
+import concurrent.futures
 import pkg_resources
 import mahotas.polygon
+import shapely
+import shapely.geometry
 
 import passion.util
 
@@ -20,6 +27,9 @@ MAX_WIDTH_GOOGLE, MAX_HEIGHT_GOOGLE = 640, 640
 WATERMARK_BING = 25
 WATERMARK_GOOGLE = 40
 
+# NUMBER OF RETRIEVED TILES AFTER WHICH THE MANIFEST IS WRITTEN TO DISK
+MANIFEST_WRITE_INTERVAL = 50
+
 # GETTING RESOURCES FROM /data FOLDER, NEEDED TO CHECK NULL IMAGES
 SATELLITE_DATA_PATH = pathlib.Path(__file__).parent.resolve() / 'data'
 NULL_IMAGE_BING_PATH = SATELLITE_DATA_PATH / 'bing_null_image.png'
@@ -34,7 +44,10 @@ def generate_dataset(
   zoom: int = passion.util.gis.MAXZOOM,
   bbox: tuple = None,
   shapefile: shapefile.Shape = None,
-  find_valid_zoom: bool = False
+  find_valid_zoom: bool = False,
+  max_workers: int = 1,
+  requests_per_second: float = None,
+  dry_run: bool = False
 ):
   '''Generate satellite tiles of a region into an output folder.
 
@@ -48,15 +61,28 @@ def generate_dataset(
   One of bbox or shapefile must be specified in order to define a region.
   If both are specified, shapefile is taken.
   TODO: if both are specified, select the bbox inside the shapefile
+
+  Tiles are retrieved concurrently by max_workers threads, as most of the
+  retrieval time is spent waiting for the service to respond. The number
+  of requests sent to the service can be capped with requests_per_second.
+
+  The tile grid is planned up front and written to a manifest in the output
+  folder (see plan_tiles()). Tiles already stored with a valid checksum are
+  skipped, so an interrupted or partially failed retrieval can be resumed
+  by running it again. With dry_run, only the plan is made and the number
+  of requests needed is reported, in order to estimate the cost of the API.
   ---
   
-  api_key           -- string, API key of the specified service
-  service           -- string, currently must be one of 'bing' or 'google'
-  output_path       -- Path, folder in which tiles will be stored
-  zoom              -- integer, zoom level (https://docs.microsoft.com/en-us/bingmaps/articles/understanding-scale-and-resolution)
-  bbox              -- tuple of tuples of floats: ((lat1, lon1), (lat2, lon2))
-  shapefile         -- shapefile, used for filtering
-  find_valid_zoom   -- bool, finds the next available zoom level if True
+  api_key             -- string, API key of the specified service
+  service             -- string, currently must be one of 'bing' or 'google'
+  output_path         -- Path, folder in which tiles will be stored
+  zoom                -- integer, zoom level (https://docs.microsoft.com/en-us/bingmaps/articles/understanding-scale-and-resolution)
+  bbox                -- tuple of tuples of floats: ((lat1, lon1), (lat2, lon2))
+  shapefile           -- shapefile, used for filtering
+  find_valid_zoom     -- bool, finds the next available zoom level if True
+  max_workers         -- int, number of tiles retrieved concurrently
+  requests_per_second -- float, maximum number of requests per second sent to the service, unlimited if None
+  dry_run             -- bool, only plans the tiles and reports the number of requests if True
   '''
   if bbox == None and shapefile == None:
     raise ValueError('Either bbox and/or shapefile must be specified.')
@@ -74,95 +100,300 @@ def generate_dataset(
   request_width = MAX_WIDTH_GOOGLE if service =='google' else MAX_WIDTH_BING
   request_height = MAX_HEIGHT_GOOGLE if service =='google' else MAX_HEIGHT_BING
 
+  rate_limiter = RateLimiter(requests_per_second)
+
   finished = False
   minimum_zoom = 0 if find_valid_zoom else (zoom - 1)
   for z in range(zoom, minimum_zoom, -1):
     if finished: break
-    
-    offset_x, offset_y = passion.util.gis.get_image_offset(bbox, zoom)
-
-    northwest_x1, northwest_y1 = passion.util.gis.latlon_toXY(lat1, lon1, zoom)
-    northwest_x2, northwest_y2 = passion.util.gis.latlon_toXY(lat2, lon2, zoom)
-    northwest_x1, northwest_x2 = min(northwest_x1, northwest_x2), max(northwest_x1, northwest_x2)
-    northwest_y1, northwest_y2 = min(northwest_y1, northwest_y2), max(northwest_y1, northwest_y2)
-
-    # START CENTER INSTEAD OF BORDER
-    x1 = northwest_x1 + (request_width//2)
-    y1 = northwest_y1 + ((request_height)//2)
-
-    current_x = x1
-    current_y = y1
-
-    valid_request = True
-
-    print('Trying zoom level: {0}'.format(zoom))
-    print('Map pixels from\t({0},{1})\nTo\t({2},{3})'.format(northwest_x1,northwest_y1,northwest_x2,northwest_y2))
-
-    # x=0, y=0 is at lat=90 lon=-180
-    total = math.ceil(abs(x1-northwest_x2)/request_width) * math.ceil(abs(y1-northwest_y2)/request_height)
-    pbar = tqdm.tqdm(total=total, position=0, leave=True)
-    while ((current_y  < northwest_y2) and valid_request):
-      while ((current_x < northwest_x2) and valid_request):
-        # Current image center latlon values
-        current_lat, current_lon = passion.util.gis.xy_tolatlon(current_x, current_y, zoom)
-
-        try:
-          #TODO: adjust image center at the width and height borders, so that we cover the exact area
-          limit_x, limit_y = current_x + request_width, current_y + request_height
-          image_bbox = [ (current_x, current_y), (current_x, limit_y), (limit_x, limit_y), (limit_x, current_y) ]
-
-          image_intersects = True
-          if shapefile:
-            shapefile_pixels = passion.util.gis.shape_to_pixels(shapefile, zoom)
-            shapefile_pixels_corrected = passion.util.gis.substract_offset(shapefile_pixels, offset_x, offset_y)
-            shapefile_pixels_relative = passion.util.gis.substract_offset(shapefile_pixels_corrected, current_x-offset_x, current_y-offset_y)
-            
-            image_intersects = passion.util.gis.polygons_intersect(shapefile_pixels, image_bbox)
-          
-          if image_intersects:
-            img = retrieve_image(api_key, service, (current_lat, current_lon), (request_width, request_height), zoom)
-
-            if (is_null_image(img, service)):
-              raise RuntimeError('Null image retrieved, {0} level of detail not available.'.format(zoom))
-            
-            # WATERMARK ADJUSTMENT
-            img = img.crop((0,0,request_width,request_height-watermark))
-            tmp_x, tmp_y = passion.util.gis.latlon_toXY(current_lat, current_lon, zoom)
-            current_lat, current_lon = passion.util.gis.xy_tolatlon(tmp_x, tmp_y - (watermark//2), zoom)
-
-            if shapefile:
-              img = filter_image_shapefile(img, shapefile_pixels_relative)
-            
-            filename = passion.util.gis.get_filename((current_lat, current_lon), zoom)
-
-            tif_name = filename.replace('.png', '.tif')
-            img_np = np.asarray(img)
-            height, width, channels = img_np.shape
-            west, north, east, south = (current_x - (width//2), current_y + (height//2) - (watermark//2), current_x + (width//2), current_y - (height//2) - (watermark//2))
-            
-            transform = passion.util.gis.get_gdal_transform([west, south, east, north], width, height)
-            projection = passion.util.gis.get_gdal_projection(epsg = 3857)
-            metadata = {'zoom_level': str(zoom)}
-            passion.util.io.write_geotiff(str(output_path / tif_name),
-                                          img_np,
-                                          transform,
-                                          projection,
-                                          metadata)
-        
-        except Exception as e:
-          #TODO: handle specific exceptions
-          print(traceback.format_exc())
-          valid_request = False
-          pbar.close()
 
+    print('Trying zoom level: {0}'.format(z))
+    shapefile_pixels = None
+    if shapefile:
+      shapefile_pixels = passion.util.gis.shape_to_pixels(shapefile, z)
 
-        current_x += request_width
-        pbar.update(1)
-      current_x = x1
-      current_y += request_height - watermark
-    pbar.close()
+    tiles = plan_tiles(bbox, z, (request_width, request_height), watermark, shapefile_pixels)
+
+    # Keep the status of the tiles retrieved in previous runs
+    manifest_path = output_path / get_manifest_name(z)
+    tiles = merge_manifest(tiles, load_manifest(manifest_path))
+
+    n_requests = len(get_pending_tiles(output_path, tiles))
+    print('Zoom level {0}: {1} tiles in the grid, {2} intersect the region, {3} requests needed.'.format(
+          z, len(tiles), sum(tile['status'] != 'outside' for tile in tiles), n_requests))
+    if dry_run: break
+
+    write_manifest(tiles, manifest_path)
+
+    valid_request = retrieve_tiles(api_key, service, output_path, tiles, z,
+                                   (request_width, request_height), watermark,
+                                   shapefile_pixels, max_workers, rate_limiter,
+                                   manifest_path)
     if valid_request: finished = True
 
+def get_tile_grid(bbox: tuple, zoom: int, size: tuple, watermark: int):
+  '''Returns the list of tiles covering a bounding box as tuples of
+  (row, column, center x, center y), in pixel coordinates.
+
+  Tiles are ordered row by row from the northwest corner. Consecutive rows
+  overlap by the size of the watermark, which is cropped from every tile.
+  '''
+  (lat1, lon1), (lat2, lon2) = bbox
+  request_width, request_height = size
+
+  northwest_x1, northwest_y1 = passion.util.gis.latlon_toXY(lat1, lon1, zoom)
+  northwest_x2, northwest_y2 = passion.util.gis.latlon_toXY(lat2, lon2, zoom)
+  northwest_x1, northwest_x2 = min(northwest_x1, northwest_x2), max(northwest_x1, northwest_x2)
+  northwest_y1, northwest_y2 = min(northwest_y1, northwest_y2), max(northwest_y1, northwest_y2)
+
+  print('Map pixels from\t({0},{1})\nTo\t({2},{3})'.format(northwest_x1,northwest_y1,northwest_x2,northwest_y2))
+
+  # START CENTER INSTEAD OF BORDER
+  x1 = northwest_x1 + (request_width//2)
+  y1 = northwest_y1 + ((request_height)//2)
+
+  # x=0, y=0 is at lat=90 lon=-180
+  tiles = []
+  for row, current_y in enumerate(range(y1, northwest_y2, request_height - watermark)):
+    for col, current_x in enumerate(range(x1, northwest_x2, request_width)):
+      tiles.append((row, col, current_x, current_y))
+
+  return tiles
+
+def plan_tiles(bbox: tuple, zoom: int, size: tuple, watermark: int, shapefile_pixels: list = None):
+  '''Plans the tiles needed to cover a bounding box before retrieving them.
+
+  Returns a list of manifest entries, one per tile, with the keys:
+  row, col      -- tile index in the grid.
+  x, y          -- tile center in pixel coordinates, as requested to the service.
+  lat, lon      -- tile center in latitude and longitude, as requested to the service.
+  pixel_box     -- [west, north, east, south] pixel box of the stored (cropped) tile.
+  filename      -- name of the stored GeoTIFF.
+  status        -- one of 'pending', 'done', 'failed' or 'outside' (does not intersect the shapefile).
+  checksum      -- checksum of the stored GeoTIFF, empty if not retrieved.
+  '''
+  request_width, request_height = size
+
+  grid = get_tile_grid(bbox, zoom, size, watermark)
+  grid_x, grid_y = np.array(grid, dtype=np.int64).reshape(-1, 4)[:, 2:].T
+
+  # Select the tiles that intersect the shapefile at once, projecting it only once
+  intersects = np.ones(len(grid), dtype=bool)
+  if shapefile_pixels and grid:
+    #TODO: adjust image center at the width and height borders, so that we cover the exact area
+    image_bboxes = shapely.box(grid_x, grid_y, grid_x + request_width, grid_y + request_height)
+    shapefile_polygon = shapely.geometry.Polygon(shapefile_pixels)
+    shapely.prepare(shapefile_polygon)
+    intersects = shapely.intersects(shapefile_polygon, image_bboxes)
+
+  # Current image center latlon values
+  grid_lat, grid_lon = passion.util.gis.xy_tolatlon_array(grid_x, grid_y, zoom)
+
+  # WATERMARK ADJUSTMENT
+  tmp_x, tmp_y = passion.util.gis.latlon_toXY_array(grid_lat, grid_lon, zoom)
+  tiles_lat, tiles_lon = passion.util.gis.xy_tolatlon_array(tmp_x, tmp_y - (watermark//2), zoom)
+
+  tiles = []
+  for (row, col, current_x, current_y), current_lat, current_lon, tile_lat, tile_lon, tile_intersects in zip(
+      grid, grid_lat.tolist(), grid_lon.tolist(), tiles_lat.tolist(), tiles_lon.tolist(), intersects):
+    status = 'pending' if tile_intersects else 'outside'
+    filename = passion.util.gis.get_filename((tile_lat, tile_lon), zoom, extension='tif')
+
+    width, height = request_width, request_height - watermark
+    west, north, east, south = (current_x - (width//2), current_y + (height//2) - (watermark//2), current_x + (width//2), current_y - (height//2) - (watermark//2))
+
+    tiles.append({
+      'row': row,
+      'col': col,
+      'x': current_x,
+      'y': current_y,
+      'lat': current_lat,
+      'lon': current_lon,
+      'pixel_box': [west, north, east, south],
+      'filename': filename,
+      'status': status,
+      'checksum': ''
+    })
+
+  return tiles
+
+def get_manifest_name(zoom: int):
+  '''Returns the name of the manifest file of a zoom level.'''
+  return 'manifest_{0:02d}L.csv'.format(zoom)
+
+def load_manifest(manifest_path: pathlib.Path):
+  '''Loads a tile manifest, returning an empty list if it does not exist.'''
+  if not manifest_path.exists(): return []
+  return passion.util.io.load_csv(manifest_path.parent, manifest_path.name)
+
+def write_manifest(tiles: list, manifest_path: pathlib.Path):
+  '''Writes a tile manifest, replacing the previous one only once it is complete.'''
+  if not tiles: return
+  tmp_name = manifest_path.stem + '.tmp'
+  passion.util.io.save_to_csv(tiles, manifest_path.parent, tmp_name)
+  os.replace(manifest_path.parent / (tmp_name + '.csv'), manifest_path)
+
+def merge_manifest(tiles: list, previous_tiles: list):
+  '''Copies the status and checksum of previously retrieved tiles into a new plan.'''
+  previous = { tile['filename']: tile for tile in previous_tiles }
+  for tile in tiles:
+    previous_tile = previous.get(tile['filename'])
+    if previous_tile and tile['status'] != 'outside':
+      tile['status'] = previous_tile['status']
+      tile['checksum'] = str(previous_tile['checksum'])
+  return tiles
+
+def get_checksum(path: pathlib.Path):
+  '''Returns the MD5 checksum of a file, prefixed with the algorithm name.'''
+  md5 = hashlib.md5()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      md5.update(chunk)
+  return 'md5:' + md5.hexdigest()
+
+def is_tile_valid(output_path: pathlib.Path, tile: dict):
+  '''Checks if a tile was already retrieved and is unchanged on disk.'''
+  if tile['status'] != 'done': return False
+  tile_path = output_path / tile['filename']
+  if not tile_path.exists(): return False
+  return get_checksum(tile_path) == tile['checksum']
+
+def get_pending_tiles(output_path: pathlib.Path, tiles: list):
+  '''Returns the planned tiles that intersect the region and are not stored yet.'''
+  return [ tile for tile in tiles if tile['status'] != 'outside' and not is_tile_valid(output_path, tile) ]
+
+def retrieve_tiles(
+  api_key: str,
+  service: str,
+  output_path: pathlib.Path,
+  tiles: list,
+  zoom: int,
+  size: tuple,
+  watermark: int,
+  shapefile_pixels: list = None,
+  max_workers: int = 1,
+  rate_limiter = None,
+  manifest_path: pathlib.Path = None
+):
+  '''Retrieves the tiles of a plan generated by plan_tiles() using a pool of
+  max_workers threads. Tiles that are already stored and valid are skipped,
+  and the status of every tile is written to the manifest.
+
+  Tiles that fail are marked as 'failed' so that they are retried in the next run.
+  Returns False if the zoom level is not available, in which case the
+  tiles that were not started yet are cancelled.
+  '''
+  pending = get_pending_tiles(output_path, tiles)
+  n_outside = sum(tile['status'] == 'outside' for tile in tiles)
+  print('{0} tiles planned: {1} outside of the region, {2} already retrieved, {3} to retrieve.'.format(
+        len(tiles), n_outside, len(tiles) - n_outside - len(pending), len(pending)))
+
+  valid_request = True
+  pbar = tqdm.tqdm(total=len(pending), position=0, leave=True)
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+    futures = { executor.submit(retrieve_tile, api_key, service, output_path, tile, zoom,
+                                size, watermark, shapefile_pixels, rate_limiter): tile
+                for tile in pending }
+    for i, future in enumerate(concurrent.futures.as_completed(futures)):
+      if future.cancelled(): continue
+      tile = futures[future]
+      try:
+        tile['checksum'] = future.result()
+        tile['status'] = 'done'
+      except NullImageError as e:
+        print(traceback.format_exc())
+        tile['status'] = 'pending'
+        if valid_request:
+          valid_request = False
+          for f in futures: f.cancel()
+      except Exception as e:
+        #TODO: handle specific exceptions
+        print(traceback.format_exc())
+        tile['status'] = 'failed'
+      pbar.update(1)
+      if manifest_path and (i + 1) % MANIFEST_WRITE_INTERVAL == 0:
+        write_manifest(tiles, manifest_path)
+  pbar.close()
+
+  if manifest_path: write_manifest(tiles, manifest_path)
+  n_failed = sum(tile['status'] == 'failed' for tile in tiles)
+  if n_failed:
+    print('{0} tiles failed, run the retrieval again to retry them.'.format(n_failed))
+
+  return valid_request
+
+def retrieve_tile(
+  api_key: str,
+  service: str,
+  output_path: pathlib.Path,
+  tile: dict,
+  zoom: int,
+  size: tuple,
+  watermark: int,
+  shapefile_pixels: list = None,
+  rate_limiter = None
+):
+  '''Retrieves a single tile planned by plan_tiles(), removes the
+  watermark and stores it as a GeoTIFF in the output folder.
+
+  Returns the checksum of the stored tile.
+  '''
+  current_x, current_y = tile['x'], tile['y']
+  current_lat, current_lon = tile['lat'], tile['lon']
+  request_width, request_height = size
+
+  img = retrieve_image(api_key, service, (current_lat, current_lon), (request_width, request_height), zoom, rate_limiter)
+
+  if (is_null_image(img, service)):
+    raise NullImageError('Null image retrieved, {0} level of detail not available.'.format(zoom))
+  
+  # WATERMARK ADJUSTMENT
+  img = img.crop((0,0,request_width,request_height-watermark))
+
+  if shapefile_pixels:
+    shapefile_pixels_relative = passion.util.gis.substract_offset(shapefile_pixels, current_x, current_y)
+    img = filter_image_shapefile(img, shapefile_pixels_relative)
+
+  img_np = np.asarray(img)
+  height, width, channels = img_np.shape
+  west, north, east, south = tile['pixel_box']
+  
+  transform = passion.util.gis.get_gdal_transform([west, south, east, north], width, height)
+  projection = passion.util.gis.get_gdal_projection(epsg = 3857)
+  metadata = {'zoom_level': str(zoom)}
+  passion.util.io.write_geotiff(str(output_path / tile['filename']),
+                                img_np,
+                                transform,
+                                projection,
+                                metadata)
+
+  return get_checksum(output_path / tile['filename'])
+
+class NullImageError(RuntimeError):
+  '''Raised when a service returns its null image, meaning that the
+  requested level of detail is not available.'''
+  pass
+
+class RateLimiter:
+  '''Thread-safe limiter that spaces out the requests made to a service
+  so that at most requests_per_second are sent. If requests_per_second
+  is None, requests are not limited.
+  '''
+  def __init__(self, requests_per_second: float = None):
+    self.interval = (1 / requests_per_second) if requests_per_second else 0
+    self.next_request = time.monotonic()
+    self.lock = threading.Lock()
+
+  def wait(self):
+    '''Blocks until the next request is allowed to be sent.'''
+    if not self.interval: return
+    with self.lock:
+      now = time.monotonic()
+      wait_time = self.next_request - now
+      self.next_request = max(now, self.next_request) + self.interval
+    if wait_time > 0:
+      time.sleep(wait_time)
+
 def is_null_image(img, service):
   '''Checks if a retrieved image is null by comparing it
   with the image that each service returns when
@@ -198,9 +429,11 @@ def retrieve_image(
   service: str,
   latlon: tuple,
   size: tuple,
-  zoom: int
+  zoom: int,
+  rate_limiter: RateLimiter = None
 ):
-  '''Retrieve a single image from a given service at a latlon and zoom level'''
+  '''Retrieve a single image from a given service at a latlon and zoom level.
+  If a RateLimiter is given, every request waits for it before being sent.'''
   if service != 'bing' and service != 'google':
     raise ValueError('Service must be either "bing" or "google"')
   
@@ -212,6 +445,7 @@ def retrieve_image(
   success = False
   while not (success or n_tries > 10):
     try:
+      if rate_limiter: rate_limiter.wait()
       img = img_from_url(url)
       success = True
     except urllib.error.URLError:
@@ -1,4 +1,5 @@
 import pathlib
+import itertools
 import numpy as np
 import tqdm
 import shapely.geometry
@@ -8,7 +9,10 @@ import passion.util
 def generate_osm(input_path: pathlib.Path,
                  output_path: pathlib.Path,
                  osm_request_interval: float = 5,
-                 num_retries: int = 5
+                 num_retries: int = 5,
+                 osm_cache_path: pathlib.Path = None,
+                 osm_chunk_size: float = 0.05,
+                 overpass_url: str = passion.util.osm.OVERPASS_URL
 ):
   '''Segments a full dataset generated by generate_dataset(),
   saving the open OSM footprints as segmented masks
@@ -19,16 +23,34 @@ def generate_osm(input_path: pathlib.Path,
   Segmented images are saved with the same name as the original
   images appending '_MASK' in the end.
 
+  If a cache path is given, the footprints of the whole dataset are requested
+  in chunks of osm_chunk_size degrees and stored there before segmenting, and
+  every image is rasterized from the cache with no further requests. Otherwise,
+  a request is sent per image.
+
   ---
   
   input_path            -- Path, folder in which image_retrieval dataset was generated.
   output_path           -- Path, folder in which masks and filtered images will be stored.
   osm_request_interval  -- float, seconds to wait per request retry.
   num_retries           -- int, number of times to retry a request after an error.
+  osm_cache_path        -- Path, SQLite file in which the footprints of the dataset are cached.
+  osm_chunk_size        -- float, size in degrees of the chunks requested to Overpass for the cache.
+  overpass_url          -- str, Overpass interpreter URL, or file:// path of a stand-in response.
   '''
   output_path.mkdir(parents=True, exist_ok=True)
 
-  paths = list(input_path.glob('*.tif'))
+  paths = sorted(input_path.glob('*.tif'))
+
+  if osm_cache_path is not None:
+    bboxes = []
+    for img_path in paths:
+      src = passion.util.io.read_geotiff(img_path)
+      img_center_latlon, zoom = get_image_center(src)
+      bboxes.append(passion.util.gis.get_image_bbox(img_center_latlon, zoom, (src.RasterYSize, src.RasterXSize)))
+    passion.util.osm.build_footprints_cache(bboxes, osm_cache_path, osm_chunk_size,
+                                            osm_request_interval, num_retries, overpass_url)
+
   pbar = tqdm.tqdm(paths)
   for img_path in pbar:
     src = passion.util.io.read_geotiff(img_path)
@@ -36,13 +58,10 @@ def generate_osm(input_path: pathlib.Path,
     # Change channels first to channels last
     image = np.moveaxis(image, 0, -1)
 
-    zoom = int(src.tags().get('zoom_level'))
-    img_center_x, img_center_y = src.xy(src.height // 2, src.width // 2)
-    img_center_lat, img_center_lon = passion.util.gis.xy_tolatlon(img_center_x, img_center_y, zoom)
+    (img_center_lat, img_center_lon), zoom = get_image_center(src)
 
-    latlon, zoom = passion.util.gis.extract_filename(img_path.stem)
-
-    seg_image = segment_img(image, (img_center_lat, img_center_lon), zoom, osm_request_interval, num_retries)
+    seg_image = segment_img(image, (img_center_lat, img_center_lon), zoom, osm_request_interval, num_retries,
+                            osm_cache_path, overpass_url)
 
     seg_image = postprocess_output(seg_image)
 
@@ -60,9 +79,22 @@ def generate_osm(input_path: pathlib.Path,
 
   return
 
-def segment_img(image: np.ndarray, latlon: tuple, zoom: int, osm_request_interval: float = 5, num_retries: int = 5):
+def get_image_center(src):
+  '''Returns the latitude and longitude of the center of a GeoTiff image, and its zoom level.'''
+  zoom = int(src.GetMetadata().get('zoom_level'))
+
+  west, xres, xskew, north, yskew, yres  = src.GetGeoTransform()
+  east = west + (src.RasterXSize * xres)
+  south = north + (src.RasterYSize * yres)
+  img_center_x = (west + east) // 2
+  img_center_y = (south + north) // 2
+
+  return passion.util.gis.xy_tolatlon(img_center_x, img_center_y, zoom), zoom
+
+def segment_img(image: np.ndarray, latlon: tuple, zoom: int, osm_request_interval: float = 5, num_retries: int = 5,
+                osm_cache_path: pathlib.Path = None, overpass_url: str = passion.util.osm.OVERPASS_URL):
   ''''Segments a single image in numpy format with
-  the open OSM footprints. 
+  the open OSM footprints, read from osm_cache_path if given.
   
   Returns a binary numpy image.'''
 
@@ -77,15 +109,21 @@ def segment_img(image: np.ndarray, latlon: tuple, zoom: int, osm_request_interva
 
   bbox = passion.util.gis.get_image_bbox(latlon, zoom, image.shape)
 
-  img_buildings = passion.util.osm.get_footprints_latlon(bbox, osm_request_interval, num_retries)
-
-  img_buildings_xy_abs = [ [ (passion.util.gis.latlon_toXY(coord[0], coord[1], zoom)) for coord in building ] for building in img_buildings ]
+  if osm_cache_path is not None:
+    img_buildings = passion.util.osm.get_cached_footprints_latlon(bbox, osm_cache_path)
+  else:
+    img_buildings = passion.util.osm.get_footprints_latlon(bbox, osm_request_interval, num_retries, overpass_url)
 
   offset_x, offset_y = passion.util.gis.get_image_offset(bbox, zoom)
 
-  img_buildings_xy = [ [ (coord[0]-offset_x, coord[1]-offset_y) for coord in building] for building in img_buildings_xy_abs]
-
-  img_buildings_polygons = [ shapely.geometry.Polygon(building) for building in img_buildings_xy]
+  # Convert the coordinates of all of the buildings at once
+  img_buildings_xy = []
+  if img_buildings:
+    lengths = [ len(building) for building in img_buildings ]
+    coords = np.fromiter(itertools.chain.from_iterable(itertools.chain.from_iterable(img_buildings)), dtype=float).reshape(-1, 2)
+    buildings_x, buildings_y = passion.util.gis.latlon_toXY_array(coords[:, 0], coords[:, 1], zoom)
+    buildings_xy = np.stack([buildings_x - offset_x, buildings_y - offset_y], axis=-1)
+    img_buildings_xy = np.split(buildings_xy, np.cumsum(lengths)[:-1])
 
   seg_image = passion.util.shapes.outlines_to_image(img_buildings_xy, len(img_buildings_xy)*[1], image.shape[:2])
 
@@ -1,9 +1,15 @@
 import pathlib
+import queue
+import threading
+import time
+import concurrent.futures
+import contextlib
 import numpy as np
 import cv2
 import PIL
 from enum import Enum
 import tqdm
+import os
 import shapely.geometry
 import PIL
 
@@ -14,6 +20,10 @@ from typing import List
 
 import passion.util
 
+class MERGE_MODE(Enum):
+  '''Policies to merge the predictions of overlapping tiles.'''
+  PROBABILITIES, VOTES = range(2)
+
 def segment_dataset(input_path: pathlib.Path,
                     model: torch.nn.Module,
                     output_path: pathlib.Path,
@@ -23,7 +33,16 @@ def segment_dataset(input_path: pathlib.Path,
                     save_masks: bool = True,
                     save_filtered: bool = True,
                     opening_closing_kernel: int = 9,
-                    erosion_kernel: int = 9
+                    erosion_kernel: int = 9,
+                    batch_size: int = 8,
+                    images_per_batch: int = 1,
+                    pipelined: bool = False,
+                    num_readers: int = 2,
+                    num_workers: int = 2,
+                    queue_size: int = 8,
+                    merge_mode: MERGE_MODE = MERGE_MODE.PROBABILITIES,
+                    blending: str = 'gaussian',
+                    num_threads: int = None
 ):
   '''Segments a full dataset generated by generate_dataset(),
   saving the rooftop segmented masks in the specified folder.
@@ -35,6 +54,12 @@ def segment_dataset(input_path: pathlib.Path,
 
   Tile size must match model's input size.
 
+  The tiles of images_per_batch images are stacked together
+  and predicted in batches of batch_size tiles.
+
+  If pipelined is true, reading, inference and post processing
+  run concurrently (see segment_dataset_pipelined()).
+
   ---
   
   input_path              -- Path, path of the input images.
@@ -47,68 +72,549 @@ def segment_dataset(input_path: pathlib.Path,
   save_filtered           -- bool, if true, saves the filtered images into disk.
   opening_closing_kernel  -- int, size of the kernel for opening and closing in post processing.
   erosion_kernel          -- int, size of the kernel for erosion in post processing.
+  batch_size              -- int, number of tiles predicted in a single forward pass.
+  images_per_batch        -- int, number of images whose tiles are predicted together.
+  pipelined               -- bool, if true, runs reading, inference and post processing concurrently.
+  num_readers             -- int, number of threads reading images in pipelined mode.
+  num_workers             -- int, number of threads post processing and writing masks in pipelined mode.
+  queue_size              -- int, maximum number of images waiting between stages in pipelined mode.
+  merge_mode              -- MERGE_MODE, policy to merge overlapping tiles when stride < tile_size.
+  blending                -- str, window weighting overlapping tiles (gaussian, cosine or uniform).
+  num_threads             -- int, number of threads post processing the classes of the masks, shared by
+                             all images. All cores if not specified, or 1 in pipelined mode, whose
+                             num_workers already post process several masks at a time.
   '''
+  if pipelined:
+    return segment_dataset_pipelined(input_path, [ model ], [ output_path ], [ background_class ],
+                                     tile_size, stride, [ opening_closing_kernel ], [ erosion_kernel ],
+                                     batch_size, images_per_batch, num_readers, num_workers, queue_size,
+                                     merge_mode, blending, 1 if num_threads is None else num_threads)
+
   output_path.mkdir(parents=True, exist_ok=True)
+
+  model, device = prepare_model(model)
   
+  paths = list(input_path.glob('*.tif'))
+  pbar = tqdm.tqdm(total=len(paths))
+  with get_postprocess_executor(num_threads) as executor:
+    for i in range(0, len(paths), images_per_batch):
+      img_paths = paths[i:i+images_per_batch]
+      images, georefs = zip(*[ read_image(img_path) for img_path in img_paths ])
+
+      seg_images = segment_imgs(images, model, tile_size, stride, background_class, batch_size, device,
+                                merge_mode, blending)
+
+      for img_path, georef, seg_image in zip(img_paths, georefs, seg_images):
+        seg_image = postprocess_output(seg_image, opening_closing_kernel, erosion_kernel, background_class,
+                                       num_threads=num_threads, executor=executor)
+        write_mask(output_path, img_path, seg_image, georef)
+      pbar.update(len(img_paths))
+  pbar.close()
+
+  return
+
+def segment_dataset_multi(input_path: pathlib.Path,
+                          models: List[torch.nn.Module],
+                          output_paths: List[pathlib.Path],
+                          background_classes: List[int],
+                          tile_size: int = 512,
+                          stride: int = 512,
+                          opening_closing_kernels: List[int] = None,
+                          erosion_kernels: List[int] = None,
+                          batch_size: int = 8,
+                          pipelined: bool = False,
+                          num_readers: int = 2,
+                          num_workers: int = 2,
+                          queue_size: int = 8,
+                          merge_mode: MERGE_MODE = MERGE_MODE.PROBABILITIES,
+                          blending: str = 'gaussian',
+                          num_threads: int = None
+):
+  '''Segments a full dataset generated by generate_dataset()
+  with several models, reading and tiling each image only once.
+  The same tiles are predicted by every model and each resulting
+  mask is saved in the output path of its model, with the same
+  name as the original image appending '_MASK' in the end.
+
+  All models must share the same input size (tile_size).
+
+  If pipelined is true, reading, inference and post processing
+  run concurrently (see segment_dataset_pipelined()).
+
+  ---
+  
+  input_path              -- Path, path of the input images.
+  models                  -- list of torch.nn.Module, segmentation models.
+  output_paths            -- list of Path, output path of the segmented data of each model.
+  background_classes      -- list of int, background class of each model.
+  tile_size               -- int, input size of the models.
+  stride                  -- int, image separation for each new prediction.
+  opening_closing_kernels -- list of int, size of the kernel for opening and closing of each model.
+  erosion_kernels         -- list of int, size of the kernel for erosion of each model.
+  batch_size              -- int, number of tiles predicted in a single forward pass.
+  pipelined               -- bool, if true, runs reading, inference and post processing concurrently.
+  num_readers             -- int, number of threads reading images in pipelined mode.
+  num_workers             -- int, number of threads post processing and writing masks in pipelined mode.
+  queue_size              -- int, maximum number of images waiting between stages in pipelined mode.
+  merge_mode              -- MERGE_MODE, policy to merge overlapping tiles when stride < tile_size.
+  blending                -- str, window weighting overlapping tiles (gaussian, cosine or uniform).
+  num_threads             -- int, number of threads post processing the classes of the masks, shared by
+                             all images. All cores if not specified, or 1 in pipelined mode, whose
+                             num_workers already post process several masks at a time.
+  '''
+  if opening_closing_kernels is None: opening_closing_kernels = [ 9 ] * len(models)
+  if erosion_kernels is None: erosion_kernels = [ 9 ] * len(models)
+
+  if pipelined:
+    return segment_dataset_pipelined(input_path, models, output_paths, background_classes,
+                                     tile_size, stride, opening_closing_kernels, erosion_kernels,
+                                     batch_size, 1, num_readers, num_workers, queue_size,
+                                     merge_mode, blending, 1 if num_threads is None else num_threads)
+
+  models, devices = zip(*[ prepare_model(model) for model in models ])
+  for output_path in output_paths:
+    output_path.mkdir(parents=True, exist_ok=True)
+
   paths = list(input_path.glob('*.tif'))
   pbar = tqdm.tqdm(paths)
-  for img_path in pbar:
-    src = passion.util.io.read_geotiff(img_path)
-    image = src.ReadAsArray()
-    # Change channels first to channels last
-    image = np.moveaxis(image, 0, -1)
+  with get_postprocess_executor(num_threads) as executor:
+    for img_path in pbar:
+      image, georef = read_image(img_path)
+
+      tiles = get_tile_views(image, tile_size, stride)
+
+      for model, device, output_path, background_class, opening_closing_kernel, erosion_kernel in zip(
+          models, devices, output_paths, background_classes, opening_closing_kernels, erosion_kernels):
+        seg_image, = segment_img_tiles(tiles, [ image.shape[:2] ], model, tile_size, stride, background_class,
+                                       batch_size, device, merge_mode, blending)
+        seg_image = postprocess_output(seg_image, opening_closing_kernel, erosion_kernel, background_class,
+                                       num_threads=num_threads, executor=executor)
+        write_mask(output_path, img_path, seg_image, georef)
+
+  return
+
+def segment_dataset_pipelined(input_path: pathlib.Path,
+                              models: List[torch.nn.Module],
+                              output_paths: List[pathlib.Path],
+                              background_classes: List[int],
+                              tile_size: int = 512,
+                              stride: int = 512,
+                              opening_closing_kernels: List[int] = None,
+                              erosion_kernels: List[int] = None,
+                              batch_size: int = 8,
+                              images_per_batch: int = 1,
+                              num_readers: int = 2,
+                              num_workers: int = 2,
+                              queue_size: int = 8,
+                              merge_mode: MERGE_MODE = MERGE_MODE.PROBABILITIES,
+                              blending: str = 'gaussian',
+                              num_threads: int = 1
+):
+  '''Segments a full dataset generated by generate_dataset() with
+  one or more models, overlapping the stages of the segmentation:
+
+  - num_readers background threads read, preprocess and tile the images.
+  - The calling thread runs the batched inference of every model.
+  - A pool of num_workers threads runs postprocess_output() and writes the masks.
+    If num_threads is greater than 1, the classes of the masks are post processed
+    in a single pool of num_threads threads shared by the workers.
 
-    image = preprocess_input(image)
+  Stages are connected by bounded queues of queue_size images, so that
+  memory usage does not depend on the size of the dataset. Throughput
+  and the time spent in each stage are printed at the end.
 
-    seg_image = segment_img(image, model, tile_size, stride, background_class)
+  Outputs are the same as with segment_dataset() or segment_dataset_multi().
+  '''
+  if opening_closing_kernels is None: opening_closing_kernels = [ 9 ] * len(models)
+  if erosion_kernels is None: erosion_kernels = [ 9 ] * len(models)
 
-    seg_image = postprocess_output(seg_image, opening_closing_kernel, erosion_kernel, background_class)
-    
-    seg_image = seg_image[np.newaxis, ...]
-    channels, height, width = seg_image.shape
+  models, devices = zip(*[ prepare_model(model) for model in models ])
+  for output_path in output_paths:
+    output_path.mkdir(parents=True, exist_ok=True)
 
-    # Change channels first to channels last
-    seg_image = np.moveaxis(seg_image, 0, -1)
-    passion.util.io.write_geotiff(str(output_path / (img_path.stem + '_MASK.tif')),
-                                  seg_image,
-                                  src.GetGeoTransform(),
-                                  src.GetProjection(),
-                                  src.GetMetadata())
+  paths = list(input_path.glob('*.tif'))
+  num_readers = max(1, min(num_readers, len(paths)))
+
+  timings = { 'read': 0.0, 'inference': 0.0, 'postprocess': 0.0, 'write': 0.0 }
+  timings_lock = threading.Lock()
+  def add_timing(stage, start):
+    with timings_lock:
+      timings[stage] += time.perf_counter() - start
+
+  read_queue = queue.Queue(maxsize=queue_size)
+  read_errors = []
+  def read_images(img_paths):
+    try:
+      for img_path in img_paths:
+        start = time.perf_counter()
+        image, georef = read_image(img_path)
+        tiles = get_tile_views(image, tile_size, stride)
+        add_timing('read', start)
+        read_queue.put((img_path, image.shape[:2], tiles, georef))
+    except Exception as e:
+      read_errors.append(e)
+    finally:
+      read_queue.put(None)
+
+  def postprocess_and_write(output_path, img_path, seg_image, georef,
+                            opening_closing_kernel, erosion_kernel, background_class):
+    start = time.perf_counter()
+    seg_image = postprocess_output(seg_image, opening_closing_kernel, erosion_kernel, background_class,
+                                   num_threads=num_threads, executor=class_executor)
+    add_timing('postprocess', start)
+    start = time.perf_counter()
+    write_mask(output_path, img_path, seg_image, georef)
+    add_timing('write', start)
+
+  start_time = time.perf_counter()
+  readers = [ threading.Thread(target=read_images, args=(paths[i::num_readers],), daemon=True)
+              for i in range(num_readers) ]
+  for reader in readers:
+    reader.start()
+
+  pbar = tqdm.tqdm(total=len(paths))
+  pending = set()
+  finished_readers = 0
+  with get_postprocess_executor(num_threads) as class_executor, \
+       concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+    while finished_readers < len(readers):
+      batch = []
+      while len(batch) < images_per_batch and finished_readers < len(readers):
+        item = read_queue.get()
+        if item is None:
+          finished_readers += 1
+        else:
+          batch.append(item)
+      if not batch:
+        continue
+
+      start = time.perf_counter()
+      img_paths, img_shapes, all_tiles, georefs = zip(*batch)
+      results = []
+      for model, device, background_class in zip(models, devices, background_classes):
+        results.extend(segment_img_tiles(list(all_tiles), img_shapes, model, tile_size, stride, background_class,
+                                         batch_size, device, merge_mode, blending))
+      add_timing('inference', start)
+
+      # Bound the number of masks waiting to be post processed
+      while len(pending) >= queue_size:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done: future.result()
+
+      seg_images = iter(results)
+      for output_path, opening_closing_kernel, erosion_kernel, background_class in zip(
+          output_paths, opening_closing_kernels, erosion_kernels, background_classes):
+        for img_path, georef in zip(img_paths, georefs):
+          pending.add(executor.submit(postprocess_and_write, output_path, img_path, next(seg_images), georef,
+                                      opening_closing_kernel, erosion_kernel, background_class))
+      pbar.update(len(batch))
+
+    for future in concurrent.futures.as_completed(pending):
+      future.result()
+  pbar.close()
+
+  if read_errors:
+    raise read_errors[0]
+
+  elapsed = time.perf_counter() - start_time
+  print('Segmented {0} images in {1:.2f} s ({2:.2f} images/s)'.format(len(paths), elapsed,
+                                                                       len(paths) / elapsed if elapsed > 0 else 0))
+  for stage, stage_time in timings.items():
+    print('  {0:<12}{1:>10.2f} s{2:>10.1f} ms/image'.format(stage, stage_time,
+                                                           1000 * stage_time / max(1, len(paths))))
 
   return
 
+def read_image(img_path: pathlib.Path):
+  '''Reads and preprocesses a GeoTIFF image in channels last format.
+  Returns the image and its georeference as a tuple of
+  (transform, projection, metadata).
+  '''
+  src = passion.util.io.read_geotiff(img_path)
+  # Change channels first to channels last
+  image = preprocess_input(np.moveaxis(src.ReadAsArray(), 0, -1))
+
+  return image, (src.GetGeoTransform(), src.GetProjection(), src.GetMetadata())
+
+def write_mask(output_path: pathlib.Path,
+               img_path: pathlib.Path,
+               seg_image: np.ndarray,
+               georef: tuple
+):
+  '''Writes a segmented mask as a GeoTIFF named after the original
+  image appending '_MASK', with the georeference (transform,
+  projection, metadata) returned by read_image().
+  '''
+  transform, projection, metadata = georef
+  # Add channels last
+  seg_image = seg_image[..., np.newaxis]
+  passion.util.io.write_geotiff(str(output_path / (img_path.stem + '_MASK.tif')),
+                                seg_image,
+                                transform,
+                                projection,
+                                metadata)
+
+def prepare_model(model: torch.nn.Module, device: str = None):
+  '''Moves the model to the device and sets it to evaluation mode.
+  If no device is specified, cuda is used when available.
+  Returns the model and the device.
+  '''
+  if device is None:
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+  model = model.to(device)
+  model.eval()
+
+  return model, device
+
 def segment_img(image: np.ndarray,
                 model: torch.nn.Module,
                 tile_size: int,
                 stride: int,
-                background_class: int
+                background_class: int,
+                batch_size: int = 8,
+                device: str = None,
+                merge_mode: MERGE_MODE = MERGE_MODE.PROBABILITIES,
+                blending: str = 'gaussian'
 ):
   '''Segments a single image in numpy format with a
   given model. Tile size has to be specified and must
   match model's input size.
   '''
-  if type(image) != np.ndarray:
-    print('Image type: {0} not a np.array'.format(type(image)))
+  seg_images = segment_imgs([image], model, tile_size, stride, background_class, batch_size, device,
+                            merge_mode, blending)
+  if seg_images is None:
     return None
-  if len(image.shape) != 3 or image.shape[-1] != 3:
-    print('Image shape: {0} not in format MxNx3'.format(image.shape))
+
+  return seg_images[0]
+
+def segment_imgs(images: List[np.ndarray],
+                 model: torch.nn.Module,
+                 tile_size: int,
+                 stride: int,
+                 background_class: int,
+                 batch_size: int = 8,
+                 device: str = None,
+                 merge_mode: MERGE_MODE = MERGE_MODE.PROBABILITIES,
+                 blending: str = 'gaussian'
+):
+  '''Segments a list of images in numpy format with a
+  given model, predicting the tiles of all of them in
+  batches of batch_size. Tile size has to be specified
+  and must match model's input size.
+
+  If the stride is smaller than the tile size, overlapping
+  predictions are merged as described in segment_img_tiles().
+
+  The model is expected to be in evaluation mode and in
+  the given device (see prepare_model()).
+  '''
+  all_tiles = []
+  for image in images:
+    if type(image) != np.ndarray:
+      print('Image type: {0} not a np.array'.format(type(image)))
+      return None
+    if len(image.shape) != 3 or image.shape[-1] != 3:
+      print('Image shape: {0} not in format MxNx3'.format(image.shape))
+      return None
+    all_tiles.append(get_tile_views(image, tile_size, stride))
+
+  return segment_img_tiles(all_tiles, [ image.shape[:2] for image in images ],
+                           model, tile_size, stride, background_class, batch_size, device,
+                           merge_mode, blending)
+
+def segment_img_tiles(tiles: List[np.ndarray],
+                      img_shapes: List[tuple],
+                      model: torch.nn.Module,
+                      tile_size: int,
+                      stride: int,
+                      background_class: int,
+                      batch_size: int = 8,
+                      device: str = None,
+                      merge_mode: MERGE_MODE = MERGE_MODE.PROBABILITIES,
+                      blending: str = 'gaussian'
+):
+  '''Segments the tiles of one or more images, as a list with the
+  tiles of each image generated by get_tile_views() or divide_img_tiles()
+  in the order of img_shapes, and composes them back into one
+  segmented image per shape.
+
+  If the stride is smaller than the tile size, pixels are predicted
+  by several tiles, which are weighted with a blending window (see
+  get_blending_window()) and merged with one of the policies:
+
+  - MERGE_MODE.PROBABILITIES: the class probabilities of the tiles
+  are accumulated and the most probable class is taken.
+  - MERGE_MODE.VOTES: the predicted classes of the tiles are
+  accumulated as votes and the most voted class is taken.
+  '''
+  if stride < tile_size and merge_mode == MERGE_MODE.PROBABILITIES:
+    return blend_tiles(tiles, img_shapes, model, tile_size, stride, background_class,
+                       batch_size, device, blending)
+
+  seg_tiles = segment_tiles(tiles, model, background_class, batch_size, device)
+  if type(seg_tiles) != np.ndarray:
+    print('Error processing tiles, returning...')
     return None
 
-  tiles = divide_img_tiles(image, tile_size, stride)
+  window = get_blending_window(tile_size, blending) if stride < tile_size else None
+  seg_images = []
+  splits = np.cumsum([ len(get_tile_positions(img_shape, stride)) for img_shape in img_shapes ])[:-1]
+  for img_shape, img_seg_tiles in zip(img_shapes, np.split(seg_tiles, splits)):
+    seg_images.append(compose_tiles(img_seg_tiles, img_shape, stride, window))
+
+  return seg_images
+
+def blend_tiles(tiles: List[np.ndarray],
+                img_shapes: List[tuple],
+                model: torch.nn.Module,
+                tile_size: int,
+                stride: int,
+                background_class: int,
+                batch_size: int = 8,
+                device: str = None,
+                blending: str = 'gaussian'
+):
+  '''Segments overlapping tiles of one or more images, accumulating
+  the class probabilities of every tile weighted by a blending window
+  into an array of shape (classes, height, width) per image, and
+  taking the most probable class of each pixel.
+
+  Only the accumulators of the images with tiles in the current batch
+  are kept in memory, so memory usage is bounded by the image size.
+  '''
+  if device is None:
+    device = next(model.parameters()).device
+  window = torch.from_numpy(get_blending_window(tile_size, blending)).to(device)
+
+  positions = [ get_tile_positions(img_shape, stride) for img_shape in img_shapes ]
+  tile_images = [ (img_i, y, x) for img_i, img_positions in enumerate(positions) for y, x in img_positions ]
+  remaining = [ len(img_positions) for img_positions in positions ]
+
+  seg_images = [ None ] * len(img_shapes)
+  accumulators = {}
+  tile_i = 0
+  for probs in predict_tiles(tiles, model, batch_size, device, window):
+    for tile_probs in probs:
+      img_i, y, x = tile_images[tile_i]
+      tile_i += 1
+      img_size_y, img_size_x = img_shapes[img_i]
+      if img_i not in accumulators:
+        accumulators[img_i] = np.zeros((tile_probs.shape[0], img_size_y, img_size_x), dtype=np.float32)
+      h, w = min(tile_size, img_size_y - y), min(tile_size, img_size_x - x)
+      accumulators[img_i][:, y:y+h, x:x+w] += tile_probs[:, :h, :w]
+
+      remaining[img_i] -= 1
+      if remaining[img_i] == 0:
+        pred = np.argmax(accumulators.pop(img_i), axis=0)
+        seg_images[img_i] = remap_background(pred, background_class).astype(np.uint8)
+
+  return seg_images
+
+def segment_tiles(tiles: np.ndarray,
+                  model: torch.nn.Module,
+                  background_class: int,
+                  batch_size: int = 8,
+                  device: str = None
+):
+  '''Segments an array of tiles of model's input size with shape
+  (n_tiles, tile_size, tile_size, 3), running a single forward pass
+  per batch of batch_size tiles under inference mode.
+
+  Tiles can also be given as returned by get_tile_views(), or as a
+  list of tile arrays that are predicted one after the other.
+  Returns the predictions with shape (n_tiles, tile_size, tile_size).
 
-  seg_tiles = []
-  for tile in tiles:
-    prediction = segment_tile(tile, model, tile_size, background_class)
-    if type(prediction) != np.ndarray:
-      print('Error processing tile, returning...')
+  The model is expected to be in evaluation mode and in
+  the given device (see prepare_model()). If no device is
+  specified, the device of the model parameters is used.
+  '''
+  tiles_list = tiles if type(tiles) == list else [ tiles ]
+  for img_tiles in tiles_list:
+    if type(img_tiles) != np.ndarray:
+      print('Tiles type: {0} not a np.array'.format(type(img_tiles)))
+      return None
+    if len(img_tiles.shape) < 4 or img_tiles.shape[-1] != 3:
+      print('Tiles shape: {0} not in format KxMxNx3'.format(img_tiles.shape))
       return None
-    seg_tiles.append(prediction)
-  seg_tiles = np.array(seg_tiles)
+  preds = list(predict_tiles(tiles_list, model, batch_size, device))
+  if not preds:
+    return np.zeros((0,) + tiles_list[0].shape[-3:-1], dtype=np.int64)
 
-  seg_image = compose_tiles(seg_tiles, image.shape[:2], stride)
+  return remap_background(np.concatenate(preds), background_class)
 
-  return seg_image
-  
+def predict_tiles(tiles: List[np.ndarray],
+                  model: torch.nn.Module,
+                  batch_size: int = 8,
+                  device: str = None,
+                  window: torch.Tensor = None
+):
+  '''Generator predicting the tiles in batches of batch_size under
+  inference mode. For every batch, yields the predicted class of each
+  pixel with shape (batch, tile_size, tile_size) or, if a window is
+  given, the class probabilities multiplied by the window with shape
+  (batch, classes, tile_size, tile_size).
+
+  Tiles are given as a list of arrays of shape (..., tile_size, tile_size, 3),
+  such as the views returned by get_tile_views(), and are copied once
+  into a preallocated batch, pinned in memory when predicting on cuda.
+  '''
+  if device is None:
+    device = next(model.parameters()).device
+  if type(tiles) != list:
+    tiles = [ tiles ]
+  n_tiles = sum(int(np.prod(img_tiles.shape[:-3])) for img_tiles in tiles)
+  if n_tiles == 0:
+    return
+
+  tile_shape = tiles[0].shape[-3:]
+  dtype = torch.from_numpy(np.empty(0, dtype=tiles[0].dtype)).dtype
+  pin_memory = torch.device(device).type == 'cuda'
+  buffer = torch.empty((min(batch_size, n_tiles),) + tile_shape, dtype=dtype, pin_memory=pin_memory)
+  buffer_np = buffer.numpy()
+
+  def predict(n):
+    output = model(tiles_to_tensor(buffer[:n], device))
+    # Moving the output to the cpu waits for the batch, so the buffer can be reused
+    if window is None:
+      return torch.argmax(output, dim=1).cpu().numpy()
+    return (torch.softmax(output, dim=1) * window).cpu().numpy()
+
+  filled = 0
+  with torch.inference_mode():
+    for img_tiles in tiles:
+      for idx in np.ndindex(img_tiles.shape[:-3]):
+        buffer_np[filled] = img_tiles[idx]
+        filled += 1
+        if filled == len(buffer_np):
+          yield predict(filled)
+          filled = 0
+    if filled > 0:
+      yield predict(filled)
+
+def remap_background(pred: np.ndarray, background_class: int):
+  '''If background is not 0, transforms it to 0 and adds 1 to the rest of classes.'''
+  rooftop_pred = pred.copy()
+  if background_class != 0:
+    rooftop_pred[pred==background_class] = 0
+    rooftop_pred[pred!=background_class] = (rooftop_pred[pred!=background_class] + 1)
+
+  return rooftop_pred
+
+def tiles_to_tensor(tiles, device):
+  '''Converts a batch of BGR tiles with shape (n_tiles, height, width, 3),
+  as a numpy array or a tensor, into an RGB tensor of shape
+  (n_tiles, 3, height, width) in the given device, scaling uint8
+  values into [0, 1] as torchvision's ToTensor.
+  '''
+  if type(tiles) == np.ndarray:
+    tiles = torch.from_numpy(np.ascontiguousarray(tiles))
+  batch = tiles.to(device, non_blocking=True)
+  # BGR to RGB and channels last to channels first
+  batch = batch.flip(-1).permute(0, 3, 1, 2)
+  if batch.dtype == torch.uint8:
+    return batch.float().div(255)
+
+  return batch.float()
 
 def segment_tile(tile: np.ndarray,
                  model: torch.nn.Module,
@@ -123,65 +629,82 @@ def segment_tile(tile: np.ndarray,
   if tile.shape != (tile_size,tile_size,3):
     print('Image shape: {0} not in format {1}x{1}x3'.format(tile.shape, tile_size))
     return None
-  
-  trans = torchvision.transforms.Compose([torchvision.transforms.ToTensor(), ])
-  tile = cv2.cvtColor(tile, cv2.COLOR_BGR2RGB)
-  tile = trans(tile).reshape(1, 3, tile_size, tile_size)
-  DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-  tile = tile.to(DEVICE)
-  pred = model(tile)
-  pred = torch.argmax(pred, dim=1)
-  pred = pred.cpu().data.numpy().squeeze()
-  tile = tile.cpu().data.numpy().squeeze()
-  tile = np.moveaxis(tile, 0, -1)
-
-  # If background is not 0, transform it to 0 and add 1 to the rest of classes
-  rooftop_pred = pred.copy()
-  if background_class != 0:
-    rooftop_pred[pred==background_class] = 0
-    rooftop_pred[pred!=background_class] = (rooftop_pred[pred!=background_class] + 1)
 
-  return rooftop_pred
+  return segment_tiles(tile[np.newaxis, ...], model, background_class, batch_size=1)[0]
 
 def divide_img_tiles(image: np.ndarray, tile_size: int, stride: int):
-  '''Divides an image into a list of tiles of specified size.'''
+  '''Divides an image into an array of tiles of specified size,
+  with shape (n_tiles, tile_size, tile_size, channels).
+  '''
+  tiles = get_tile_views(image, tile_size, stride)
+
+  return tiles.reshape((-1,) + tiles.shape[2:])
+
+def get_tile_views(image: np.ndarray, tile_size: int, stride: int):
+  '''Divides an image into tiles of specified size without copying them.
+  The image is padded with zeros once, and the tiles are returned as
+  read-only views of the padded image with shape
+  (tiles_y, tiles_x, tile_size, tile_size, channels).
+  '''
   img_size_y, img_size_x, img_channels = image.shape
+  tiles_y, tiles_x = -(-img_size_y // stride), -(-img_size_x // stride)
+  padded_y, padded_x = (tiles_y - 1) * stride + tile_size, (tiles_x - 1) * stride + tile_size
 
-  tiles = []
-  for h in range(0,img_size_y,stride):
-    for w in range(0,img_size_x,stride):
-      i = image[h:h+tile_size,w:w+tile_size]
-      i = np.pad(i, ((0, tile_size - i.shape[0]), (0, tile_size - i.shape[1]), (0, 0)),
-              mode='constant', constant_values=0)
-      tiles.append(i)
-  
-  return np.array(tiles)
+  padded = image[:padded_y, :padded_x]
+  padded = np.pad(padded, ((0, padded_y - padded.shape[0]), (0, padded_x - padded.shape[1]), (0, 0)),
+                  mode='constant', constant_values=0)
+  tiles = np.lib.stride_tricks.sliding_window_view(padded, (tile_size, tile_size), axis=(0, 1))
 
-'''
-class MERGE_MODE(Enum):
-  \'''Custom enum to register the different merging policies.\'''
-  OR, AND, VOTE = range(3)
-'''
+  return np.moveaxis(tiles[::stride, ::stride], 2, -1)
+
+def get_tile_positions(img_shape: tuple, stride: int):
+  '''Returns the (y, x) position of the upper left corner of each
+  tile of an image, in the order generated by divide_img_tiles().
+  '''
+  img_size_y, img_size_x = img_shape[:2]
 
-def compose_tiles(tiles: list,
+  return [ (h, w) for h in range(0, img_size_y, stride) for w in range(0, img_size_x, stride) ]
+
+def get_blending_window(tile_size: int, blending: str = 'gaussian'):
+  '''Returns a (tile_size, tile_size) array weighting the predictions
+  of a tile when merging overlapping tiles, from the following:
+
+  - gaussian: gaussian centered in the tile with a standard
+  deviation of 1/8 of the tile size.
+  - cosine:   squared sine (Hann) window, sampled at pixel centers
+  so that no weight is zero.
+  - uniform:  the same weight for every pixel.
+
+  Weights of the pixels close to the center of the tile, where the
+  model has more context, are higher than the ones in the borders.
+  '''
+  coords = np.arange(tile_size, dtype=np.float32) + 0.5
+  if blending == 'gaussian':
+    sigma = tile_size / 8
+    window_1d = np.exp(-0.5 * ((coords - tile_size / 2) / sigma) ** 2)
+  elif blending == 'cosine':
+    window_1d = np.sin(np.pi * coords / tile_size) ** 2
+  elif blending == 'uniform':
+    window_1d = np.ones(tile_size, dtype=np.float32)
+  else:
+    raise ValueError('Blending window {0} not in (gaussian, cosine, uniform)'.format(blending))
+
+  window = np.outer(window_1d, window_1d).astype(np.float32)
+
+  return window / window.max()
+
+def compose_tiles(tiles: np.ndarray,
                   img_shape: tuple,
-                  stride: int
-                  #merge_mode: MERGE_MODE=MERGE_MODE.AND
+                  stride: int,
+                  window: np.ndarray = None
 ):
-  '''Composes back a list of tiles into a single image.
+  '''Composes back an array of segmented tiles into a single image.
 
-  If a stride smaller than the tile size is specified,
-  a merging policy can be specified from the following:
-  
-  - MERGE_MODE.AND:   For multiple predictions in a single
-  pixel, its value will only be 255 if all of the predictions
-  for that pixel are 255.
-  - MERGE_MODE.OR:    For multiple predictions in a single
-  pixel, its value will only be 255 if any of the predictions
-  for that pixel are 255.
-  - MERGE_MODE.VOTE:  For multiple predictions in a single
-  pixel, its value will only be 255 if the majority of the
-  predictions for that pixel are 255.
+  If a stride smaller than the tile size is specified, each pixel
+  is predicted by several tiles. If a blending window is given (see
+  get_blending_window()), the predicted class of every tile adds
+  its window weight as a vote and the most voted class is taken.
+  Otherwise, the last tile predicting a pixel is kept.
   '''
   if type(tiles) != np.ndarray:
     print('Error: input tiles type {0} not np.ndarray'.format(type(tiles)))
@@ -189,65 +712,30 @@ def compose_tiles(tiles: list,
   if len(img_shape) != 2:
     print('Image shape {0} not two dimensional'.format(img_shape))
     return None
-  
-  num_images = len(tiles)
+
   tile_size_y, tile_size_x = tiles[0].shape
   img_size_y, img_size_x = img_shape
+  positions = get_tile_positions(img_shape, stride)
 
-  final_pred = PIL.Image.new('L', (img_size_x, img_size_y), color=1)
-  
-  '''
-  if merge_mode == MERGE_MODE.AND:
-    sliding_window_mask = np.array(PIL.Image.new('L', (img_size_x, img_size_y), color=1))
-  else:
-    sliding_window_mask = np.array(PIL.Image.new('L', (img_size_x, img_size_y), color=0))
-  '''
-  current_x = 0
-  current_y = 0
+  if window is None:
+    final_pred = np.ones((img_size_y, img_size_x), dtype=np.uint8)
+    for (y, x), tile in zip(positions, tiles):
+      h, w = min(tile_size_y, img_size_y - y), min(tile_size_x, img_size_x - x)
+      final_pred[y:y+h, x:x+w] = tile[:h, :w]
+    return final_pred
 
-  for i, tile in enumerate(tiles):
-    p = PIL.Image.fromarray(np.uint8(tile))
-    '''
-    if tile_size_x != stride:
-      former = sliding_window_mask[current_y:current_y+tile_size_y,current_x:current_x+tile_size_x]
-      new = np.asarray(p)
+  num_classes = int(tiles.max()) + 1
+  votes = np.zeros(num_classes * img_size_y * img_size_x, dtype=np.float32)
+  rows, cols = np.indices((tile_size_y, tile_size_x))
+  for (y, x), tile in zip(positions, tiles):
+    h, w = min(tile_size_y, img_size_y - y), min(tile_size_x, img_size_x - x)
+    # Every pixel of a tile votes for a single class, so indices are unique
+    idx = (tile[:h, :w].astype(np.int64) * img_size_y + (y + rows[:h, :w])) * img_size_x + (x + cols[:h, :w])
+    votes[idx] += window[:h, :w]
 
-      new = np.pad(new, ((0, tile_size_x - new.shape[0]), (0, tile_size_y - new.shape[1])),
-                  mode='constant', constant_values=0)
-      
-      if merge_mode == MERGE_MODE.OR:
-        former = np.pad(former, ((0, tile_size_x - former.shape[0]), (0, tile_size_y - former.shape[1])),
-                mode='constant', constant_values=0)
-        merge = np.logical_or(former, new).astype(np.uint8)
-      if merge_mode == MERGE_MODE.AND:
-        former = np.pad(former, ((0, tile_size_x - former.shape[0]), (0, tile_size_y - former.shape[1])),
-                mode='constant', constant_values=1)
-        merge = np.logical_and(former, new).astype(np.uint8)
-      if merge_mode == MERGE_MODE.VOTE:
-        former = np.pad(former, ((0, tile_size_x - former.shape[0]), (0, tile_size_y - former.shape[1])),
-                mode='constant', constant_values=0)
-        merge = former + new
-
-      p = PIL.Image.fromarray(merge)
-
-      target_shape = sliding_window_mask[current_y:current_y+tile_size_y,current_x:current_x+tile_size_x].shape
-      sliding_window_mask[current_y:current_y+tile_size_y,current_x:current_x+tile_size_x] = merge[0:target_shape[0], 0:target_shape[1]]
-    '''
-    final_pred.paste(p, box=(current_x,current_y,current_x+tile_size_x,current_y+tile_size_y))
-    
-    
-    current_x += stride
-        
-    if current_x >= img_size_x:
-      current_x = 0
-      current_y += stride
-
-  final_pred_arr = np.asarray(final_pred)
-
-  #threshold = np.amax(final_pred_arr) // 2
-  #final_pred_arr = (final_pred_arr > threshold).astype(np.uint8) * 255
-  
-  return final_pred_arr
+  votes = votes.reshape(num_classes, img_size_y, img_size_x)
+
+  return np.argmax(votes, axis=0).astype(np.uint8)
 
 def preprocess_input(image: np.ndarray):
   '''Preprocessing made to the numpy image before performing segmentation.
@@ -256,22 +744,57 @@ def preprocess_input(image: np.ndarray):
   '''
   return image
 
-def postprocess_output(image: np.ndarray, opening_closing_kernel: int = 9, erosion_kernel: int = 9, background_class: int = 0):
+@contextlib.contextmanager
+def get_postprocess_executor(num_threads: int = None):
+  '''Returns a context with the thread pool shared by the calls to postprocess_output()
+  of a whole dataset, with num_threads threads (all cores if not specified), or None if
+  num_threads is 1.
+  '''
+  if num_threads is None:
+    num_threads = os.cpu_count() or 1
+  if num_threads == 1:
+    yield None
+    return
+  with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+    yield executor
+
+def postprocess_output(image: np.ndarray,
+                       opening_closing_kernel: int = 9,
+                       erosion_kernel: int = 9,
+                       background_class: int = 0,
+                       num_threads: int = None,
+                       executor: concurrent.futures.Executor = None
+):
   '''Postprocessing made to the numpy image after performing segmentation.
   Can be redefined with a custom function as:
   prediction.postprocess_output = custom_postprocess_function
+
+  Every class is opened, closed and eroded separately, with later
+  classes overwriting earlier ones. Each class is only processed in
+  its bounding box, enlarged by a margin that the morphological
+  operations cannot cross, and classes are processed in parallel
+  in the given executor, or else by num_threads threads (all cores
+  if not specified).
   '''
   out_image = np.full(image.shape, background_class)
 
+  seg_classes = np.unique(image)
+  seg_classes = seg_classes[seg_classes != background_class]
+  if len(seg_classes) == 0:
+    return out_image
+
+  # Openings, closings and erosions can only spread a class by their kernel sizes
+  margin = 4 * opening_closing_kernel + erosion_kernel
   opening_closing_kernel = np.ones((opening_closing_kernel, opening_closing_kernel), np.uint8)
   erosion_kernel = np.ones((erosion_kernel, erosion_kernel), np.uint8)
 
-  poly_list = []
-  class_list = []
-  seg_classes = np.unique(image)[np.unique(image) != background_class]
-  for seg_class in seg_classes:
-    #image_class = image.copy()
+  img_size_y, img_size_x = image.shape
+  def postprocess_class(seg_class):
     image_class = (image == seg_class).astype(np.uint8)
+    x, y, w, h = cv2.boundingRect(image_class)
+    crop = (slice(max(0, y - margin), min(img_size_y, y + h + margin)),
+            slice(max(0, x - margin), min(img_size_x, x + w + margin)))
+    image_class = image_class[crop]
 
     # opening + closing
     image_class = cv2.morphologyEx(image_class, cv2.MORPH_OPEN, opening_closing_kernel)
@@ -279,7 +802,20 @@ def postprocess_output(image: np.ndarray, opening_closing_kernel: int = 9, erosi
     # erosion
     image_class = cv2.erode(image_class, erosion_kernel)
 
-    # From binary to class
-    out_image[image_class == 1] = seg_class
+    return crop, image_class
+
+  if num_threads is None:
+    num_threads = os.cpu_count() or 1
+  if len(seg_classes) == 1 or (executor is None and num_threads == 1):
+    results = map(postprocess_class, seg_classes)
+  elif executor is not None:
+    results = list(executor.map(postprocess_class, seg_classes))
+  else:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+      results = list(executor.map(postprocess_class, seg_classes))
+
+  # From binary to class, in the same order as the classes
+  for seg_class, (crop, image_class) in zip(seg_classes, results):
+    out_image[crop][image_class == 1] = seg_class
 
-  return out_image
\ No newline at end of file
+  return out_image
@@ -1,8 +1,10 @@
 import pathlib
+import hashlib
+import numpy as np
 import pandas as pd
 import reskit as rk
+import shapely
 import shapely.geometry
-import shapely.wkt
 import xarray
 
 import passion.util
@@ -13,7 +15,12 @@ def generate_technical(input_path: pathlib.Path,
                        merra_path: pathlib.Path,
                        solar_atlas_path: pathlib.Path,
                        minimum_section_area: float,
-                       pv_panel_properties: dict
+                       pv_panel_properties: dict,
+                       n_workers: int = 1,
+                       chunk_size: int = 256,
+                       simulation_chunk_size: int = None,
+                       save_hourly: bool = False,
+                       simulation_cache: dict = None
 ):
   '''Generates a NetCDF file containing the technical potential of the input sections.
   
@@ -31,8 +38,17 @@ def generate_technical(input_path: pathlib.Path,
   solar_atlas_path      -- Path, folder in which the Solar Atlas dataset is stored.
   minimum_section_area  -- float, threshold area to filter sections in square meters.
   pv_panel_properties   -- Path, dictionary containing the properties for the panel simulation.
+  n_workers             -- int, number of processes laying out and reprojecting panels in parallel.
+  chunk_size            -- int, number of sections sent to a process at a time.
+  simulation_chunk_size -- int, number of placements simulated at a time. If set, only the yearly
+                           aggregates are kept in the output. If None, all placements are simulated at once.
+  save_hourly           -- bool, if True and simulating in chunks, the hourly series of every chunk are
+                           written to a folder next to the output.
+  simulation_cache      -- dict, if given, placements are simulated through a cache of 1 kW profiles,
+                           with its 'path', 'weather_cell_size', 'tilt_bin' and 'elev_bin' (see simulate_placements_cached).
   '''
   output_path.mkdir(parents=True, exist_ok=True)
+  output_stem = output_filename[:-len('.nc')] if output_filename.endswith('.nc') else output_filename
 
   pv_model_id = pv_panel_properties.get('id')
   pv_model_name = pv_panel_properties.get('name')
@@ -53,8 +69,10 @@ def generate_technical(input_path: pathlib.Path,
   with xarray.open_dataset(str(input_path)) as sections_ds:
     print(f'Loaded dataset {str(input_path)}')
     section_id = sections_ds.section_id.to_dataframe()
-    section_wkt_latlon = sections_ds.section_wkt_latlon.to_dataframe()
-    section_wkt_xy = sections_ds.section_wkt_xy.to_dataframe()
+    section_poly_latlon = pd.Series(passion.util.io.decode_geometries(sections_ds, 'section_wkb_latlon'),
+                                    index=section_id.index, name='section_poly_latlon')
+    section_poly_xy = pd.Series(passion.util.io.decode_geometries(sections_ds, 'section_wkb_xy'),
+                                index=section_id.index, name='section_poly_xy')
     section_azimuth = sections_ds.section_azimuth.to_dataframe()
     section_tilt = sections_ds.section_tilt.to_dataframe()
     section_flat = sections_ds.section_flat.to_dataframe()
@@ -64,17 +82,17 @@ def generate_technical(input_path: pathlib.Path,
     original_image_shape = sections_ds.original_image_width.item(), sections_ds.original_image_height.item()
     zoom_level = sections_ds.zoom_level.item()
 
-    # Create separate dataset for filtered rooftops, and rename variables
-    filtered_ds = sections_ds.where(sections_ds.section_area < minimum_section_area, drop=True)
+    # Create separate dataset for filtered rooftops, and rename variables and dimensions
+    filtered_index = np.flatnonzero(sections_ds.section_area.values < minimum_section_area)
     section_vars = [var for var in list(sections_ds.variables) if 'section_' in var]
-    filter_vars = [var.replace('section_','filtered_') for var in section_vars]
-    filtered_ds = filtered_ds[section_vars]
-    rename_dict = dict(zip(section_vars, filter_vars))
-    filtered_ds = filtered_ds.rename(rename_dict)
+    filtered_ds = passion.util.io.isel_geometries(sections_ds[section_vars], 'section_id', filtered_index).load()
+    filter_names = [name for name in list(filtered_ds.variables) + list(filtered_ds.dims) if 'section_' in name]
+    rename_dict = {name: name.replace('section_','filtered_') for name in filter_names}
+    filtered_ds = passion.util.io.rename_geometries(filtered_ds, rename_dict)
 
     sections_df = pd.concat([section_id,
-                             section_wkt_latlon,
-                             section_wkt_xy,
+                             section_poly_latlon,
+                             section_poly_xy,
                              section_azimuth,
                              section_tilt,
                              section_flat,
@@ -88,16 +106,12 @@ def generate_technical(input_path: pathlib.Path,
 
     
     superst_id = sections_ds.superst_id.to_dataframe()
-    superst_wkt_latlon = sections_ds.superst_wkt_latlon.to_dataframe()
-    superst_wkt_xy = sections_ds.superst_wkt_xy.to_dataframe()
     superst_seg_class = sections_ds.superst_seg_class.to_dataframe()
     superst_img_center_lat = sections_ds.superst_img_center_lat.to_dataframe()
     superst_img_center_lon = sections_ds.superst_img_center_lon.to_dataframe()
     superst_area = sections_ds.superst_area.to_dataframe()
 
     supersts_df = pd.concat([superst_id,
-                             superst_wkt_latlon,
-                             superst_wkt_xy,
                              superst_seg_class,
                              superst_img_center_lat,
                              superst_img_center_lon,
@@ -105,6 +119,11 @@ def generate_technical(input_path: pathlib.Path,
                              ], axis=1)
     obstacles_df = supersts_df
     obstacles_ds = xarray.Dataset.from_dataframe(obstacles_df)
+    for name in ['superst_wkb_latlon', 'superst_wkb_xy']:
+      obstacles_ds = obstacles_ds.assign(passion.util.io.encode_wkb(passion.util.io.get_wkb(sections_ds, name),
+                                                                    'superst_id', name))
+    supersts_df = supersts_df.assign(superst_poly_latlon=passion.util.io.decode_geometries(sections_ds, 'superst_wkb_latlon'),
+                                     superst_poly_xy=passion.util.io.decode_geometries(sections_ds, 'superst_wkb_xy'))
 
     # Rename to remove "superst_"
     supersts_df.columns = supersts_df.columns.str.replace('superst_', '')
@@ -117,44 +136,42 @@ def generate_technical(input_path: pathlib.Path,
   # CALCULATE SECTIONS
   if not sections_df.empty:
     # Necessary for RESKit: lat, lon, azimuth, tilt, elevation, capacity
-    sections_df['poly_latlon'] = sections_df['wkt_latlon'].apply(lambda x: shapely.wkt.loads(x))
-    sections_df['poly_xy'] = sections_df['wkt_xy'].apply(lambda x: shapely.wkt.loads(x))
     # filter empty polygons
     sections_df = sections_df[sections_df.poly_latlon.apply(lambda x: not x.is_empty)]
     sections_df['centroid_latlon'] = sections_df['poly_latlon'].apply(lambda x: x.centroid)
     sections_df['lat'] = sections_df['centroid_latlon'].apply(lambda x: x.coords[0][0])
     sections_df['lon'] = sections_df['centroid_latlon'].apply(lambda x: x.coords[0][1])
     sections_df['elev'] = 204.0 #TODO: request elevation from 'https://api.opentopodata.org/v1/'
-    # Non necessary for RESKit: area, flat, wkt_latlon, wkt_xy, n_panels, modules_cost
+    # Non necessary for RESKit: area, flat, poly_latlon, poly_xy, n_panels, modules_cost
     sections_df['pv_model'] = pv_model_name
 
-    sections_df['gr'] = sections_df['lat'].apply(lambda lat: passion.util.gis.ground_resolution(lat, zoom_level))
-    sections_df['pv_pixel_size'] = sections_df['gr'].apply(lambda gr: (pv_model_width / gr, pv_model_height / gr))
-    sections_df['pv_border_spacing_pixels'] = sections_df['gr'].apply(lambda gr: pv_border_spacing / gr)
-
-    sections_df['pv_layout_multipoly'] = sections_df.apply(lambda x: passion.util.shapes.get_panel_layout(x.poly_xy,
-                                                                                              panel_size=x.pv_pixel_size,
-                                                                                              azimuth=x.azimuth,
-                                                                                              spacing_factor=pv_spacing_factor,
-                                                                                              border_spacing=x.pv_border_spacing_pixels,
-                                                                                              n_offset=pv_n_offset),
-                                                                                              axis=1)
-    sections_df['n_panels'] = sections_df['pv_layout_multipoly'].apply(lambda x: len(x.geoms))
+    sections_df['gr'] = passion.util.gis.ground_resolution_array(sections_df['lat'].values, zoom_level)
+    sections_df['pv_pixel_size'] = list(zip(pv_model_width / sections_df['gr'].values, pv_model_height / sections_df['gr'].values))
+    sections_df['pv_border_spacing_pixels'] = pv_border_spacing / sections_df['gr'].values
+
+    print(f'Laying out panels on {len(sections_df)} sections...')
+    n_panels, pv_layout_wkb = passion.util.shapes.get_panel_layouts(shapely.to_wkb(sections_df['poly_xy'].values),
+                                                                    sections_df['pv_pixel_size'].tolist(),
+                                                                    sections_df['azimuth'].values,
+                                                                    pv_spacing_factor,
+                                                                    sections_df['pv_border_spacing_pixels'].values,
+                                                                    pv_n_offset,
+                                                                    sections_df[['img_center_lat', 'img_center_lon']].values,
+                                                                    original_image_shape,
+                                                                    zoom_level,
+                                                                    n_workers,
+                                                                    chunk_size)
+    sections_df['n_panels'] = n_panels
+    sections_df['pv_layout_wkb'] = pv_layout_wkb
     sections_df = sections_df.drop(sections_df[sections_df.n_panels < 1].index)
 
   if not sections_df.empty:
-    sections_df['pv_layout_wkt'] = sections_df.apply(lambda x: passion.util.shapes.xy_poly_to_latlon(x.pv_layout_multipoly,
-                                                                                            (x.img_center_lat, x.img_center_lon),
-                                                                                            original_image_shape,
-                                                                                            zoom_level).wkt,
-                                                                                            axis=1)
-
     sections_df['panel_area'] = sections_df['n_panels'] * pv_model_width * pv_model_height
     sections_df['modules_cost'] = sections_df['n_panels'] * pv_model_price
     sections_df['capacity'] = sections_df['n_panels'] * pv_model_capacity
     
-    sections_df = sections_df[['id', 'lat','lon', 'elev', 'capacity', 'tilt', 'azimuth', 'flat', 'area', 'wkt_latlon', 'wkt_xy',
-                              'pv_layout_wkt', 'panel_area', 'n_panels', 'modules_cost', 'pv_model']]
+    sections_df = sections_df[['id', 'lat','lon', 'elev', 'capacity', 'tilt', 'azimuth', 'flat', 'area', 'poly_latlon', 'poly_xy',
+                              'pv_layout_wkb', 'panel_area', 'n_panels', 'modules_cost', 'pv_model']]
 
     print(f'Sections columns: {sections_df.columns}')
 
@@ -162,8 +179,6 @@ def generate_technical(input_path: pathlib.Path,
   # CALCULATE PANELS
   if not panels_df.empty:
     # Necessary for RESKit: lat, lon, azimuth, tilt, elevation, capacity
-    panels_df['poly_latlon'] = panels_df['wkt_latlon'].apply(lambda x: shapely.wkt.loads(x))
-    panels_df['poly_xy'] = panels_df['wkt_xy'].apply(lambda x: shapely.wkt.loads(x))
     # filter empty polygons
     panels_df = panels_df[panels_df.poly_latlon.apply(lambda x: not x.is_empty)]
     panels_df['centroid_latlon'] = panels_df['poly_latlon'].apply(lambda x: x.centroid)
@@ -173,31 +188,32 @@ def generate_technical(input_path: pathlib.Path,
     panels_df['azimuth'] = 180.0
     panels_df['tilt'] = 31.0
     # Calculate capacity
-    panels_df['gr'] = panels_df['lat'].apply(lambda lat: passion.util.gis.ground_resolution(lat, zoom_level))
-    panels_df['pv_pixel_size'] = panels_df['gr'].apply(lambda gr: (pv_model_width / gr, pv_model_height / gr))
-    panels_df['pv_border_spacing_pixels'] = panels_df['gr'].apply(lambda gr: pv_border_spacing / gr)
-    panels_df['pv_layout_multipoly'] = panels_df.apply(lambda x: passion.util.shapes.get_panel_layout(x.poly_xy,
-                                                                                              panel_size=x.pv_pixel_size,
-                                                                                              azimuth=x.azimuth,
-                                                                                              spacing_factor=1,
-                                                                                              border_spacing=0,
-                                                                                              n_offset=pv_n_offset),
-                                                                                              axis=1)
-    panels_df['n_panels'] = panels_df['pv_layout_multipoly'].apply(lambda x: len(x.geoms))
+    panels_df['gr'] = passion.util.gis.ground_resolution_array(panels_df['lat'].values, zoom_level)
+    panels_df['pv_pixel_size'] = list(zip(pv_model_width / panels_df['gr'].values, pv_model_height / panels_df['gr'].values))
+    panels_df['pv_border_spacing_pixels'] = pv_border_spacing / panels_df['gr'].values
+    print(f'Laying out existing panels on {len(panels_df)} superstructures...')
+    n_panels, pv_layout_wkb = passion.util.shapes.get_panel_layouts(shapely.to_wkb(panels_df['poly_xy'].values),
+                                                                    panels_df['pv_pixel_size'].tolist(),
+                                                                    panels_df['azimuth'].values,
+                                                                    1,
+                                                                    0,
+                                                                    pv_n_offset,
+                                                                    panels_df[['img_center_lat', 'img_center_lon']].values,
+                                                                    original_image_shape,
+                                                                    zoom_level,
+                                                                    n_workers,
+                                                                    chunk_size)
+    panels_df['n_panels'] = n_panels
+    panels_df['pv_layout_wkb'] = pv_layout_wkb
     panels_df = panels_df.drop(panels_df[panels_df.n_panels < 1].index)
 
   if not panels_df.empty:
-    panels_df['pv_layout_wkt'] = panels_df.apply(lambda x: passion.util.shapes.xy_poly_to_latlon(x.pv_layout_multipoly,
-                                                                                            (x.img_center_lat, x.img_center_lon),
-                                                                                            original_image_shape,
-                                                                                            zoom_level).wkt,
-                                                                                            axis=1)
     panels_df['panel_area'] = panels_df['n_panels'] * pv_model_width * pv_model_height
     panels_df['modules_cost'] = panels_df['n_panels'] * pv_model_price
     panels_df['capacity'] = panels_df['n_panels'] * pv_model_capacity
 
-    panels_df = panels_df[['id', 'lat','lon', 'elev', 'capacity', 'tilt', 'azimuth', 'wkt_latlon', 'wkt_xy',
-                           'area', 'pv_layout_wkt', 'panel_area', 'n_panels', 'modules_cost']]
+    panels_df = panels_df[['id', 'lat','lon', 'elev', 'capacity', 'tilt', 'azimuth', 'poly_latlon', 'poly_xy',
+                           'area', 'pv_layout_wkb', 'panel_area', 'n_panels', 'modules_cost']]
 
     print(f'Panels columns: {panels_df.columns}')
 
@@ -205,9 +221,11 @@ def generate_technical(input_path: pathlib.Path,
   Possible output_variables:
   Defined by PASSION:
   ['lat', 'lon', 'elev', 'capacity', 'tilt',
-  'azimuth', 'flat', 'wkt_latlon', 'wkt_xy',
-  'panel_area', 'n_panels', 'modules_cost',
-  'pv_model', 'pv_layout_wkt']
+  'azimuth', 'flat', 'panel_area', 'n_panels',
+  'modules_cost', 'pv_model']
+
+  Geometries are not passed through RESKit, and are
+  added afterwards as WKB blobs (see passion.util.io).
 
   Defined by RESKit:
   ['direct_normal_irradiance', 'global_horizontal_irradiance', 'surface_wind_speed',
@@ -222,53 +240,65 @@ def generate_technical(input_path: pathlib.Path,
   if not sections_df.empty:
     output_variables = [
       'lat', 'lon', 'elev', 'capacity', 'tilt',
-      'azimuth', 'flat', 'wkt_latlon', 'wkt_xy',
+      'azimuth', 'flat',
       'area', 'panel_area', 'n_panels', 'modules_cost',
-      'pv_model', 'pv_layout_wkt',
+      'pv_model',
       'capacity_factor', 'total_system_generation'
     ]
     print(f'Simulating sections...')
-    technical_ds = rk.solar.openfield_pv_merra_ryberg2019(sections_df,
-                                                          str(merra_path),
-                                                          str(solar_atlas_path),
-                                                          module=pv_model_id,
-                                                          output_variables=output_variables
-                                                          )
+    if simulation_cache is not None:
+      technical_ds = simulate_placements_cached(sections_df,
+                                                merra_path,
+                                                solar_atlas_path,
+                                                pv_model_id,
+                                                output_variables,
+                                                simulation_cache.get('path'),
+                                                simulation_cache.get('weather_cell_size', (0.5, 0.625)),
+                                                simulation_cache.get('tilt_bin', 1.0),
+                                                simulation_cache.get('elev_bin', 100.0),
+                                                simulation_chunk_size)
+    else:
+      technical_ds = simulate_placements(sections_df,
+                                         merra_path,
+                                         solar_atlas_path,
+                                         pv_model_id,
+                                         output_variables,
+                                         simulation_chunk_size,
+                                         output_path / f'{output_stem}_hourly_sections' if save_hourly else None)
   
   if not panels_df.empty:
     output_variables = [
       'lat', 'lon', 'elev', 'capacity', 'tilt',
-      'azimuth', 'wkt_latlon', 'wkt_xy',
+      'azimuth',
       'area', 'panel_area', 'n_panels', 'modules_cost',
-      'pv_layout_wkt',
       'capacity_factor', 'total_system_generation'
     ]
     print(f'Simulating existing panels...')
-    panels_ds = rk.solar.openfield_pv_merra_ryberg2019(panels_df,
-                                                        str(merra_path),
-                                                        str(solar_atlas_path),
-                                                        module=pv_model_id,
-                                                        output_variables=output_variables
-                                                        )
+    if simulation_cache is not None:
+      panels_ds = simulate_placements_cached(panels_df,
+                                             merra_path,
+                                             solar_atlas_path,
+                                             pv_model_id,
+                                             output_variables,
+                                             simulation_cache.get('path'),
+                                             simulation_cache.get('weather_cell_size', (0.5, 0.625)),
+                                             simulation_cache.get('tilt_bin', 1.0),
+                                             simulation_cache.get('elev_bin', 100.0),
+                                             simulation_chunk_size)
+    else:
+      panels_ds = simulate_placements(panels_df,
+                                      merra_path,
+                                      solar_atlas_path,
+                                      pv_model_id,
+                                      output_variables,
+                                      simulation_chunk_size,
+                                      output_path / f'{output_stem}_hourly_panels' if save_hourly else None)
   
-  # Mean capacity factor by location (annual mean capacity factor)
+  # Yearly generation of the sections from their hourly mean
   if not sections_df.empty:
-    yearly_capacity_factor = technical_ds.capacity_factor.fillna(0).mean(dim='time')
-    yearly_system_generation = technical_ds.total_system_generation.fillna(0).mean(dim='time') * 365 * 24
-    technical_ds = technical_ds.assign(yearly_capacity_factor=yearly_capacity_factor)
-    technical_ds = technical_ds.assign(yearly_system_generation=yearly_system_generation)
-  # Mean capacity factor by location (annual mean capacity factor)
-  if not panels_df.empty:
-    yearly_capacity_factor = panels_ds.capacity_factor.fillna(0).mean(dim='time')
-    yearly_system_generation = panels_ds.total_system_generation.fillna(0).mean(dim='time')
-    panels_ds = panels_ds.assign(yearly_capacity_factor=yearly_capacity_factor)
-    panels_ds = panels_ds.assign(yearly_system_generation=yearly_system_generation)
+    technical_ds = technical_ds.assign(yearly_system_generation=technical_ds.yearly_system_generation * 365 * 24)
 
   print(f'Filtered sections variables: {list(filtered_ds.keys())}')
-  filtered_wkt_latlon_str, filtered_wkt_xy_str = filtered_ds.filtered_wkt_latlon.astype(str), \
-                                                 filtered_ds.filtered_wkt_xy.astype(str)
-  filtered_ds = filtered_ds.assign(filtered_wkt_latlon=filtered_wkt_latlon_str, \
-                                   filtered_wkt_xy=filtered_wkt_xy_str)
   print(f'Superstructures variables: {list(obstacles_ds.keys())}')
   ds_list = [obstacles_ds, filtered_ds]
   if not sections_df.empty:
@@ -278,6 +308,7 @@ def generate_technical(input_path: pathlib.Path,
     prefix_variables = [('section_' + var) for var in current_variables]
     rename_dict = dict(zip(current_variables, prefix_variables))
     technical_ds = technical_ds.rename(name_dict=rename_dict)
+    technical_ds = assign_geometries(technical_ds, sections_df, 'section_')
     new_variables = list(technical_ds.keys())
     print(f'Estimated panels new variables: {new_variables}')
     ds_list.append(technical_ds)
@@ -288,6 +319,7 @@ def generate_technical(input_path: pathlib.Path,
     prefix_variables = [('panel_' + var) for var in current_variables]
     rename_dict = dict(zip(current_variables, prefix_variables))
     panels_ds = panels_ds.rename(name_dict=rename_dict)
+    panels_ds = assign_geometries(panels_ds, panels_df, 'panel_')
     new_variables = list(panels_ds.keys())
     print(f'Existing panels new variables: {new_variables}')
     ds_list.append(panels_ds)
@@ -297,4 +329,253 @@ def generate_technical(input_path: pathlib.Path,
     output_filename += '.nc'
   final_ds.to_netcdf(str(output_path / output_filename))
 
-  return
\ No newline at end of file
+  return
+
+def assign_geometries(placements_ds: xarray.Dataset, placements_df: pd.DataFrame, prefix: str):
+  '''Adds the outlines and panel layouts of the simulated placements, in the same
+  order, to their dataset as WKB blobs named <prefix>wkb_latlon, <prefix>wkb_xy
+  and <prefix>pv_layout_wkb.
+  '''
+  location_dim = placements_ds[f'{prefix}capacity'].dims[0]
+  placements_ds = placements_ds.assign(passion.util.io.encode_geometries(placements_df['poly_latlon'].values,
+                                                                         location_dim, f'{prefix}wkb_latlon'))
+  placements_ds = placements_ds.assign(passion.util.io.encode_geometries(placements_df['poly_xy'].values,
+                                                                         location_dim, f'{prefix}wkb_xy'))
+  placements_ds = placements_ds.assign(passion.util.io.encode_wkb(placements_df['pv_layout_wkb'].values,
+                                                                  location_dim, f'{prefix}pv_layout_wkb'))
+  return placements_ds
+
+def simulate_placements(placements_df: pd.DataFrame,
+                        merra_path: pathlib.Path,
+                        solar_atlas_path: pathlib.Path,
+                        pv_model_id: str,
+                        output_variables: list,
+                        chunk_size: int = None,
+                        hourly_path: pathlib.Path = None
+):
+  '''Simulates the placements with RESKit and adds their yearly mean capacity factor and
+  system generation as yearly_capacity_factor and yearly_system_generation.
+
+  If chunk_size is set, placements are simulated in blocks of chunk_size and every block
+  is reduced to its yearly aggregates straight away, dropping the hourly series, so that
+  memory does not grow with the number of placements. The hourly series of every block
+  can be written to hourly_path as a separate NetCDF file.
+
+  ---
+
+  placements_df     -- DataFrame, placements to simulate.
+  merra_path        -- Path, folder in which the MERRA-2 dataset is stored.
+  solar_atlas_path  -- Path, folder in which the Solar Atlas dataset is stored.
+  pv_model_id       -- str, RESKit identifier of the panel model.
+  output_variables  -- list, variables returned by RESKit.
+  chunk_size        -- int, number of placements simulated at a time. If None, all at once.
+  hourly_path       -- Path, folder to store the hourly series of every chunk. If None, they are discarded.
+  '''
+  n_placements = len(placements_df)
+  if hourly_path is not None and chunk_size:
+    hourly_path.mkdir(parents=True, exist_ok=True)
+
+  chunks = []
+  for chunk_i, start in enumerate(range(0, n_placements, chunk_size or n_placements)):
+    chunk_df = placements_df.iloc[start:start + (chunk_size or n_placements)]
+    if chunk_size: print(f'Simulating placements {start}-{start + len(chunk_df)} of {n_placements}...')
+    chunk_ds = rk.solar.openfield_pv_merra_ryberg2019(chunk_df,
+                                                      str(merra_path),
+                                                      str(solar_atlas_path),
+                                                      module=pv_model_id,
+                                                      output_variables=output_variables
+                                                      )
+    yearly_capacity_factor = chunk_ds.capacity_factor.fillna(0).mean(dim='time')
+    yearly_system_generation = chunk_ds.total_system_generation.fillna(0).mean(dim='time')
+    chunk_ds = chunk_ds.assign(yearly_capacity_factor=yearly_capacity_factor)
+    chunk_ds = chunk_ds.assign(yearly_system_generation=yearly_system_generation)
+    if not chunk_size:
+      return chunk_ds
+
+    # RESKit numbers the locations of every call from 0, continue the numbering of the previous chunks
+    location_dim = next(dim for dim in chunk_ds.dims if dim != 'time')
+    chunk_ds = chunk_ds.assign_coords({ location_dim: np.arange(start, start + len(chunk_df)) })
+    if hourly_path is not None:
+      chunk_ds.to_netcdf(str(hourly_path / f'chunk_{chunk_i:05d}.nc'))
+    chunks.append(chunk_ds.drop_dims('time'))
+    del chunk_ds
+
+  return xarray.concat(chunks, dim=location_dim, data_vars='minimal')
+
+def simulate_placements_cached(placements_df: pd.DataFrame,
+                               merra_path: pathlib.Path,
+                               solar_atlas_path: pathlib.Path,
+                               pv_model_id: str,
+                               output_variables: list,
+                               cache_path: pathlib.Path = None,
+                               weather_cell_size: tuple = (0.5, 0.625),
+                               tilt_bin: float = 1.0,
+                               elev_bin: float = 100.0,
+                               chunk_size: int = None
+):
+  '''Simulates the placements through a cache of normalized 1 kW profiles, and returns
+  the placement variables with their yearly_capacity_factor and yearly_system_generation.
+
+  Placements are grouped by weather cell, elevation bin, tilt bin and azimuth. A single
+  placement of 1 kW with the tilt of the bin is simulated per group, at the mean location
+  and elevation of the placements of the group, and its yearly aggregates are scaled by the
+  capacity of every placement of the group. Variations of the Solar Atlas within a group
+  are therefore not captured.
+
+  Groups found in the CSV at cache_path are not simulated again, and the new ones are
+  appended to it. Profiles of other MERRA-2 or Solar Atlas datasets, as identified by
+  get_dataset_fingerprint(), are discarded. Hourly series are not kept.
+
+  ---
+
+  placements_df     -- DataFrame, placements to simulate.
+  merra_path        -- Path, folder in which the MERRA-2 dataset is stored.
+  solar_atlas_path  -- Path, folder in which the Solar Atlas dataset is stored.
+  pv_model_id       -- str, RESKit identifier of the panel model.
+  output_variables  -- list, placement variables to keep in the output.
+  cache_path        -- Path, CSV file storing the simulated profiles. If None, they are not stored.
+  weather_cell_size -- tuple, size in degrees of the latitude and longitude of the weather cells.
+  tilt_bin          -- float, size in degrees of the tilt bins.
+  elev_bin          -- float, size in meters of the elevation bins.
+  chunk_size        -- int, number of profiles simulated at a time. If None, all at once.
+  '''
+  datasets = '{0}-{1}'.format(get_dataset_fingerprint(merra_path), get_dataset_fingerprint(solar_atlas_path))
+  keys = get_profile_keys(placements_df, pv_model_id, datasets, weather_cell_size, tilt_bin, elev_bin)
+  key_columns = list(keys.columns)
+
+  profile_columns = key_columns + ['lat', 'lon', 'elev', 'capacity_factor', 'generation_per_kw']
+  cache_df = pd.DataFrame(columns=profile_columns)
+  if cache_path is not None and pathlib.Path(cache_path).exists():
+    cache_df = pd.read_csv(cache_path, float_precision='round_trip', dtype={'pv_model': str, 'datasets': str})
+    if not set(profile_columns) <= set(cache_df.columns):
+      print(f'Simulation cache {cache_path} has an old format, its profiles will be simulated again.')
+      cache_df = pd.DataFrame(columns=profile_columns)
+    stale = (cache_df['datasets'] != datasets).values
+    if stale.any():
+      print(f'Simulation cache: discarding {stale.sum()} profiles of other weather or Solar Atlas datasets.')
+      cache_df = cache_df[~stale]
+
+  unique_keys = keys.drop_duplicates()
+  missing_keys = unique_keys.merge(cache_df[key_columns], on=key_columns, how='left', indicator=True)
+  missing_keys = missing_keys[missing_keys['_merge'] == 'left_only'][key_columns].reset_index(drop=True)
+  print(f'Simulation cache: {len(unique_keys) - len(missing_keys)} hits, {len(missing_keys)} misses '
+        f'for {len(placements_df)} placements')
+
+  if not missing_keys.empty:
+    # Representative point of every group, at the mean location and elevation of its placements
+    points = pd.concat([keys, placements_df[['lat', 'lon', 'elev']].reset_index(drop=True)], axis=1)
+    points = points.groupby(key_columns, sort=False)[['lat', 'lon', 'elev']].mean().reset_index()
+    missing_keys = missing_keys.merge(points, on=key_columns, how='left')
+    profiles_df = pd.DataFrame({'lat': missing_keys['lat'].values,
+                                'lon': missing_keys['lon'].values,
+                                'elev': missing_keys['elev'].values,
+                                'capacity': 1.0,
+                                'tilt': missing_keys['tilt_bin'].values,
+                                'azimuth': missing_keys['azimuth_bin'].values})
+    profiles_ds = simulate_placements(profiles_df,
+                                      merra_path,
+                                      solar_atlas_path,
+                                      pv_model_id,
+                                      ['lat', 'lon', 'elev', 'capacity', 'tilt', 'azimuth',
+                                       'capacity_factor', 'total_system_generation'],
+                                      chunk_size)
+    new_cache_df = missing_keys.assign(capacity_factor=profiles_ds.yearly_capacity_factor.values,
+                                       generation_per_kw=profiles_ds.yearly_system_generation.values)
+    cache_df = pd.concat([cache_df, new_cache_df[profile_columns]], ignore_index=True)
+    if cache_path is not None:
+      pathlib.Path(cache_path).parent.mkdir(parents=True, exist_ok=True)
+      cache_df.to_csv(cache_path, index=False)
+
+  profiles = keys.merge(cache_df[key_columns + ['capacity_factor', 'generation_per_kw']], on=key_columns, how='left')
+  location = np.arange(len(placements_df))
+  placements_ds = xarray.Dataset({var: ('location', placements_df[var].values)
+                                  for var in output_variables if var in placements_df.columns},
+                                 coords={'location': location})
+  yearly_capacity_factor = profiles['capacity_factor'].values.astype(float)
+  yearly_system_generation = profiles['generation_per_kw'].values.astype(float) * placements_df['capacity'].values
+  placements_ds = placements_ds.assign(yearly_capacity_factor=('location', yearly_capacity_factor),
+                                       yearly_system_generation=('location', yearly_system_generation))
+  return placements_ds
+
+def get_profile_keys(placements_df: pd.DataFrame,
+                     pv_model_id: str,
+                     datasets: str,
+                     weather_cell_size: tuple = (0.5, 0.625),
+                     tilt_bin: float = 1.0,
+                     elev_bin: float = 100.0):
+  '''Returns the keys of the simulation cache of every placement: panel model, datasets
+  fingerprint, weather cell, elevation bin, tilt bin and azimuth.
+  '''
+  lat_cells, lon_cells = passion.util.gis.get_weather_cells(placements_df['lat'].values,
+                                                            placements_df['lon'].values,
+                                                            weather_cell_size)
+  return pd.DataFrame({'pv_model': pv_model_id,
+                       'datasets': datasets,
+                       'lat_cell': lat_cells,
+                       'lon_cell': lon_cells,
+                       'elev_bin': np.round(placements_df['elev'].values.astype(float) / elev_bin) * elev_bin,
+                       'tilt_bin': np.round(placements_df['tilt'].values.astype(float) / tilt_bin) * tilt_bin,
+                       'azimuth_bin': np.round(placements_df['azimuth'].values.astype(float), 3)})
+
+def cache_tilt_profiles(input_path: pathlib.Path,
+                        merra_path: pathlib.Path,
+                        solar_atlas_path: pathlib.Path,
+                        pv_model_id: str,
+                        cache_path: pathlib.Path,
+                        weather_cell_size: tuple = (0.5, 0.625),
+                        tilt_bin: float = 1.0,
+                        elev_bin: float = 100.0,
+                        chunk_size: int = None
+):
+  '''Completes the simulation cache of a technical analysis with the profiles of every
+  tilt bin between 0 and 90 degrees for the orientation of every non-flat section, so that
+  any tilt sampled in the uncertainty analysis can be interpolated between simulated bins.
+
+  Every weather cell, elevation bin and azimuth is simulated at the mean location and
+  elevation of its sections. Profiles already in the cache are not simulated again.
+
+  ---
+
+  input_path        -- Path, path in which the technical potential NetCDF analysis is stored.
+  merra_path        -- Path, folder in which the MERRA-2 dataset is stored.
+  solar_atlas_path  -- Path, folder in which the Solar Atlas dataset is stored.
+  pv_model_id       -- str, RESKit identifier of the panel model.
+  cache_path        -- Path, CSV file of the simulation cache.
+  weather_cell_size -- tuple, size in degrees of the latitude and longitude of the weather cells.
+  tilt_bin          -- float, size in degrees of the tilt bins.
+  elev_bin          -- float, size in meters of the elevation bins.
+  chunk_size        -- int, number of profiles simulated at a time. If None, all at once.
+  '''
+  with xarray.open_dataset(str(input_path)) as technical_ds:
+    sections_df = pd.DataFrame({ var: technical_ds[f'section_{var}'].values
+                                 for var in ['lat', 'lon', 'elev', 'tilt', 'azimuth', 'flat'] })
+  sections_df = sections_df[~sections_df['flat'].astype(bool)].dropna(subset=['lat', 'lon', 'elev', 'azimuth'])
+  if sections_df.empty: return
+
+  keys = get_profile_keys(sections_df, pv_model_id, '', weather_cell_size, tilt_bin, elev_bin)
+  group_columns = ['lat_cell', 'lon_cell', 'elev_bin', 'azimuth_bin']
+  groups = pd.concat([keys[group_columns], sections_df[['lat', 'lon', 'elev']].reset_index(drop=True)], axis=1)
+  groups = groups.groupby(group_columns)[['lat', 'lon', 'elev']].mean().reset_index()
+
+  tilts = np.arange(0, 90 + tilt_bin / 2, tilt_bin)
+  profiles_df = groups.loc[groups.index.repeat(len(tilts))].reset_index(drop=True)
+  profiles_df = profiles_df.assign(tilt=np.tile(tilts, len(groups)), azimuth=profiles_df['azimuth_bin'], capacity=1.0)
+  print(f'Caching the profiles of {len(tilts)} tilt bins for {len(groups)} section orientations...')
+  simulate_placements_cached(profiles_df[['lat', 'lon', 'elev', 'capacity', 'tilt', 'azimuth']],
+                             merra_path, solar_atlas_path, pv_model_id, [], cache_path,
+                             weather_cell_size, tilt_bin, elev_bin, chunk_size)
+  return
+
+def get_dataset_fingerprint(path: pathlib.Path):
+  '''Returns a short hash of the names, sizes and modification times of the files
+  of a dataset, stored in a file or a folder, that changes when any of them changes.
+  '''
+  path = pathlib.Path(path)
+  files = sorted(p for p in path.rglob('*') if p.is_file()) if path.is_dir() else [ path ]
+  fingerprint = hashlib.sha1()
+  for file in files:
+    stat = file.stat() if file.exists() else None
+    fingerprint.update('{0}:{1}:{2};'.format(file.relative_to(path) if path.is_dir() else file.name,
+                                              stat.st_size if stat else -1,
+                                              stat.st_mtime_ns if stat else -1).encode())
+  return fingerprint.hexdigest()[:16]
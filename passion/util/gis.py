@@ -1,4 +1,5 @@
 from math import cos, sin, pi, log, atan, exp, floor
+import numpy as np
 import urllib
 import urllib.request
 from functools import singledispatch
@@ -24,6 +25,9 @@ def map_width(zoom):
 def ground_resolution(lat, zoom):
   '''distance on the ground that’s represented by a single pixel in the map'''
   return cos(lat * pi / 180) * 2 * pi * EARTH_RADIUS / map_width(zoom)
+def ground_resolution_array(lat, zoom):
+  '''ground_resolution() for a numpy array of latitudes'''
+  return np.cos(np.asarray(lat, dtype=float) * pi / 180) * 2 * pi * EARTH_RADIUS / map_width(zoom)
 def map_scale(lat, zoom, screen_dpi):
   '''ratio between map distance and ground distance'''
   return 0.0254 / (ground_resolution(lat, zoom) * screen_dpi)
@@ -50,6 +54,28 @@ def xy_tolatlon(pixel_x, pixel_y, zoom):
 
   return(latitude, longitude)
 
+def latlon_toXY_array(lat, lon, zoom):
+  '''latlon_toXY() for numpy arrays of latitudes and longitudes, returns two integer arrays with the pixel coordinates'''
+  lat = np.clip(np.asarray(lat, dtype=float), MINLAT, MAXLAT)
+  lon = np.clip(np.asarray(lon, dtype=float), MINLON, MAXLON)
+
+  sin_lat = np.sin(lat * pi/180)
+  pixel_x = ((lon + 180) / 360) * map_width(zoom)
+  pixel_y = (0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * pi)) * map_width(zoom)
+
+  return np.floor(pixel_x + 0.5).astype(np.int64), np.floor(pixel_y + 0.5).astype(np.int64)
+
+def xy_tolatlon_array(pixel_x, pixel_y, zoom):
+  '''xy_tolatlon() for numpy arrays of pixel coordinates, returns two arrays with the latitudes and longitudes'''
+  map_size = map_width(zoom)
+  x = (np.asarray(pixel_x, dtype=float) / map_size) - 0.5
+  y = 0.5 - np.asarray(pixel_y, dtype=float) / map_size
+
+  latitude = 90 - 360 * np.arctan(np.exp(-y * 2 * pi)) / pi
+  longitude = 360 * x
+
+  return latitude, longitude
+
 def xy_totile(pixel_x, pixel_y):
   '''converts a point in pixel coordinates to the coordinates of the tile containing it'''
   return(floor(pixel_x / 256), floor(pixel_y / 256))
@@ -90,6 +116,29 @@ def get_image_bbox(latlon: tuple, zoom: int, img_shape: tuple):
 
   return bbox
 
+def get_image_bbox_array(lat, lon, zoom: int, img_shape: tuple):
+  '''get_image_bbox() for numpy arrays of image center latitudes and longitudes of the same image shape.
+  Returns four arrays: min_lat, min_lon, max_lat, max_lon.
+  '''
+  size_y, size_x = img_shape[:2]
+
+  center_x, center_y = latlon_toXY_array(lat, lon, zoom)
+
+  # Truncate towards zero as int() does
+  lat1, lon1 = xy_tolatlon_array(np.trunc(center_x - (size_x / 2)), np.trunc(center_y - (size_y / 2)), zoom)
+  lat2, lon2 = xy_tolatlon_array(np.trunc(center_x + (size_x / 2)), np.trunc(center_y + (size_y / 2)), zoom)
+
+  return np.minimum(lat1, lat2), np.minimum(lon1, lon2), np.maximum(lat1, lat2), np.maximum(lon1, lon2)
+
+def get_weather_cells(lat, lon, cell_size: tuple = (0.5, 0.625)):
+  '''Takes arrays of latitudes and longitudes and the size in degrees of a regular
+  weather grid centered on multiples of it (MERRA-2 by default), and returns the
+  integer latitude and longitude indices of the nearest grid point.
+  '''
+  lat_cell = np.round(np.asarray(lat, dtype=float) / cell_size[0]).astype(int)
+  lon_cell = np.round(np.asarray(lon, dtype=float) / cell_size[1]).astype(int)
+  return lat_cell, lon_cell
+
 def get_filename(latlon: tuple, zoom: int, extension: str = 'png'):
   '''Generates a filename with the format:
   DD[D]MM[M]SSSSS[S][NORTH/SOUTH]DD[D]MM[M]SSSSS[S][WEST/EAST]_LL[L].[EXT]
@@ -178,7 +227,9 @@ def str_to_ddmmss(ddmmss: str):
 
 def shape_to_pixels(shape: shapefile.Shape, zoom):
   '''Gets a shapefile.Shape and returns a list of tuples with the coordinates representation.'''
-  pixel_points = [latlon_toXY(coord[1], coord[0], zoom) for coord in shape.points]
+  points = np.asarray(shape.points, dtype=float).reshape(-1, 2)
+  pixel_x, pixel_y = latlon_toXY_array(points[:, 1], points[:, 0], zoom)
+  pixel_points = list(zip(pixel_x.tolist(), pixel_y.tolist()))
   return pixel_points
 
 def shape_bbox(shape: shapefile.Shape):
@@ -204,7 +255,8 @@ def polygons_intersect(polygon1, polygon2):
 
 def substract_offset(polygon, offset_x, offset_y):
   '''Returns the polygon expressed as a list after substracting the given offset'''
-  return [(coord[0]-offset_x, coord[1]-offset_y) for coord in polygon]
+  polygon = np.asarray(polygon).reshape(-1, 2)
+  return list(zip((polygon[:, 0] - offset_x).tolist(), (polygon[:, 1] - offset_y).tolist()))
 
 def get_gdal_transform(extent: List[int], width: int, height: int):
   ''''''
@@ -6,6 +6,7 @@ import cv2
 import ast
 import pickle
 import sys
+import shapely
 from osgeo import gdal, gdal_array
 from typing import List, Dict
 
@@ -56,6 +57,97 @@ def load_pickle(path: pathlib.Path):
     obj = pickle.load(f)
   return obj
 
+def encode_geometries(geometries, dim: str, name: str):
+  '''Takes a list of shapely geometries and returns the variables that store them
+  in a Dataset as WKB blobs, to be assigned or passed as data_vars:
+    -name, the concatenated blobs as bytes along the name_byte dimension.
+    -name_offset, the position in name of the blob of every geometry along dim.
+    -name_length, the length of the blob of every geometry along dim.
+  Since every geometry keeps its own offset, the blobs stay valid when the Dataset
+  is reordered, selected or padded along dim.
+  '''
+  blobs = shapely.to_wkb(np.array(list(geometries), dtype=object))
+  return encode_wkb(blobs, dim, name)
+
+def encode_wkb(blobs, dim: str, name: str):
+  '''encode_geometries() for an array of WKB blobs, in which None is stored with length 0.'''
+  blobs = [ blob or b'' for blob in blobs ]
+  lengths = np.fromiter(map(len, blobs), dtype=np.int64, count=len(blobs))
+  offsets = np.cumsum(lengths) - lengths
+  data = np.frombuffer(b''.join(blobs), dtype=np.uint8)
+  return {
+    name: ([f'{name}_byte'], data,
+           {
+             'type': 'bytes',
+             'str_format': 'wkb',
+             'offsets': f'{name}_offset',
+             'lengths': f'{name}_length'
+           },
+           { 'zlib': True, 'complevel': 1 }),
+    f'{name}_offset': ([dim], offsets,
+                       {
+                         'type': 'int',
+                         'description': f'Position in {name} of the WKB blob of every geometry.'
+                       }),
+    f'{name}_length': ([dim], lengths,
+                       {
+                         'type': 'int',
+                         'description': f'Length in bytes of the WKB blob of every geometry in {name}.'
+                       })
+  }
+
+def get_wkb(ds, name: str):
+  '''Returns an array with the WKB blob of every geometry stored as name in a Dataset,
+  or None for the positions without geometry.
+  '''
+  offsets = ds[f'{name}_offset'].values
+  lengths = ds[f'{name}_length'].values
+  # Merging datasets along dim pads the offsets and lengths of missing geometries with NaN
+  missing = ~(np.isfinite(offsets) & np.isfinite(lengths))
+  offsets = np.where(missing, 0, offsets).astype(np.int64)
+  lengths = np.where(missing, 0, lengths).astype(np.int64)
+  missing |= lengths == 0
+  buffer = ds[name].values.tobytes()
+  blobs = np.empty(len(lengths), dtype=object)
+  blobs[:] = [ buffer[offset:offset + length] for offset, length in zip(offsets.tolist(), lengths.tolist()) ]
+  blobs[missing] = None
+  return blobs
+
+def decode_geometries(ds, name: str):
+  '''Returns an array with the shapely geometries stored as name in a Dataset,
+  decoded in a single vectorized call.
+  '''
+  return shapely.from_wkb(get_wkb(ds, name))
+
+def isel_geometries(ds, dim: str, index):
+  '''Selects the given positions along dim of a Dataset, as Dataset.isel(),
+  keeping only the WKB blobs of the selected geometries.
+  '''
+  names = [ name for name in ds.data_vars
+            if f'{name}_length' in ds.data_vars and ds[f'{name}_length'].dims == (dim,) ]
+  blobs = { name: get_wkb(ds, name)[index] for name in names }
+  ds = ds.drop_vars([ f'{name}{suffix}' for name in names for suffix in ['', '_offset', '_length'] ])
+  ds = ds.isel({ dim: index })
+  for name in names:
+    ds = ds.assign(encode_wkb(blobs[name], dim, name))
+  return ds
+
+def rename_geometries(ds, name_dict: dict):
+  '''Renames variables and dimensions of a Dataset, as Dataset.rename(), rewriting
+  the attributes that point each WKB blob to its offsets and lengths.
+  '''
+  ds = ds.rename(name_dict).copy()
+  for name in ds.data_vars:
+    attrs = ds[name].attrs
+    if attrs.get('str_format') != 'wkb': continue
+    old_name = next((old for old, new in name_dict.items() if new == name), name)
+    attrs.update({ key: name_dict.get(attrs[key], attrs[key]) for key in ['offsets', 'lengths'] if key in attrs })
+    for suffix in ['_offset', '_length']:
+      if f'{name}{suffix}' in ds.data_vars and 'description' in ds[f'{name}{suffix}'].attrs:
+        description = ds[f'{name}{suffix}'].attrs['description']
+        ds[f'{name}{suffix}'].attrs['description'] = description.replace(old_name, name)
+  return ds
+
 def write_geotiff(filename: str, img: np.array, transform: List[float], projection: str, metadata: Dict[str, str]):
   '''Writes a GeoTiff image from a numpy array in shape format (height, width, channels).'''
   # https://epsg.io/3857
@@ -1,14 +1,42 @@
 import requests
 import json
+import re
 import time
+import pathlib
+import sqlite3
+import itertools
+import contextlib
+import math
+import numpy as np
+import pandas as pd
+import shapely
+import shapely.geometry
 
 import passion.util
 
 OVERPASS_URL = "http://overpass-api.de/api/interpreter"
 
-def get_footprints_latlon(bbox: tuple, osm_request_interval: float = 5, num_retries: int = 5):
+def get_footprints_latlon(bbox: tuple, osm_request_interval: float = 5, num_retries: int = 5,
+                          overpass_url: str = OVERPASS_URL):
   '''Given a bounding box, requests the OSM buildings of the area
   and returns them as a list of outlines.'''
+  results = request_overpass(get_overpass_query(bbox), osm_request_interval, num_retries, overpass_url)
+  
+  if not results: return []
+  if results.get('remark'):
+    print(f'Overpass response for {bbox} may be incomplete: {results["remark"]}')
+
+  ways, nodes = get_ways_nodes(results)
+
+  buildings = []
+  if (ways and nodes):
+    #get_node_latlon(ways['elements'][0]['nodes'][0], nodes['elements'])
+    buildings = get_buildings(ways, nodes)
+
+  return buildings
+
+def get_overpass_query(bbox: tuple):
+  '''Returns the Overpass query of the OSM buildings in a bounding box, with their nodes.'''
   latlon1, latlon2 = bbox
 
   min_lat, max_lat = min(latlon1[0], latlon2[0]), max(latlon1[0], latlon2[0])
@@ -23,14 +51,28 @@ def get_footprints_latlon(bbox: tuple, osm_request_interval: float = 5, num_retr
   out;
   """.format(min_lat, min_lon, max_lat, max_lon)
 
+  return overpass_query
+
+def request_overpass(overpass_query: str, osm_request_interval: float = 5, num_retries: int = 5,
+                     overpass_url: str = OVERPASS_URL):
+  '''Sends a query to Overpass and returns its JSON response, or None if every retry failed.
+
+  A file:// URL reads the response from a local JSON file instead, as a stand-in for Overpass,
+  keeping only the ways that intersect the bounding box of the query and their nodes.
+  '''
+  if overpass_url.startswith('file://'):
+    with open(overpass_url[len('file://'):], 'r') as f:
+      results = json.load(f)
+    return filter_overpass_bbox(results, overpass_query)
+
   #TODO: handle if empty request
 
   # workaround for hitting request limit (error 429) from overpass
   #time.sleep(osm_request_interval)
-  num_retries = 5
+  results = None
   for i in range(num_retries):
     try:
-      response = requests.get(OVERPASS_URL, params={'data': overpass_query})
+      response = requests.get(overpass_url, params={'data': overpass_query})
       results = response.json()
       print(f'Successful request {i}.')
       break
@@ -39,9 +81,30 @@ def get_footprints_latlon(bbox: tuple, osm_request_interval: float = 5, num_retr
       results = None
       print(f'Waiting {osm_request_interval} seconds.')
       time.sleep(osm_request_interval)
-  
-  if not results: return []
 
+  return results
+
+def filter_overpass_bbox(results: dict, overpass_query: str):
+  '''Returns the response with only the ways that intersect the bounding box
+  (south, west, north, east) of an Overpass query, and their nodes.
+  '''
+  bbox = re.search(r'\(\s*([-\d.eE]+),\s*([-\d.eE]+),\s*([-\d.eE]+),\s*([-\d.eE]+)\s*\)', overpass_query)
+  if bbox is None: return results
+  min_lat, min_lon, max_lat, max_lon = map(float, bbox.groups())
+
+  ways, nodes = get_ways_nodes(results)
+  if ways and nodes:
+    lines = [ shapely.LineString(building) if len(building) > 1 else shapely.MultiPoint(building)
+              for building in get_buildings(ways, nodes) ]
+    ways = [ way for way, inside in zip(ways, shapely.intersects(lines, shapely.box(min_lat, min_lon, max_lat, max_lon)))
+             if inside ]
+  else:
+    ways = []
+  way_nodes = set(itertools.chain.from_iterable(way['nodes'] for way in ways))
+  return { **results, 'elements': [ node for node in nodes if node['id'] in way_nodes ] + ways }
+
+def get_ways_nodes(results: dict):
+  '''Splits the elements of an Overpass response into ways and nodes.'''
   nodes = []
   ways = []
   for result in results['elements']:
@@ -51,14 +114,218 @@ def get_footprints_latlon(bbox: tuple, osm_request_interval: float = 5, num_retr
       nodes.append(result)
     else:
       print(f'Other Overpass type: {result["type"]}')
+  return ways, nodes
 
-  buildings = []
-  if (ways and nodes):
-    #get_node_latlon(ways['elements'][0]['nodes'][0], nodes['elements'])
-    buildings = get_buildings(ways, nodes)
+def build_footprints_cache(bboxes: list,
+                           cache_path: pathlib.Path,
+                           chunk_size: float = 0.05,
+                           osm_request_interval: float = 5,
+                           num_retries: int = 5,
+                           overpass_url: str = OVERPASS_URL,
+                           max_splits: int = 2):
+  '''Requests the OSM buildings of a region once, and stores them in an
+  SQLite file with an R*Tree index on their bounding boxes, to be read
+  with get_cached_footprints_latlon() without further requests.
+
+  The region is split in a grid of chunk_size degrees, and only the chunks
+  that intersect one of the bounding boxes are requested. Requested chunks
+  are recorded in the cache, so an interrupted or extended region only
+  requests the chunks that are missing. Buildings in several chunks are
+  stored once.
+
+  Overpass answers a query that timed out or ran out of memory with a remark
+  and partial elements. Such a chunk is requested again in quarters, up to
+  max_splits times, and if it is still incomplete nothing is stored for it,
+  so it is requested again in the next run.
+
+  ---
+
+  bboxes                -- list, bounding boxes ((lat, lon), (lat, lon)) of the region, e.g. of every image.
+  cache_path            -- Path, SQLite file of the cache.
+  chunk_size            -- float, size in degrees of the chunks requested to Overpass.
+  osm_request_interval  -- float, seconds to wait per request retry.
+  num_retries           -- int, number of times to retry a request after an error.
+  overpass_url          -- str, Overpass interpreter URL, or file:// path of a stand-in response.
+  max_splits            -- int, number of times an incomplete chunk is split in quarters and requested again.
+  '''
+  cache_path.parent.mkdir(parents=True, exist_ok=True)
+
+  chunks = set()
+  for (lat1, lon1), (lat2, lon2) in bboxes:
+    min_i, max_i = int(np.floor(min(lat1, lat2) / chunk_size)), int(np.floor(max(lat1, lat2) / chunk_size))
+    min_j, max_j = int(np.floor(min(lon1, lon2) / chunk_size)), int(np.floor(max(lon1, lon2) / chunk_size))
+    chunks.update(itertools.product(range(min_i, max_i + 1), range(min_j, max_j + 1)))
+
+  with open_footprints_cache(cache_path) as connection:
+    done = set(connection.execute('''SELECT i, j FROM chunks WHERE chunk_size = ?''', (chunk_size,)).fetchall())
+    missing = sorted(chunks - done)
+    print(f'Requesting {len(missing)} of {len(chunks)} OSM chunks, {len(chunks) - len(missing)} already cached.')
 
+    for n, (i, j) in enumerate(missing):
+      bbox = ((i * chunk_size, j * chunk_size), ((i + 1) * chunk_size, (j + 1) * chunk_size))
+      ways, buildings = request_footprints(bbox, osm_request_interval, num_retries, overpass_url, max_splits)
+      if ways is None:
+        print(f'OSM chunk {n} at {bbox} could not be requested, it will be requested again in the next run.')
+        continue
+
+      for way, building in zip(ways, buildings):
+        coords = np.asarray(building, dtype=np.float64).reshape(-1, 2)
+        if not len(coords): continue
+        inserted = connection.execute('''INSERT OR IGNORE INTO footprints (id, coords) VALUES (?, ?)''',
+                                      (way['id'], coords.tobytes())).rowcount
+        if inserted:
+          (min_lat, min_lon), (max_lat, max_lon) = coords.min(axis=0).tolist(), coords.max(axis=0).tolist()
+          connection.execute('''INSERT INTO footprints_index VALUES (?, ?, ?, ?, ?)''',
+                             (way['id'], min_lat, max_lat, min_lon, max_lon))
+      connection.execute('''INSERT INTO chunks VALUES (?, ?, ?)''', (chunk_size, i, j))
+      connection.commit()
+
+  return
+
+def request_footprints(bbox: tuple, osm_request_interval: float = 5, num_retries: int = 5,
+                       overpass_url: str = OVERPASS_URL, max_splits: int = 2):
+  '''Requests the OSM buildings of a bounding box, and returns their ways and
+  outlines, or (None, None) if the request failed. A response with a remark is
+  incomplete, and its bounding box is requested again in quarters.
+  '''
+  results = request_overpass(get_overpass_query(bbox), osm_request_interval, num_retries, overpass_url)
+  if results is None: return None, None
+  if results.get('remark'):
+    print(f'Overpass response for {bbox} is incomplete: {results["remark"]}')
+    if max_splits <= 0: return None, None
+
+    (lat1, lon1), (lat2, lon2) = bbox
+    mid_lat, mid_lon = (lat1 + lat2) / 2, (lon1 + lon2) / 2
+    ways, buildings = [], []
+    for lats, lons in itertools.product([ (lat1, mid_lat), (mid_lat, lat2) ], [ (lon1, mid_lon), (mid_lon, lon2) ]):
+      quarter_ways, quarter_buildings = request_footprints(tuple(zip(lats, lons)), osm_request_interval,
+                                                           num_retries, overpass_url, max_splits - 1)
+      if quarter_ways is None: return None, None
+      ways += quarter_ways
+      buildings += quarter_buildings
+    return ways, buildings
+
+  ways, nodes = get_ways_nodes(results)
+  buildings = get_buildings(ways, nodes) if (ways and nodes) else []
+  return ways, buildings
+
+def get_cached_footprints_latlon(bbox: tuple, cache_path: pathlib.Path):
+  '''get_footprints_latlon() reading the buildings from a cache generated by
+  build_footprints_cache(), returning those whose bounding box intersects bbox.
+  '''
+  _, buildings = query_footprints_cache(bbox, cache_path)
   return buildings
 
+def query_footprints_cache(bbox: tuple, cache_path: pathlib.Path):
+  '''Returns the OSM way ids and the outlines of the buildings in a cache
+  generated by build_footprints_cache() whose bounding box intersects bbox.
+  '''
+  (lat1, lon1), (lat2, lon2) = bbox
+
+  with open_footprints_cache(cache_path) as connection:
+    rows = connection.execute('''SELECT footprints.id, footprints.coords FROM footprints_index
+                                 JOIN footprints ON footprints.id = footprints_index.id
+                                 WHERE max_lat >= ? AND min_lat <= ? AND max_lon >= ? AND min_lon <= ?
+                                 ORDER BY footprints.id''',
+                              (min(lat1, lat2), max(lat1, lat2), min(lon1, lon2), max(lon1, lon2))).fetchall()
+
+  ids = [ way_id for way_id, _ in rows ]
+  buildings = [ list(map(tuple, np.frombuffer(coords, dtype=np.float64).reshape(-1, 2).tolist())) for _, coords in rows ]
+  return ids, buildings
+
+def match_osm_buildings(rooftops_latlon,
+                        cache_path: pathlib.Path,
+                        distance: float = 50,
+                        chunk_size: float = 0.05,
+                        osm_request_interval: float = 5,
+                        num_retries: int = 5,
+                        overpass_url: str = OVERPASS_URL):
+  '''Matches every rooftop of a region with the OSM buildings around it.
+
+  The OSM buildings of the region are requested once into the cache of
+  build_footprints_cache(), and all of the rooftops are matched with a single
+  spatial index, in Web Mercator coordinates scaled to meters at the latitude
+  of every rooftop.
+
+  Returns a DataFrame with a row per rooftop and the columns:
+    -osm_way_id, id of the nearest OSM building within distance, or <NA>.
+    -distance, distance in meters between the rooftop and that building, 0 if they intersect.
+    -n_intersecting, number of OSM buildings intersecting the rooftop.
+
+  ---
+
+  rooftops_latlon       -- list, rooftop polygons in (lat, lon) coordinates.
+  cache_path            -- Path, SQLite file of the OSM buildings cache.
+  distance              -- float, maximum distance in meters to the nearest building.
+  chunk_size            -- float, size in degrees of the chunks requested to Overpass.
+  osm_request_interval  -- float, seconds to wait per request retry.
+  num_retries           -- int, number of times to retry a request after an error.
+  overpass_url          -- str, Overpass interpreter URL, or file:// path of a stand-in response.
+  '''
+  rooftops_latlon = np.array(list(rooftops_latlon), dtype=object)
+  matches = pd.DataFrame({
+    'osm_way_id': pd.array([pd.NA] * len(rooftops_latlon), dtype='Int64'),
+    'distance': np.full(len(rooftops_latlon), np.nan),
+    'n_intersecting': np.zeros(len(rooftops_latlon), dtype=np.int64)
+  })
+  if not len(rooftops_latlon): return matches
+
+  # Region of the rooftops, extended by the matching distance
+  min_lat, min_lon, max_lat, max_lon = shapely.total_bounds(rooftops_latlon)
+  margin_lat = distance / 110574
+  margin_lon = distance / (111320 * np.cos(np.radians(max(abs(min_lat), abs(max_lat)))))
+  rooftop_bounds = shapely.bounds(rooftops_latlon)
+  bboxes = [ ((lat1 - margin_lat, lon1 - margin_lon), (lat2 + margin_lat, lon2 + margin_lon))
+             for lat1, lon1, lat2, lon2 in rooftop_bounds ]
+  build_footprints_cache(bboxes, cache_path, chunk_size, osm_request_interval, num_retries, overpass_url)
+  way_ids, buildings = query_footprints_cache(((min_lat - margin_lat, min_lon - margin_lon),
+                                               (max_lat + margin_lat, max_lon + margin_lon)), cache_path)
+
+  buildings = [ (way_id, building) for way_id, building in zip(way_ids, buildings) if len(building) > 2 ]
+  if not buildings: return matches
+  way_ids = np.array([ way_id for way_id, _ in buildings ], dtype=np.int64)
+  lengths = [ len(building) for _, building in buildings ]
+  coords = np.array(list(itertools.chain.from_iterable(building for _, building in buildings)), dtype=np.float64)
+  osm_latlon = shapely.polygons(shapely.linearrings(coords, indices=np.repeat(np.arange(len(lengths)), lengths)))
+
+  def to_xy(coords):
+    x, y = passion.util.gis.latlon_toXY_array(coords[:, 0], coords[:, 1], passion.util.gis.MAXZOOM)
+    return np.stack([x, y], axis=-1)
+  rooftops_xy = shapely.transform(rooftops_latlon, to_xy)
+  osm_xy = shapely.make_valid(shapely.transform(osm_latlon, to_xy))
+  meters_per_pixel = passion.util.gis.ground_resolution_array(rooftop_bounds[:, [0, 2]].mean(axis=1),
+                                                              passion.util.gis.MAXZOOM)
+
+  tree = shapely.STRtree(osm_xy)
+  rooftop_i, _ = tree.query(rooftops_xy, predicate='intersects')
+  matches['n_intersecting'] = np.bincount(rooftop_i, minlength=len(rooftops_xy))
+
+  (rooftop_i, osm_i), distances = tree.query_nearest(rooftops_xy, max_distance=distance / meters_per_pixel.min(),
+                                                     return_distance=True)
+  distances = distances * meters_per_pixel[rooftop_i]
+  # Keep a single nearest building per rooftop, within its own distance in meters
+  first = np.unique(rooftop_i, return_index=True)[1]
+  rooftop_i, osm_i, distances = rooftop_i[first], osm_i[first], distances[first]
+  within = distances <= distance
+  matches.loc[rooftop_i[within], 'osm_way_id'] = way_ids[osm_i[within]]
+  matches.loc[rooftop_i[within], 'distance'] = distances[within]
+
+  return matches
+
+@contextlib.contextmanager
+def open_footprints_cache(cache_path: pathlib.Path):
+  '''Opens the SQLite footprints cache, creating its tables if needed, and closes it on exit.'''
+  connection = sqlite3.connect(str(cache_path))
+  try:
+    connection.execute('''CREATE TABLE IF NOT EXISTS footprints (id INTEGER PRIMARY KEY, coords BLOB)''')
+    connection.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS footprints_index
+                          USING rtree(id, min_lat, max_lat, min_lon, max_lon)''')
+    connection.execute('''CREATE TABLE IF NOT EXISTS chunks
+                          (chunk_size REAL, i INTEGER, j INTEGER, PRIMARY KEY (chunk_size, i, j))''')
+    yield connection
+  finally:
+    connection.close()
+
 def get_nearest_osm_building(outline_lonlat: list, latlon: tuple):
   '''Given a building outline as a list of longitudes and latitudes and
   a given center latitude, returns the closest overlapping OSM building
@@ -102,50 +369,83 @@ def get_nearest_osm_building(outline_lonlat: list, latlon: tuple):
   way_map = dict()
   nearest_building = None
 
+  _, nodes = get_ways_nodes(elements)
+  node_index = get_node_index(nodes)
   for way in ways['elements']:
-    way_nodes = []
-    for node in elements['elements']:
-      if node['id'] in way['nodes']:
-        way_nodes.append(node)
     way_map[way['id']] = way
-    node_map[way['id']] = way_nodes
+    node_map[way['id']] = get_way_coords(way['nodes'], node_index)
 
   closest_distance = 99999
   for ident in node_map.keys():
     way = way_map[ident]
 
-    b = []
-    for node in node_map[ident]:
-      b.append((node['lat'], node['lon']))
+    b = node_map[ident]
     
     if passion.util.gis.polygons_intersect(outline_lonlat, b):
       intersecting_buildings.append(way)
     
-    x, y = Polygon(b).centroid.coords.xy
+    x, y = shapely.geometry.Polygon(b).centroid.coords.xy
     x = x[0]
     y = y[0]
 
     if (math.sqrt( (x - lat)**2 + (y - lon)**2 )) < closest_distance:
+      closest_distance = math.sqrt( (x - lat)**2 + (y - lon)**2 )
       nearest_building = way
     
     nearby_buildings.append(way)
 
   return nearest_building, len(intersecting_buildings)
 
-def get_node_latlon(id: int, nodes: list):
-  '''Given an OSM list of nodes and the id of a node,
-  returns its latitude and longitude.
+def get_node_index(nodes: list):
+  '''Given an OSM list of nodes, returns their sorted ids and the latitude
+  and longitude of each one, to look them up in bulk with get_nodes_latlon().
+  '''
+  ids = np.fromiter((node['id'] for node in nodes), dtype=np.int64, count=len(nodes))
+  latlon = np.fromiter(itertools.chain.from_iterable((node['lat'], node['lon']) for node in nodes),
+                       dtype=np.float64, count=2 * len(nodes)).reshape(-1, 2)
+  order = np.argsort(ids, kind='stable')
+  return ids[order], latlon[order]
+
+def get_nodes_latlon(ids: np.ndarray, node_index: tuple):
+  '''Given a node index from get_node_index() and an array of node ids,
+  returns an array with the latitude and longitude of every node.
   '''
-  return next((node['lat'], node['lon']) for node in nodes if (node['id'] == id))
+  node_ids, node_latlon = node_index
+  ids = np.asarray(ids, dtype=np.int64)
+  positions = np.minimum(np.searchsorted(node_ids, ids), max(len(node_ids) - 1, 0))
+  missing = (node_ids[positions] != ids) if len(node_ids) else np.ones(len(ids), dtype=bool)
+  if missing.any():
+    raise KeyError(f'OSM nodes {ids[missing][:10].tolist()} not found.')
+  return node_latlon[positions]
 
-def get_way_coords(way_nodes: list, nodes: list):
-  '''Given an OSM list of nodes and a list of nodes of a way,
-  returns the latitude and longitude of the nodes of the way.
+def get_node_latlon(id: int, nodes):
+  '''Given an OSM list of nodes, or a node index from get_node_index(),
+  and the id of a node, returns its latitude and longitude.
   '''
-  return list(get_node_latlon(id, nodes) for id in way_nodes)
+  if isinstance(nodes, list): nodes = get_node_index(nodes)
+  return tuple(get_nodes_latlon([id], nodes)[0].tolist())
+
+def get_way_coords(way_nodes: list, nodes):
+  '''Given an OSM list of nodes, or a node index from get_node_index(),
+  and a list of nodes of a way, returns the latitude and longitude of the
+  nodes of the way.
+  '''
+  if isinstance(nodes, list): nodes = get_node_index(nodes)
+  latlon = get_nodes_latlon(way_nodes, nodes)
+  return list(zip(latlon[:, 0].tolist(), latlon[:, 1].tolist()))
 
 def get_buildings(ways: list, nodes: list):
   '''Given an OSM list of nodes and ways, returns the coordinates of
   the ways in a latitude longitude representation.
+
+  Nodes are indexed once, and the nodes of all of the ways are looked up
+  in a single vectorized call.
   '''
-  return list(get_way_coords(way['nodes'], nodes) for way in ways)
\ No newline at end of file
+  node_index = get_node_index(nodes)
+  lengths = np.fromiter((len(way['nodes']) for way in ways), dtype=np.int64, count=len(ways))
+  refs = np.fromiter(itertools.chain.from_iterable(way['nodes'] for way in ways), dtype=np.int64, count=lengths.sum())
+  latlon = get_nodes_latlon(refs, node_index)
+  lats, lons = latlon[:, 0].tolist(), latlon[:, 1].tolist()
+  ends = np.cumsum(lengths).tolist()
+  starts = [0] + ends[:-1]
+  return [ list(zip(lats[start:end], lons[start:end])) for start, end in zip(starts, ends) ]
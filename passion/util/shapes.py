@@ -1,8 +1,9 @@
+import concurrent.futures
 import numpy as np
 import PIL
 import PIL.ImageDraw
+import shapely
 import shapely.geometry
-from shapely import affinity
 import cv2
 
 import passion.util
@@ -19,37 +20,50 @@ def xy_poly_to_latlon(poly_xy: shapely.geometry.Polygon,
   If lonlat_order is set to True, the returned list will be in
   longitude latitude format instead of latitude longitude.
   '''
-  if poly_xy.geom_type == 'MultiPolygon':
-    polys_latlon = []
-    for poly in poly_xy.geoms:
-      poly_latlon = xy_poly_to_latlon(poly, img_center_latlon, img_shape, zoom, lonlat_order)
-      polys_latlon.append(poly_latlon)
-    return shapely.geometry.MultiPolygon(polys_latlon)
-  
   img_center_lat, img_center_lon = img_center_latlon
   img_center_x, img_center_y = passion.util.gis.latlon_toXY(img_center_lat, img_center_lon, zoom)
-  img_size_y, img_size_x = img_shape
+  img_size_y, img_size_x = img_shape[:2]
   img_start_x = img_center_x - (img_size_x // 2)
   img_start_y = img_center_y - (img_size_y // 2)
 
-  outline_xy = poly_xy.exterior.coords
-  outline_latlon = []
-  for point in outline_xy:
-    lat, lon = passion.util.gis.xy_tolatlon(img_start_x + point[0], img_start_y + point[1], zoom)
-    new_point = [lon, lat] if lonlat_order else [lat, lon]
-    outline_latlon.append(new_point)
-
-  # Add each of the polygon interiors (holes)
-  interiors = []
-  for interior in poly_xy.interiors:
-    interior_latlon = []
-    for point in interior.coords:
-      lat, lon = passion.util.gis.xy_tolatlon(img_start_x + point[0], img_start_y + point[1], zoom)
-      new_point = [lon, lat] if lonlat_order else [lat, lon]
-      interior_latlon.append(new_point)
-    interiors.append(interior_latlon)
-  
-  return shapely.geometry.Polygon(outline_latlon, interiors)
+  # Transform all of the coordinates at once, including holes and every part of a MultiPolygon
+  def to_latlon(coords):
+    lat, lon = passion.util.gis.xy_tolatlon_array(img_start_x + coords[:, 0], img_start_y + coords[:, 1], zoom)
+    return np.stack([lon, lat] if lonlat_order else [lat, lon], axis=-1)
+
+  return shapely.transform(poly_xy, to_latlon)
+
+def xy_polys_to_latlon(polys_xy,
+                       img_centers_latlon,
+                       img_shape: tuple,
+                       zoom: int,
+                       lonlat_order: bool = False
+):
+  '''Takes an array of polygons in the pixel coordinate system of their images,
+  and the array of image centers as (lat, lon) rows, and transforms all of
+  them into latitude and longitude in a single vectorized pass.
+
+  A single image center can be given if all of the polygons belong to the same image.
+  All images must share the same shape and zoom level.
+  Returns a numpy array of polygons.
+  '''
+  polys_xy = np.array(polys_xy, dtype=object)
+  img_centers_latlon = np.asarray(img_centers_latlon, dtype=float).reshape(-1, 2)
+  if polys_xy.size == 0: return polys_xy
+  if len(img_centers_latlon) == 1:
+    img_centers_latlon = np.repeat(img_centers_latlon, len(polys_xy), axis=0)
+
+  img_centers_x, img_centers_y = passion.util.gis.latlon_toXY_array(img_centers_latlon[:, 0], img_centers_latlon[:, 1], zoom)
+  img_size_y, img_size_x = img_shape[:2]
+  img_starts_x = img_centers_x - (img_size_x // 2)
+  img_starts_y = img_centers_y - (img_size_y // 2)
+
+  coords, index = shapely.get_coordinates(polys_xy, return_index=True)
+  lat, lon = passion.util.gis.xy_tolatlon_array(img_starts_x[index] + coords[:, 0], img_starts_y[index] + coords[:, 1], zoom)
+  coords = np.stack([lon, lat] if lonlat_order else [lat, lon], axis=-1)
+
+  # set_coordinates replaces the geometries of the given array, which is a copy
+  return shapely.set_coordinates(polys_xy, coords)
 
 def get_outline_center(poly: shapely.geometry.Polygon):
   '''Given an outline as a list of coordinates, return its center.'''
@@ -138,41 +152,58 @@ def get_image_classes_xy(image: np.ndarray, simplification_distance: int):
   format relative to the image.
   A simplification distance can be specify in order to simplify the
   detected polygons.
+
+  Contours are retrieved as a two-level hierarchy, so the holes of every
+  region are attached to its polygon at extraction time, and the polygons
+  of each class are built, fixed and simplified in vectorized calls.
   '''
-  seg_classes = np.unique(image)[np.unique(image) != 0]
+  seg_classes = np.unique(image)
+  seg_classes = seg_classes[seg_classes != 0]
   class_list = []
   polygon_list = []
+  image_class = np.empty(image.shape, dtype=np.uint8)
   for seg_class in seg_classes:
-    image_class = image.copy()
-    image_class = (image_class == seg_class).astype(np.uint8)
-    
-    contours, hierarchy = cv2.findContours(image_class, cv2.RETR_TREE, cv2.CHAIN_APPROX_TC89_L1)
-    
-    for contour in contours:
-      if len(contour) > 2:
-        points = []
-        for point in contour:
-          points.append([point[0][0], point[0][1]])
-        poly = shapely.geometry.Polygon(points)
-        # Fix invalid polygons
-        poly = poly.buffer(0)
-        poly = poly.simplify(simplification_distance)
-        
-        if poly.geom_type == 'Polygon':
-          polygon_list.append(poly)
-          class_list.append(seg_class)
-        elif poly.geom_type == 'MultiPolygon':
-          for p in poly.geoms:
-            polygon_list.append(p)
-            class_list.append(seg_class)
-        elif poly.geom_type == 'GeometryCollection':
-          for p in poly.geoms:
-            if p.geom_type == 'Polygon':
-              polygon_list.append(p)
-              class_list.append(seg_class)
-  
+    np.equal(image, seg_class, out=image_class.view(bool))
+
+    contours, hierarchy = cv2.findContours(image_class, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_TC89_L1)
+    polygons = get_contour_polygons(contours, hierarchy)
+    if not len(polygons): continue
+
+    # Fix invalid polygons
+    polygons = shapely.simplify(shapely.buffer(polygons, 0), simplification_distance)
+    parts = shapely.get_parts(polygons)
+    parts = parts[shapely.get_type_id(parts) == shapely.GeometryType.POLYGON]
+
+    polygon_list.extend(parts.tolist())
+    class_list.extend([seg_class] * len(parts))
+
   return class_list, polygon_list
 
+def get_contour_polygons(contours: tuple, hierarchy: np.ndarray):
+  '''Takes the contours and the hierarchy of cv2.findContours() with RETR_CCOMP,
+  and returns an array with a polygon for every outer contour with at least three
+  points, with its inner contours of at least three points as holes.
+  '''
+  if not contours: return np.empty(0, dtype=object)
+
+  parents = hierarchy[0][:, 3]
+  lengths = np.fromiter(map(len, contours), dtype=np.int64, count=len(contours))
+  valid = lengths > 2
+  outer = valid & (parents == -1)
+  inner = valid & (parents != -1)
+  inner[inner] = outer[parents[inner]]
+
+  # Number the polygons by their outer contour, and put every ring after the outer one
+  polygon_ids = np.full(len(contours), -1)
+  polygon_ids[outer] = np.arange(outer.sum())
+  polygon_ids[inner] = polygon_ids[parents[inner]]
+  ring_ids = np.flatnonzero(outer | inner)
+  ring_ids = ring_ids[np.lexsort((~outer[ring_ids], polygon_ids[ring_ids]))]
+
+  coords = np.concatenate([ contours[i] for i in ring_ids ]).reshape(-1, 2)
+  rings = shapely.linearrings(coords, indices=np.repeat(np.arange(len(ring_ids)), lengths[ring_ids]))
+  return shapely.polygons(rings, indices=polygon_ids[ring_ids])
+
 def filter_image(image: np.ndarray, mask: np.ndarray):
   '''Filters an image with a binary or grayscale mask.'''
   mask = (mask != 0).astype(int)
@@ -183,21 +214,23 @@ def filter_image(image: np.ndarray, mask: np.ndarray):
   
   return mask * image
 
-def get_layout(outline, panel_size, azimuth, spacing_factor, border_spacing, offset):
+def get_layout(outline, panel_size, azimuth, spacing_factor, border_spacing, offset, shrunk_outline=None):
   '''
   Takes an outline, a panel size, azimuth, spacing factor,
   minimum space to the border and starting offset for
   the grid, and returns the list of found panels.
+
+  All the cells of the grid are built and rotated at once as
+  coordinate arrays, and tested against the prepared outline
+  with a single vectorized predicate. The outline shrunk by
+  border_spacing can be passed as shrunk_outline to reuse it
+  between calls.
   '''
   panel_width, panel_height = panel_size
   
   cell_width  = panel_width * spacing_factor
   cell_height = panel_height * spacing_factor
 
-  grid_cells = []
-  outter_cells = []
-  panel_cells = []
-
   # get polygon bbox oriented to 0 degrees
   xmin, ymin, xmax, ymax = outline.bounds
   xmin += offset
@@ -208,30 +241,52 @@ def get_layout(outline, panel_size, azimuth, spacing_factor, border_spacing, off
   bbox = shapely.geometry.Polygon([(xmin,ymin),(xmin,ymax),(xmax,ymax),(xmax,ymin),(xmin,ymin)])
 
   # Shrink objective polygon by offset in order to have space in the borders
-  outline = outline.buffer(-border_spacing)
-  for x0 in np.arange(xmin, xmax, cell_width):
-    for y0 in np.arange(ymin, ymax, cell_height):
-      # getting the installation bbox from the grid
-      x1 = x0+cell_width
-      y1 = y0+cell_height
-      new_cell = shapely.geometry.box(x0, y0, x1, y1)
-      new_cell = affinity.rotate(new_cell, -azimuth, origin=bbox.centroid)
-
-      # shrinking the bbox to get the actual panel bbox
-      panel_x0 = x0+((cell_width - panel_width)/2)
-      panel_y0 = y0+((cell_height - panel_height)/2)
-      panel_x1 = panel_x0+panel_width
-      panel_y1 = panel_y0+panel_height
-      panel_cell = shapely.geometry.box(panel_x0, panel_y0, panel_x1, panel_y1)
-      panel_cell = affinity.rotate(panel_cell, -azimuth, origin=bbox.centroid)
-
-      # if the installation space is inside the rooftop, add it
-      if new_cell.within(outline):
-        grid_cells.append(new_cell)
-        panel_cells.append(panel_cell)
-      else:
-        outter_cells.append(new_cell)
-  return panel_cells
+  if shrunk_outline is None:
+    shrunk_outline = outline.buffer(-border_spacing)
+    shapely.prepare(shrunk_outline)
+
+  # grid origins in the same x-major order as the nested loops over the bbox
+  xs = np.arange(xmin, xmax, cell_width)
+  ys = np.arange(ymin, ymax, cell_height)
+  if len(xs) == 0 or len(ys) == 0: return []
+  x0 = np.repeat(xs, len(ys))
+  y0 = np.tile(ys, len(xs))
+
+  # installation cells and the panels centered inside them
+  new_cells = get_rotated_boxes(x0, y0, x0 + cell_width, y0 + cell_height, -azimuth, bbox.centroid)
+  panel_x0 = x0 + ((cell_width - panel_width) / 2)
+  panel_y0 = y0 + ((cell_height - panel_height) / 2)
+  panel_cells = get_rotated_boxes(panel_x0, panel_y0, panel_x0 + panel_width, panel_y0 + panel_height,
+                                  -azimuth, bbox.centroid)
+
+  # if the installation space is inside the rooftop, keep its panel
+  inside = shapely.within(new_cells, shrunk_outline)
+  return panel_cells[inside].tolist()
+
+def get_rotated_boxes(x0, y0, x1, y1, angle, origin):
+  '''
+  Takes arrays of box bounds, an angle in degrees and a
+  shapely.geometry.Point origin, and returns an array of
+  the rotated boxes.
+
+  Vertices follow shapely.geometry.box and the rotation
+  follows shapely.affinity.rotate, so the coordinates are
+  the same as rotating each box on its own.
+  '''
+  angle = angle * np.pi / 180.0
+  cosp = np.cos(angle)
+  sinp = np.sin(angle)
+  if abs(cosp) < 2.5e-16: cosp = 0.0
+  if abs(sinp) < 2.5e-16: sinp = 0.0
+  ox, oy = origin.x, origin.y
+  xoff = ox - ox * cosp + oy * sinp
+  yoff = oy - ox * sinp - oy * cosp
+
+  # (n, 5, 2) counter-clockwise rings, as in shapely.geometry.box
+  x = np.stack([x1, x1, x0, x0, x1], axis=1)
+  y = np.stack([y0, y1, y1, y0, y0], axis=1)
+  coords = np.stack([cosp * x + -sinp * y + xoff, sinp * x + cosp * y + yoff], axis=-1)
+  return shapely.polygons(coords)
 
 def get_panel_layout(outline: shapely.geometry.Polygon,
                      panel_size: tuple,
@@ -253,22 +308,91 @@ def get_panel_layout(outline: shapely.geometry.Polygon,
 
   cell_length  = max(panel_width, panel_height) * spacing_factor
   
+  # the shrunk outline is the same for every offset and orientation
+  shrunk_outline = outline.buffer(-border_spacing)
+  shapely.prepare(shrunk_outline)
+
   panel_cells = []
   for offset in np.arange(0, cell_length, cell_length / n_offset):
-    p_h = get_layout(outline, (panel_width, panel_height), azimuth, spacing_factor, border_spacing, offset)
+    p_h = get_layout(outline, (panel_width, panel_height), azimuth, spacing_factor, border_spacing, offset,
+                     shrunk_outline)
     if len(p_h) > len(panel_cells):
       panel_cells = p_h
-    p_v = get_layout(outline, (panel_height, panel_width), azimuth, spacing_factor, border_spacing, offset)
+    p_v = get_layout(outline, (panel_height, panel_width), azimuth, spacing_factor, border_spacing, offset,
+                     shrunk_outline)
     if len(p_v) > len(panel_cells):
       panel_cells = p_v
 
   return shapely.geometry.MultiPolygon(panel_cells)
 
+def get_panel_layouts(polys_xy_wkb,
+                      panel_sizes,
+                      azimuths,
+                      spacing_factor: float,
+                      border_spacings,
+                      n_offset: int,
+                      img_centers_latlon,
+                      img_shape: tuple,
+                      zoom: int,
+                      n_workers: int = 1,
+                      chunk_size: int = 256
+):
+  '''
+  Takes arrays of WKB outlines in pixel coordinates, with their
+  panel sizes, azimuths, border spacings and image centers, and
+  returns the number of panels and the WKB of the panel layout in
+  latitude and longitude of every outline.
+
+  Outlines are split in chunks of chunk_size and, if n_workers
+  is greater than 1, each chunk is laid out and reprojected in a
+  separate process. Chunks are shipped and the layouts returned as
+  WKB, and the results keep the order of the input.
+  '''
+  n_polys = len(polys_xy_wkb)
+  panel_sizes = np.broadcast_to(np.asarray(panel_sizes, dtype=float), (n_polys, 2))
+  azimuths = np.broadcast_to(np.asarray(azimuths, dtype=float), (n_polys,))
+  border_spacings = np.broadcast_to(np.asarray(border_spacings, dtype=float), (n_polys,))
+  img_centers_latlon = np.broadcast_to(np.asarray(img_centers_latlon, dtype=float).reshape(-1, 2), (n_polys, 2))
+  if n_polys == 0: return np.zeros(0, dtype=int), np.array([], dtype=object)
+
+  chunk_size = max(1, int(chunk_size))
+  chunks = [ (polys_xy_wkb[i:i+chunk_size], panel_sizes[i:i+chunk_size], azimuths[i:i+chunk_size],
+              spacing_factor, border_spacings[i:i+chunk_size], n_offset, img_centers_latlon[i:i+chunk_size],
+              img_shape, zoom)
+             for i in range(0, n_polys, chunk_size) ]
+  if n_workers > 1 and len(chunks) > 1:
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+      results = list(executor.map(get_panel_layouts_chunk, chunks))
+  else:
+    results = [ get_panel_layouts_chunk(chunk) for chunk in chunks ]
+
+  n_panels = np.concatenate([ chunk_n_panels for chunk_n_panels, _ in results ])
+  layouts_wkb = np.concatenate([ chunk_layouts_wkb for _, chunk_layouts_wkb in results ])
+  return n_panels, layouts_wkb
+
+def get_panel_layouts_chunk(chunk: tuple):
+  '''
+  Lays out and reprojects a chunk of outlines, as built
+  by get_panel_layouts. Returns the number of panels and
+  the WKB of the layouts in latitude and longitude.
+  '''
+  (polys_xy_wkb, panel_sizes, azimuths, spacing_factor, border_spacings, n_offset,
+   img_centers_latlon, img_shape, zoom) = chunk
+  polys_xy = shapely.from_wkb(np.asarray(polys_xy_wkb, dtype=object))
+
+  layouts = [ get_panel_layout(poly_xy, tuple(panel_size), azimuth, spacing_factor, border_spacing, n_offset)
+              for poly_xy, panel_size, azimuth, border_spacing in zip(polys_xy, panel_sizes, azimuths, border_spacings) ]
+  n_panels = np.array([ len(layout.geoms) for layout in layouts ], dtype=int)
+
+  layouts_latlon = xy_polys_to_latlon(layouts, img_centers_latlon, img_shape, zoom)
+  layouts_wkb = shapely.to_wkb(layouts_latlon)
+  return n_panels, layouts_wkb
+
 def filter_polygon_holes(classes: list, polygons: list):
   '''
   Given a list of polygons with their corresponding classes,
   it removes those that are contained by others, and adds
-  them as holes.
+  them as holes to the ones they already have.
   '''
   if not polygons: return [], []
 
@@ -283,22 +407,26 @@ def filter_polygon_holes(classes: list, polygons: list):
       clean_polygons.append(polygon)
       clean_classes.append(p_class)
       
-  filter_polygons = []
+  # Pairs (i, j) in which polygon i contains polygon j, in the order of the pairwise loop
+  tree = shapely.STRtree(clean_polygons)
+  containers, contained = tree.query(clean_polygons, predicate='contains')
+  not_self = containers != contained
+  containers, contained = containers[not_self], contained[not_self]
+  order = np.lexsort((contained, containers))
+  containers, contained = containers[order], contained[order]
+  filter_polygons = set(contained.tolist())
+  holes_ends = np.searchsorted(containers, np.arange(len(clean_polygons) + 1))
+
   final_polygons = []
   final_classes = []
-  for i, p_a in enumerate(clean_polygons):
-    holes = []
-    for j, p_b in enumerate(clean_polygons):
-      if i != j:
-        if p_a.contains(p_b):
-          filter_polygons.append(j)
-          holes.append(p_b.exterior.coords)
-    new_poly = shapely.geometry.Polygon(p_a.exterior.coords, holes)
+  for i, (p_a, p_class) in enumerate(zip(clean_polygons, clean_classes)):
+    if i in filter_polygons: continue
+    holes = [ clean_polygons[j].exterior.coords for j in contained[holes_ends[i]:holes_ends[i + 1]] ]
+    new_poly = shapely.geometry.Polygon(p_a.exterior.coords, [ interior.coords for interior in p_a.interiors ] + holes)
     try:
       new_poly = new_poly.buffer(0)
     except:
       pass
     final_polygons.append(new_poly)
-  clean_polygons = [p for i, p in enumerate(final_polygons) if i not in filter_polygons]
-  clean_classes = [c for i, c in enumerate(clean_classes) if i not in filter_polygons]
-  return clean_classes, clean_polygons
\ No newline at end of file
+    final_classes.append(p_class)
+  return final_classes, final_polygons
\ No newline at end of file
@@ -0,0 +1,119 @@
+import passion.buildings.building_analysis
+
+import pathlib
+import numpy as np
+import xarray
+import shapely
+import shapely.geometry
+
+TILT_DISTRIBUTION_PATH = pathlib.Path(__file__).parent / 'data' / 'tilt_distribution.pkl'
+
+class AllPairs:
+  '''Stand-in spatial index returning every geometry as a candidate.'''
+  def __init__(self, geoms):
+    self.n = len(geoms)
+
+  def query(self, geom):
+    return np.arange(self.n)
+
+def random_buildings(rng, n_buildings):
+  '''Random rectangular rooftops split into sections, with small superstructures.'''
+  rooftops, sections, section_classes, supersts, superst_classes = [], [], [], [], []
+  for _ in range(n_buildings):
+    x, y = rng.uniform(0, 1900), rng.uniform(0, 1400)
+    w, h = rng.uniform(20, 80, size=2)
+    rooftops.append(shapely.geometry.box(x, y, x + w, y + h).buffer(rng.uniform(0, 3)))
+    split = x + w * rng.uniform(0.3, 0.7)
+    sections.append(shapely.geometry.box(x - 2, y, split, y + h + 2))
+    sections.append(shapely.geometry.box(split, y - 2, x + w + 2, y + h))
+    section_classes.extend(rng.integers(1, 18, size=2).tolist())
+    for _ in range(rng.integers(0, 4)):
+      sx, sy = rng.uniform(x - 5, x + w), rng.uniform(y - 5, y + h)
+      supersts.append(shapely.geometry.box(sx, sy, sx + rng.uniform(2, 8), sy + rng.uniform(2, 8)))
+      superst_classes.append(int(rng.integers(1, 9)))
+  return rooftops, sections, section_classes, supersts, superst_classes
+
+def merge(rooftops, sections, section_classes, supersts, superst_classes, merge_style):
+  tilt_distribution = passion.util.io.load_pickle(TILT_DISTRIBUTION_PATH)
+  np.random.seed(0)
+  partial_sections = passion.buildings.building_analysis.merge_rooftops_sections(
+    rooftops, sections, section_classes, 0, merge_style, tilt_distribution, (50.77, 6.08), 19)
+  partial_supersts = passion.buildings.building_analysis.merge_superstructures(
+    partial_sections, supersts, superst_classes, (50.77, 6.08), 19)
+  return partial_sections, partial_supersts
+
+def test_merge_spatial_index(monkeypatch):
+  '''Merging with the spatial index must give the same results as testing all pairs.'''
+  rng = np.random.default_rng(0)
+  polygons = random_buildings(rng, 150)
+
+  for merge_style in [ 'union', 'prioritize-rooftops', 'intersection' ]:
+    sections, supersts = merge(*polygons, merge_style)
+    with monkeypatch.context() as m:
+      m.setattr(passion.buildings.building_analysis.shapely, 'STRtree', AllPairs)
+      reference_sections, reference_supersts = merge(*polygons, merge_style)
+
+    assert len(sections) > 150
+    assert list(sections) == list(reference_sections)
+    assert list(supersts) == list(reference_supersts)
+    for results, reference in [ (sections, reference_sections), (supersts, reference_supersts) ]:
+      for k in reference:
+        assert results[k]['polygon_xy'].wkt == reference[k]['polygon_xy'].wkt
+        for attribute in set(reference[k]) - { 'polygon_xy' }:
+          assert results[k][attribute] == reference[k][attribute]
+
+def write_masks(path, rng, n_images):
+  '''Writes random rooftop, section and superstructure masks of several images.'''
+  for folder in [ 'rooftops', 'sections', 'superstructures' ]:
+    (path / folder).mkdir(parents=True)
+  x, y = passion.util.gis.latlon_toXY(50.77, 6.08, 19)
+  for img_i in range(n_images):
+    rooftop_img = np.zeros((200, 300, 1), dtype=np.uint8)
+    section_img = np.zeros((200, 300, 1), dtype=np.uint8)
+    superst_img = np.zeros((200, 300, 1), dtype=np.uint8)
+    for _ in range(10):
+      top, left = rng.integers(0, 160), rng.integers(0, 260)
+      h, w = rng.integers(20, 40, size=2)
+      rooftop_img[top:top+h, left:left+w] = 1
+      section_img[top:top+h, left:left+w//2] = rng.integers(1, 18)
+      section_img[top:top+h, left+w//2:left+w] = rng.integers(1, 18)
+      superst_img[top+5:top+12, left+5:left+12] = rng.integers(1, 9)
+    transform = passion.util.gis.get_gdal_transform([x + 300 * img_i, y + 200, x + 300 * (img_i + 1), y], 300, 200)
+    for folder, img in [ ('rooftops', rooftop_img), ('sections', section_img), ('superstructures', superst_img) ]:
+      passion.util.io.write_geotiff(str(path / folder / '{0}_MASK.tif'.format(img_i)), img, transform,
+                                    '', { 'zoom_level': '19' })
+
+def test_analyze_rooftops_workers(tmp_path):
+  '''Analyzing the images in parallel must give the same output as analyzing them in sequence.'''
+  write_masks(tmp_path, np.random.default_rng(0), 4)
+
+  datasets = []
+  for i, n_workers in enumerate([ 1, 1, 2 ]):
+    passion.buildings.building_analysis.analyze_rooftops(tmp_path / 'rooftops', tmp_path / 'sections',
+                                                         tmp_path / 'superstructures', tmp_path / 'output',
+                                                         'rooftops_{0}'.format(i), TILT_DISTRIBUTION_PATH, 0.2,
+                                                         n_workers=n_workers, seed=0)
+    datasets.append(xarray.open_dataset(str(tmp_path / 'output' / 'rooftops_{0}.nc'.format(i))).load())
+
+  assert datasets[0].sizes['section_id'] > 4
+  assert any(section_id.startswith('i3') for section_id in datasets[0]['section_id'].values)
+  assert (datasets[0]['section_flat'] == 0).any()
+  for ds in datasets[1:]:
+    xarray.testing.assert_identical(datasets[0], ds)
+
+def test_tilt_sampling():
+  '''Batches and inverse CDF tables must follow the tilt distribution, reproducibly with the seed.'''
+  tilt_distribution = passion.util.io.load_pickle(TILT_DISTRIBUTION_PATH)
+  tilt_table = passion.buildings.building_analysis.get_tilt_table(tilt_distribution)
+  assert (np.diff(tilt_table) >= 0).all()
+
+  quantiles = np.linspace(0.05, 0.95, 10)
+  expected = np.quantile(tilt_distribution.resample(100000, seed=np.random.default_rng(1))[0], quantiles)
+  for distribution in [ tilt_distribution, tilt_table ]:
+    tilts = passion.buildings.building_analysis.sample_tilts(distribution, 100000, np.random.default_rng(0))
+    same_tilts = passion.buildings.building_analysis.sample_tilts(distribution, 100000, np.random.default_rng(0))
+    assert tilts.shape == (100000,)
+    assert (tilts == same_tilts).all()
+    np.testing.assert_allclose(np.quantile(tilts, quantiles), expected, atol=0.5)
+
+  assert passion.buildings.building_analysis.sample_tilts(tilt_table, 0, np.random.default_rng(0)).shape == (0,)
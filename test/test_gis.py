@@ -77,4 +77,28 @@ def test_conversions():
     assert passion.util.gis.latlon_toXY(passion.util.gis.MINLAT-1, 0, lvl) == passion.util.gis.latlon_toXY(passion.util.gis.MINLAT, 0, lvl)
     assert passion.util.gis.latlon_toXY(passion.util.gis.MAXLAT+1, 0, lvl) == passion.util.gis.latlon_toXY(passion.util.gis.MAXLAT, 0, lvl)
     assert passion.util.gis.latlon_toXY(0, passion.util.gis.MINLON-1, lvl) == passion.util.gis.latlon_toXY(0, passion.util.gis.MINLON, lvl)
-    assert passion.util.gis.latlon_toXY(0, passion.util.gis.MAXLON+1, lvl) == passion.util.gis.latlon_toXY(0, passion.util.gis.MAXLON, lvl)
\ No newline at end of file
+    assert passion.util.gis.latlon_toXY(0, passion.util.gis.MAXLON+1, lvl) == passion.util.gis.latlon_toXY(0, passion.util.gis.MAXLON, lvl)
+def test_array_conversions():
+  '''
+  Array versions of the GIS functions must match the scalar ones
+  '''
+  random.seed(101)
+
+  lats = [random.uniform(passion.util.gis.MINLAT - 1, passion.util.gis.MAXLAT + 1) for i in range(1000)]
+  lons = [random.uniform(passion.util.gis.MINLON - 1, passion.util.gis.MAXLON + 1) for i in range(1000)]
+
+  for lvl in [1, 10, 19, passion.util.gis.MAXZOOM]:
+    xs, ys = passion.util.gis.latlon_toXY_array(lats, lons, lvl)
+    assert [tuple(p) for p in zip(xs, ys)] == [passion.util.gis.latlon_toXY(lat, lon, lvl) for lat, lon in zip(lats, lons)]
+
+    calc_lats, calc_lons = passion.util.gis.xy_tolatlon_array(xs, ys, lvl)
+    for x, y, calc_lat, calc_lon in zip(xs, ys, calc_lats, calc_lons):
+      assert (calc_lat, calc_lon) == pytest.approx(passion.util.gis.xy_tolatlon(int(x), int(y), lvl), abs=1e-12)
+
+    resolutions = passion.util.gis.ground_resolution_array(lats, lvl)
+    assert list(resolutions) == pytest.approx([passion.util.gis.ground_resolution(lat, lvl) for lat in lats])
+
+    min_lats, min_lons, max_lats, max_lons = passion.util.gis.get_image_bbox_array(lats, lons, lvl, (1475, 2000))
+    for i, (lat, lon) in enumerate(zip(lats, lons)):
+      (min_lat, min_lon), (max_lat, max_lon) = passion.util.gis.get_image_bbox((lat, lon), lvl, (1475, 2000))
+      assert (min_lats[i], min_lons[i], max_lats[i], max_lons[i]) == pytest.approx((min_lat, min_lon, max_lat, max_lon), abs=1e-12)
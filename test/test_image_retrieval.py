@@ -0,0 +1,128 @@
+import passion.satellite.image_retrieval
+
+import io
+import time
+import threading
+import http.server
+import PIL.Image
+import numpy as np
+import pytest
+
+BBOX = ((50.77850739604879, 6.0768084397936395), (50.77014558009357, 6.091035433169415))
+
+class TileHandler(http.server.BaseHTTPRequestHandler):
+  '''Local stand-in for the satellite services, serving random PNG tiles.'''
+  fail = False
+  requests = []
+
+  def do_GET(self):
+    TileHandler.requests.append(self.path)
+    if TileHandler.fail:
+      self.send_error(500)
+      return
+
+    rng = np.random.default_rng(abs(hash(self.path)) % (2 ** 32))
+    width = passion.satellite.image_retrieval.MAX_WIDTH_BING
+    height = passion.satellite.image_retrieval.MAX_HEIGHT_BING
+    img = PIL.Image.fromarray(rng.integers(0, 255, (height, width, 3), dtype=np.uint8))
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+
+    self.send_response(200)
+    self.send_header('Content-Type', 'image/png')
+    self.end_headers()
+    self.wfile.write(buffer.getvalue())
+
+  def log_message(self, format, *args):
+    return
+
+@pytest.fixture
+def tile_server(monkeypatch):
+  '''Starts a local tile server and redirects the service URLs to it.'''
+  server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), TileHandler)
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  TileHandler.fail = False
+  TileHandler.requests = []
+
+  base_url = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+  monkeypatch.setattr(passion.satellite.image_retrieval, 'get_url',
+                      lambda api_key, latlon, zoom, size, service: '{0}/{1},{2}/{3}'.format(base_url, *latlon, zoom))
+  yield base_url
+
+  server.shutdown()
+
+def test_concurrent_retrieval(tile_server, tmp_path):
+  '''Concurrent retrieval must produce the same tiles as the sequential one.'''
+  sequential_path = tmp_path / 'sequential'
+  concurrent_path = tmp_path / 'concurrent'
+
+  passion.satellite.image_retrieval.generate_dataset('', 'bing', sequential_path, zoom=19, bbox=BBOX)
+  passion.satellite.image_retrieval.generate_dataset('', 'bing', concurrent_path, zoom=19, bbox=BBOX,
+                                                     max_workers=4, requests_per_second=50)
+
+  sequential_tiles = sorted(p.name for p in sequential_path.glob('*.tif'))
+  concurrent_tiles = sorted(p.name for p in concurrent_path.glob('*.tif'))
+
+  assert len(sequential_tiles) > 1
+  assert sequential_tiles == concurrent_tiles
+  for name in sequential_tiles:
+    sequential_img = passion.util.io.read_geotiff(sequential_path / name).ReadAsArray()
+    concurrent_img = passion.util.io.read_geotiff(concurrent_path / name).ReadAsArray()
+    assert (sequential_img == concurrent_img).all()
+
+def test_rate_limiter():
+  '''Requests must be spaced out by the limiter interval.'''
+  rate_limiter = passion.satellite.image_retrieval.RateLimiter(requests_per_second=20)
+
+  start = time.monotonic()
+  for i in range(6):
+    rate_limiter.wait()
+  elapsed = time.monotonic() - start
+
+  assert elapsed >= 5 / 20 * 0.9
+
+def test_resume_retrieval(tile_server, tmp_path):
+  '''A second run must only retrieve the tiles that are missing, modified or failed.'''
+  output_path = tmp_path / 'satellite'
+
+  TileHandler.fail = True
+  passion.satellite.image_retrieval.generate_dataset('', 'bing', output_path, zoom=19, bbox=BBOX)
+  manifest_path = output_path / passion.satellite.image_retrieval.get_manifest_name(19)
+  tiles = passion.satellite.image_retrieval.load_manifest(manifest_path)
+  assert len(tiles) > 1
+  assert all(tile['status'] == 'failed' for tile in tiles)
+  assert list(output_path.glob('*.tif')) == []
+
+  TileHandler.fail = False
+  passion.satellite.image_retrieval.generate_dataset('', 'bing', output_path, zoom=19, bbox=BBOX)
+  tiles = passion.satellite.image_retrieval.load_manifest(manifest_path)
+  assert all(tile['status'] == 'done' for tile in tiles)
+  assert len(list(output_path.glob('*.tif'))) == len(tiles)
+
+  # Remove one tile and modify another one
+  (output_path / tiles[0]['filename']).unlink()
+  with open(output_path / tiles[1]['filename'], 'ab') as f:
+    f.write(b'0')
+
+  TileHandler.requests = []
+  passion.satellite.image_retrieval.generate_dataset('', 'bing', output_path, zoom=19, bbox=BBOX)
+  assert len(TileHandler.requests) == 2
+
+def test_plan_tiles_shapefile():
+  '''Tiles selected in the planning stage must be the ones intersecting the shapefile.'''
+  zoom = 19
+  size = (passion.satellite.image_retrieval.MAX_WIDTH_BING, passion.satellite.image_retrieval.MAX_HEIGHT_BING)
+  watermark = passion.satellite.image_retrieval.WATERMARK_BING
+  (lat1, lon1), (lat2, lon2) = BBOX
+  triangle = [ (lat1, lon1), (lat2, lon1), (lat2, lon2) ]
+  shapefile_pixels = [ passion.util.gis.latlon_toXY(lat, lon, zoom) for lat, lon in triangle ]
+
+  tiles = passion.satellite.image_retrieval.plan_tiles(BBOX, zoom, size, watermark, shapefile_pixels)
+
+  for tile in tiles:
+    x, y = tile['x'], tile['y']
+    image_bbox = [ (x, y), (x, y + size[1]), (x + size[0], y + size[1]), (x + size[0], y) ]
+    intersects = passion.util.gis.polygons_intersect(shapefile_pixels, image_bbox)
+    assert (tile['status'] != 'outside') == intersects
+  assert any(tile['status'] == 'outside' for tile in tiles)
@@ -6,6 +6,8 @@ import random
 import pathlib
 import shutil
 import numpy as np
+import shapely
+import xarray
 
 
 def test_image():
@@ -44,3 +46,42 @@ def test_csv():
   shutil.rmtree(tmp_path)
   
   assert dicts == loaded_csv
+
+def test_geometries(tmp_path):
+  '''Geometries stored as WKB blobs must be read back unchanged, also after
+  selecting positions and merging with a longer dimension.
+  '''
+  geometries = [
+    shapely.Polygon([(0, 0), (1, 0), (1, 1)], holes=[[(0.5, 0.2), (0.8, 0.2), (0.8, 0.5)]]),
+    shapely.MultiPolygon([shapely.box(0, 0, 1, 1), shapely.box(2, 2, 3, 3)]),
+    shapely.GeometryCollection(),
+    shapely.Point(0.1234567890123, 9.8765432109876)
+  ]
+  ds = xarray.Dataset(passion.util.io.encode_geometries(geometries, 'section_id', 'section_wkb'),
+                      coords={ 'section_id': np.arange(len(geometries)) })
+  ds.to_netcdf(tmp_path / 'geometries.nc')
+  with xarray.open_dataset(tmp_path / 'geometries.nc') as loaded_ds:
+    decoded = passion.util.io.decode_geometries(loaded_ds, 'section_wkb')
+  assert all(shapely.equals_exact(decoded, geometries, tolerance=0) | shapely.is_empty(geometries))
+  assert shapely.is_empty(decoded[2])
+
+  selected_ds = passion.util.io.isel_geometries(ds, 'section_id', [3, 0])
+  assert list(passion.util.io.decode_geometries(selected_ds, 'section_wkb')) == [ geometries[3], geometries[0] ]
+
+  reordered_ds = ds.isel(section_id=[3, 0])
+  assert list(passion.util.io.decode_geometries(reordered_ds, 'section_wkb')) == [ geometries[3], geometries[0] ]
+
+  padded_ds = xarray.merge([selected_ds, xarray.Dataset(coords={ 'section_id': np.arange(5) })], join='outer')
+  decoded = passion.util.io.decode_geometries(padded_ds, 'section_wkb')
+  assert list(decoded) == [ geometries[0], None, None, geometries[3], None ]
+  selected_ds = passion.util.io.isel_geometries(padded_ds, 'section_id', [1, 3])
+  assert list(passion.util.io.decode_geometries(selected_ds, 'section_wkb')) == [ None, geometries[3] ]
+
+  renamed_ds = passion.util.io.rename_geometries(ds, { name: name.replace('section_', 'filtered_')
+                                                       for name in list(ds.variables) + list(ds.dims) })
+  assert renamed_ds.filtered_wkb.attrs['offsets'] == 'filtered_wkb_offset'
+  assert renamed_ds.filtered_wkb.attrs['lengths'] == 'filtered_wkb_length'
+  assert 'section_' not in renamed_ds.filtered_wkb_offset.attrs['description']
+  assert ds.section_wkb.attrs['offsets'] == 'section_wkb_offset'
+  assert list(passion.util.io.decode_geometries(renamed_ds, 'filtered_wkb')) == \
+         list(passion.util.io.decode_geometries(ds, 'section_wkb'))
@@ -0,0 +1,66 @@
+import passion.economic.lcoe
+
+import numpy as np
+import xarray
+
+def calculate_lcoe_reference(generation, capacity, modules_cost, lcoe_params):
+  '''Year by year LCOE.'''
+  inverter_price = lcoe_params['inverter_price_rate'] * capacity
+  initial_investment = modules_cost + inverter_price + lcoe_params['other_costs']
+  maintenance_costs = 0
+  total_generation = 0
+  for year in range(0, int(lcoe_params['panel_lifespan'])):
+    maintenance_costs += 0.01 * initial_investment / ((1 + lcoe_params['discount_rate']) ** year)
+    if year == lcoe_params['inverter_lifespan']:
+      maintenance_costs += inverter_price
+    total_generation += generation - (lcoe_params['yearly_degradation'] ** year) / ((1 + lcoe_params['discount_rate']) ** year)
+  return (initial_investment + maintenance_costs) / total_generation * 1000 * 1000
+
+def test_calculate_lcoe():
+  '''
+  Closed-form LCOE must match the year by year LCOE
+  '''
+  rng = np.random.default_rng(0)
+  generation = xarray.DataArray(rng.uniform(1000, 50000, 20), dims='location')
+  capacity = xarray.DataArray(rng.uniform(370, 3700, 20), dims='location')
+  modules_cost = xarray.DataArray(rng.uniform(350, 3500, 20), dims='location')
+
+  default_params = passion.economic.lcoe.DEFAULT_LCOE_PARAMS
+  for lcoe_params in [ default_params,
+                       { **default_params, 'discount_rate': 0 },
+                       { **default_params, 'panel_lifespan': 10 },
+                       { **default_params, 'inverter_lifespan': 12.5 } ]:
+    lcoe = passion.economic.lcoe.calculate_lcoe(generation, capacity, modules_cost, lcoe_params)
+    expected = calculate_lcoe_reference(generation, capacity, modules_cost, lcoe_params)
+    np.testing.assert_allclose(lcoe, expected, rtol=1e-12)
+
+def test_generate_economic_scenarios(tmp_path):
+  '''
+  Every scenario of the LCOE cube must match the LCOE of its parameters
+  '''
+  rng = np.random.default_rng(1)
+  n_panels = rng.integers(1, 20, 10)
+  technical_ds = xarray.Dataset({
+    'section_yearly_system_generation': ('location', rng.uniform(1000, 50000, 10)),
+    'section_capacity': ('location', n_panels * 370.),
+    'section_n_panels': ('location', n_panels),
+    'section_modules_cost': ('location', n_panels * 350.)
+  })
+  technical_ds.to_netcdf(str(tmp_path / 'technical.nc'))
+
+  scenarios = { 'discount_rate': [ 0.04, 0.08 ], 'panel_lifespan': [ 20, 25, 30 ], 'module_price': [ 250, 350 ] }
+  passion.economic.lcoe.generate_economic_scenarios(tmp_path / 'technical.nc', tmp_path, 'scenarios', scenarios)
+
+  with xarray.open_dataset(str(tmp_path / 'scenarios.nc')) as scenarios_ds:
+    assert scenarios_ds.section_lcoe.dims == ('location', 'scenario')
+    assert scenarios_ds.sizes['scenario'] == 12
+    for i in range(scenarios_ds.sizes['scenario']):
+      scenario = scenarios_ds.isel(scenario=i)
+      lcoe_params = { **passion.economic.lcoe.DEFAULT_LCOE_PARAMS,
+                      'discount_rate': scenario.discount_rate.item(),
+                      'panel_lifespan': scenario.panel_lifespan.item() }
+      expected = calculate_lcoe_reference(technical_ds.section_yearly_system_generation.values,
+                                          technical_ds.section_capacity.values,
+                                          n_panels * scenario.module_price.item(),
+                                          lcoe_params)
+      np.testing.assert_allclose(scenario.section_lcoe.values, expected, rtol=1e-12)
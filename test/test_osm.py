@@ -0,0 +1,181 @@
+import passion.segmentation.osm
+
+import json
+import pytest
+import numpy as np
+import shapely.geometry
+
+CENTER_LATLON = (50.77, 6.08)
+ZOOM = 19
+TILE_SIZE = 256
+
+def write_tiles(path, n_rows, n_cols):
+  '''Writes a grid of blank satellite tiles around CENTER_LATLON, returning their bounding boxes.'''
+  path.mkdir(parents=True)
+  center_x, center_y = passion.util.gis.latlon_toXY(*CENTER_LATLON, ZOOM)
+  bboxes = []
+  for row in range(n_rows):
+    for col in range(n_cols):
+      x0, y0 = center_x + col * TILE_SIZE, center_y + row * TILE_SIZE
+      transform = passion.util.gis.get_gdal_transform([x0, y0 + TILE_SIZE, x0 + TILE_SIZE, y0], TILE_SIZE, TILE_SIZE)
+      latlon = passion.util.gis.xy_tolatlon(x0 + TILE_SIZE // 2, y0 + TILE_SIZE // 2, ZOOM)
+      passion.util.io.write_geotiff(str(path / passion.util.gis.get_filename(latlon, ZOOM, 'tif')),
+                                    np.zeros((TILE_SIZE, TILE_SIZE, 3), dtype=np.uint8), transform,
+                                    passion.util.gis.get_gdal_projection(epsg=3857), {'zoom_level': str(ZOOM)})
+      bboxes.append(passion.util.gis.get_image_bbox(latlon, ZOOM, (TILE_SIZE, TILE_SIZE)))
+  return bboxes
+
+def write_overpass_response(path, bboxes, rng, n_buildings):
+  '''Writes an Overpass JSON response with random rectangular buildings over the tiles.'''
+  min_lat = min(min(lat1, lat2) for (lat1, _), (lat2, _) in bboxes)
+  max_lat = max(max(lat1, lat2) for (lat1, _), (lat2, _) in bboxes)
+  min_lon = min(min(lon1, lon2) for (_, lon1), (_, lon2) in bboxes)
+  max_lon = max(max(lon1, lon2) for (_, lon1), (_, lon2) in bboxes)
+  elements = []
+  for way_id in range(n_buildings):
+    lat, lon = rng.uniform(min_lat, max_lat), rng.uniform(min_lon, max_lon)
+    dlat, dlon = rng.uniform(0.00005, 0.0002, size=2)
+    node_ids = []
+    for node_lat, node_lon in [ (lat, lon), (lat + dlat, lon), (lat + dlat, lon + dlon), (lat, lon + dlon) ]:
+      node_ids.append(len(elements) + 1000)
+      elements.append({ 'type': 'node', 'id': node_ids[-1], 'lat': node_lat, 'lon': node_lon })
+    elements.append({ 'type': 'way', 'id': way_id, 'nodes': node_ids + node_ids[:1], 'tags': { 'building': 'yes' } })
+  with open(path, 'w') as f:
+    json.dump({ 'elements': elements }, f)
+
+def load_masks(path):
+  return { p.name: passion.util.io.read_geotiff(p).ReadAsArray() for p in sorted(path.glob('*_MASK.tif')) }
+
+def test_osm_cache(tmp_path, monkeypatch):
+  '''Masks rasterized from the region cache must match the ones requested per image,
+  with a request per chunk and none once the chunks are cached.
+  '''
+  rng = np.random.default_rng(0)
+  bboxes = write_tiles(tmp_path / 'satellite', 2, 3)
+  response_path = tmp_path / 'overpass.json'
+  write_overpass_response(response_path, bboxes, rng, 40)
+  overpass_url = f'file://{response_path}'
+
+  requests = []
+  request_overpass = passion.util.osm.request_overpass
+  def counted_request_overpass(*args, **kwargs):
+    requests.append(args[0])
+    return request_overpass(*args, **kwargs)
+  monkeypatch.setattr(passion.util.osm, 'request_overpass', counted_request_overpass)
+
+  passion.segmentation.osm.generate_osm(tmp_path / 'satellite', tmp_path / 'per_image', overpass_url=overpass_url)
+  assert len(requests) == len(bboxes)
+
+  requests.clear()
+  cache_path = tmp_path / 'osm' / 'footprints.sqlite'
+  passion.segmentation.osm.generate_osm(tmp_path / 'satellite', tmp_path / 'cached', osm_cache_path=cache_path,
+                                        osm_chunk_size=0.005, overpass_url=overpass_url)
+  n_chunks = len(requests)
+  assert 0 < n_chunks < len(bboxes)
+
+  per_image_masks = load_masks(tmp_path / 'per_image')
+  cached_masks = load_masks(tmp_path / 'cached')
+  assert list(per_image_masks) == list(cached_masks)
+  assert any(mask.any() for mask in cached_masks.values())
+  for name in per_image_masks:
+    assert (per_image_masks[name] == cached_masks[name]).all()
+
+  # Every chunk is cached, so no requests are sent, even without the stand-in
+  requests.clear()
+  response_path.unlink()
+  passion.segmentation.osm.generate_osm(tmp_path / 'satellite', tmp_path / 'cached_again', osm_cache_path=cache_path,
+                                        osm_chunk_size=0.005, overpass_url=overpass_url)
+  assert requests == []
+  cached_again_masks = load_masks(tmp_path / 'cached_again')
+  for name in cached_masks:
+    assert (cached_masks[name] == cached_again_masks[name]).all()
+
+def test_get_buildings():
+  '''Ways assembled from the node index must match the linear lookup of every node.'''
+  rng = np.random.default_rng(0)
+  nodes = [ { 'type': 'node', 'id': int(i), 'lat': float(lat), 'lon': float(lon) }
+            for i, lat, lon in zip(rng.permutation(10**6)[:500], rng.uniform(50, 51, 500), rng.uniform(6, 7, 500)) ]
+  ways = []
+  for way_id in range(100):
+    way_nodes = [ node['id'] for node in rng.choice(nodes, rng.integers(3, 10)) ]
+    ways.append({ 'type': 'way', 'id': way_id, 'nodes': way_nodes + way_nodes[:1] })
+
+  buildings = passion.util.osm.get_buildings(ways, nodes)
+  reference = [ [ next((node['lat'], node['lon']) for node in nodes if node['id'] == id) for id in way['nodes'] ]
+                for way in ways ]
+
+  assert buildings == reference
+  assert passion.util.osm.get_way_coords(ways[0]['nodes'], nodes) == reference[0]
+  with pytest.raises(KeyError):
+    passion.util.osm.get_buildings([ { 'type': 'way', 'id': 0, 'nodes': [ -1 ] } ], nodes)
+
+def test_match_osm_buildings(tmp_path):
+  '''Rooftops must be matched with the buildings they overlap, with the
+  nearest ones within the distance, and with none further away.
+  '''
+  lat, lon = CENTER_LATLON
+  meter_lat, meter_lon = 1 / 110574, 1 / (111320 * np.cos(np.radians(lat)))
+  elements = []
+  for way_id in range(3):
+    building_lon = lon + way_id * 100 * meter_lon
+    node_ids = []
+    for node_lat, node_lon in [ (lat, building_lon), (lat + 10 * meter_lat, building_lon),
+                                (lat + 10 * meter_lat, building_lon + 10 * meter_lon), (lat, building_lon + 10 * meter_lon) ]:
+      node_ids.append(len(elements) + 1000)
+      elements.append({ 'type': 'node', 'id': node_ids[-1], 'lat': node_lat, 'lon': node_lon })
+    elements.append({ 'type': 'way', 'id': way_id, 'nodes': node_ids + node_ids[:1], 'tags': { 'building': 'yes' } })
+  response_path = tmp_path / 'overpass.json'
+  with open(response_path, 'w') as f:
+    json.dump({ 'elements': elements }, f)
+
+  def box(lat0, lon0, size):
+    return shapely.geometry.box(lat0, lon0, lat0 + size * meter_lat, lon0 + size * meter_lon)
+  rooftops = [
+    box(lat + 2 * meter_lat, lon + 2 * meter_lon, 6),                        # Inside building 0
+    box(lat + 2 * meter_lat, lon + 105 * meter_lon, 10),                     # Overlapping building 1
+    box(lat + 2 * meter_lat, lon + 200 * meter_lon + 30 * meter_lon, 5),     # 20 meters east of building 2
+    box(lat + 500 * meter_lat, lon, 5)                                       # Far from every building
+  ]
+
+  matches = passion.util.osm.match_osm_buildings(rooftops, tmp_path / 'footprints.sqlite', distance=50,
+                                                 chunk_size=0.01, overpass_url=f'file://{response_path}')
+
+  assert matches['osm_way_id'].tolist()[:3] == [ 0, 1, 2 ]
+  assert matches['osm_way_id'].isna().tolist() == [ False, False, False, True ]
+  assert matches['n_intersecting'].tolist() == [ 1, 1, 0, 0 ]
+  assert matches['distance'].tolist()[:2] == [ 0, 0 ]
+  assert matches['distance'][2] == pytest.approx(20, rel=0.02)
+
+def test_osm_cache_remark(tmp_path, monkeypatch):
+  '''Incomplete Overpass responses must not be cached, and must be requested again in quarters.'''
+  rng = np.random.default_rng(1)
+  lat, lon = CENTER_LATLON
+  bbox = ((lat, lon), (lat + 0.01, lon + 0.01))
+  response_path = tmp_path / 'overpass.json'
+  write_overpass_response(response_path, [ bbox ], rng, 30)
+  overpass_url = f'file://{response_path}'
+  cache_path = tmp_path / 'footprints.sqlite'
+
+  # Overpass runs out of memory for every query
+  request_overpass = passion.util.osm.request_overpass
+  def failing_request_overpass(*args, **kwargs):
+    return { **request_overpass(*args, **kwargs), 'remark': 'runtime error: out of memory' }
+  monkeypatch.setattr(passion.util.osm, 'request_overpass', failing_request_overpass)
+  passion.util.osm.build_footprints_cache([ bbox ], cache_path, chunk_size=0.02, overpass_url=overpass_url)
+  with passion.util.osm.open_footprints_cache(cache_path) as connection:
+    assert connection.execute('SELECT COUNT(*) FROM chunks').fetchone()[0] == 0
+    assert connection.execute('SELECT COUNT(*) FROM footprints').fetchone()[0] == 0
+
+  # Overpass only answers queries of up to a quarter of a chunk
+  queries = []
+  def split_request_overpass(overpass_query, *args, **kwargs):
+    queries.append(overpass_query)
+    results = request_overpass(overpass_query, *args, **kwargs)
+    if len(queries) % 5 == 1: results['remark'] = 'runtime error: query timed out'
+    return results
+  monkeypatch.setattr(passion.util.osm, 'request_overpass', split_request_overpass)
+  passion.util.osm.build_footprints_cache([ bbox ], cache_path, chunk_size=0.02, overpass_url=overpass_url)
+  with passion.util.osm.open_footprints_cache(cache_path) as connection:
+    n_chunks = connection.execute('SELECT COUNT(*) FROM chunks').fetchone()[0]
+  assert len(queries) == 5 * n_chunks
+  assert sorted(passion.util.osm.query_footprints_cache(bbox, cache_path)[0]) == list(range(30))
@@ -0,0 +1,251 @@
+import passion.segmentation.prediction
+
+import concurrent.futures
+import os
+
+import numpy as np
+import cv2
+import torch
+import torchvision
+
+class TinyModel(torch.nn.Module):
+  '''Small convolutional stand-in for the segmentation models.'''
+  def __init__(self, n_classes=3):
+    super().__init__()
+    torch.manual_seed(0)
+    self.conv = torch.nn.Conv2d(3, n_classes, 3, padding=1)
+
+  def forward(self, x):
+    return self.conv(x)
+
+def predict_unbatched(tile, model, background_class):
+  '''Reference single-tile prediction with torchvision's ToTensor.'''
+  tile = torchvision.transforms.ToTensor()(np.ascontiguousarray(tile[..., ::-1]))
+  pred = torch.argmax(model(tile[np.newaxis, ...]), dim=1).detach().numpy().squeeze()
+  rooftop_pred = pred.copy()
+  if background_class != 0:
+    rooftop_pred[pred==background_class] = 0
+    rooftop_pred[pred!=background_class] = (rooftop_pred[pred!=background_class] + 1)
+  return rooftop_pred
+
+def test_batched_prediction():
+  '''Batched predictions must match the tile by tile predictions.'''
+  rng = np.random.default_rng(0)
+  tile_size, background_class = 32, 2
+  model, device = passion.segmentation.prediction.prepare_model(TinyModel(), 'cpu')
+  images = [ rng.integers(0, 255, (70, 90, 3), dtype=np.uint8),
+             rng.integers(0, 255, (40, 33, 3), dtype=np.uint8) ]
+
+  seg_images = passion.segmentation.prediction.segment_imgs(images, model, tile_size, tile_size,
+                                                            background_class, batch_size=5, device=device)
+
+  for image, seg_image in zip(images, seg_images):
+    tiles = passion.segmentation.prediction.divide_img_tiles(image, tile_size, tile_size)
+    reference = np.array([ predict_unbatched(tile, model, background_class) for tile in tiles ])
+    reference = passion.segmentation.prediction.compose_tiles(reference, image.shape[:2], tile_size)
+    assert seg_image.shape == image.shape[:2]
+    assert (seg_image == reference).all()
+
+    single = passion.segmentation.prediction.segment_img(image, model, tile_size, tile_size,
+                                                         background_class, batch_size=1)
+    assert (single == seg_image).all()
+
+def write_dataset(input_path, n_images):
+  '''Writes random images as a dataset to be segmented.'''
+  rng = np.random.default_rng(0)
+  input_path.mkdir()
+  for i in range(n_images):
+    image = rng.integers(0, 255, (70, 90, 3), dtype=np.uint8)
+    passion.util.io.write_geotiff(str(input_path / '{0}.tif'.format(i)), image,
+                                  [0, 1, 0, 0, 0, -1], '', {})
+
+def assert_same_masks(path_a, path_b, n_images):
+  '''Asserts that two folders contain the same segmented masks.'''
+  names = sorted(p.name for p in path_a.glob('*_MASK.tif'))
+  assert names == sorted(p.name for p in path_b.glob('*_MASK.tif'))
+  assert len(names) == n_images
+  for name in names:
+    mask_a = passion.util.io.read_geotiff(path_a / name).ReadAsArray()
+    mask_b = passion.util.io.read_geotiff(path_b / name).ReadAsArray()
+    assert (mask_a == mask_b).all()
+
+def test_segment_dataset_multi(tmp_path):
+  '''A single pass with several models must write the same masks as one pass per model.'''
+  input_path = tmp_path / 'satellite'
+  write_dataset(input_path, 2)
+
+  models = [ TinyModel(3), TinyModel(5) ]
+  background_classes = [ 0, 4 ]
+  single_paths = [ tmp_path / 'single' / str(i) for i in range(len(models)) ]
+  multi_paths = [ tmp_path / 'multi' / str(i) for i in range(len(models)) ]
+
+  for model, output_path, background_class in zip(models, single_paths, background_classes):
+    passion.segmentation.prediction.segment_dataset(input_path, model, output_path, background_class,
+                                                    tile_size=32, stride=32, opening_closing_kernel=1,
+                                                    erosion_kernel=1)
+  passion.segmentation.prediction.segment_dataset_multi(input_path, models, multi_paths, background_classes,
+                                                        tile_size=32, stride=32, opening_closing_kernels=[1, 1],
+                                                        erosion_kernels=[1, 1], batch_size=3)
+
+  for single_path, multi_path in zip(single_paths, multi_paths):
+    assert_same_masks(single_path, multi_path, 2)
+
+def test_segment_dataset_pipelined(tmp_path):
+  '''The pipelined mode must write the same masks as the sequential one.'''
+  input_path = tmp_path / 'satellite'
+  write_dataset(input_path, 5)
+  model = TinyModel(4)
+  kwargs = dict(tile_size=32, stride=32, opening_closing_kernel=3, erosion_kernel=1, batch_size=4)
+
+  passion.segmentation.prediction.segment_dataset(input_path, model, tmp_path / 'sequential', 1, **kwargs)
+  passion.segmentation.prediction.segment_dataset(input_path, model, tmp_path / 'pipelined', 1,
+                                                  pipelined=True, images_per_batch=2, num_readers=2,
+                                                  num_workers=2, queue_size=2, **kwargs)
+
+  assert_same_masks(tmp_path / 'sequential', tmp_path / 'pipelined', 5)
+  passion.segmentation.prediction.segment_dataset(input_path, model, tmp_path / 'pipelined_threads', 1,
+                                                  pipelined=True, num_workers=2, num_threads=3, **kwargs)
+  assert_same_masks(tmp_path / 'sequential', tmp_path / 'pipelined_threads', 5)
+
+  models = [ TinyModel(3), TinyModel(5) ]
+  multi_paths = [ tmp_path / 'multi' / str(i) for i in range(len(models)) ]
+  passion.segmentation.prediction.segment_dataset_multi(input_path, models, multi_paths, [0, 4],
+                                                        tile_size=32, stride=32, pipelined=True, queue_size=1)
+  for model, multi_path, background_class in zip(models, multi_paths, [0, 4]):
+    single_path = tmp_path / 'single' / multi_path.name
+    passion.segmentation.prediction.segment_dataset(input_path, model, single_path, background_class,
+                                                    tile_size=32, stride=32)
+    assert_same_masks(single_path, multi_path, 5)
+
+def test_overlapping_probabilities():
+  '''Overlapping tiles must average their class probabilities weighted by the window.'''
+  rng = np.random.default_rng(0)
+  tile_size, stride, background_class = 32, 16, 1
+  model, device = passion.segmentation.prediction.prepare_model(TinyModel(4), 'cpu')
+  image = rng.integers(0, 255, (50, 70, 3), dtype=np.uint8)
+
+  for blending in [ 'gaussian', 'cosine', 'uniform' ]:
+    seg_image = passion.segmentation.prediction.segment_img(image, model, tile_size, stride, background_class,
+                                                            batch_size=3, blending=blending)
+
+    window = passion.segmentation.prediction.get_blending_window(tile_size, blending)
+    tiles = passion.segmentation.prediction.divide_img_tiles(image, tile_size, stride)
+    positions = passion.segmentation.prediction.get_tile_positions(image.shape, stride)
+    probs = np.zeros((4,) + image.shape[:2])
+    for (y, x), tile in zip(positions, tiles):
+      tile_probs = torch.softmax(model(passion.segmentation.prediction.tiles_to_tensor(tile[np.newaxis], 'cpu')), dim=1)
+      tile_probs = tile_probs.detach().numpy()[0] * window
+      h, w = probs[:, y:y+tile_size, x:x+tile_size].shape[1:]
+      probs[:, y:y+h, x:x+w] += tile_probs[:, :h, :w]
+    reference = passion.segmentation.prediction.remap_background(np.argmax(probs, axis=0), background_class)
+
+    assert seg_image.shape == image.shape[:2]
+    assert (seg_image == reference).all()
+
+def test_compose_tiles_votes():
+  '''Overlapping tiles must be merged by the weighted majority of votes.'''
+  tile_size, stride = 4, 2
+  img_shape = (6, 6)
+  positions = passion.segmentation.prediction.get_tile_positions(img_shape, stride)
+  tiles = np.array([ np.full((tile_size, tile_size), 2 if (y, x) == (2, 2) else 1) for y, x in positions ])
+  window = passion.segmentation.prediction.get_blending_window(tile_size, 'uniform')
+
+  seg_image = passion.segmentation.prediction.compose_tiles(tiles, img_shape, stride, window)
+
+  # Pixels in (2:4, 2:4) are predicted by four tiles, only one of them voting for class 2
+  assert (seg_image == 1).all()
+
+  pasted = passion.segmentation.prediction.compose_tiles(tiles, img_shape, stride)
+  assert (pasted[2:4, 2:4] == 2).all()
+  assert (pasted[4:, 4:] == 1).all()
+  assert pasted.shape == img_shape
+
+  tiles = np.array([ np.full((tile_size, tile_size), i) for i in range(len(positions)) ])
+  pasted = passion.segmentation.prediction.compose_tiles(tiles, img_shape, tile_size)
+  assert (pasted[:4, :4] == 0).all() and (pasted[4:, 4:] == 3).all()
+
+def test_divide_img_tiles():
+  '''Tiles must match the ones padded one by one, being views of the padded image.'''
+  rng = np.random.default_rng(0)
+  image = rng.integers(0, 255, (45, 70, 3), dtype=np.uint8)
+
+  for tile_size, stride in [ (16, 16), (16, 8), (16, 20), (32, 32), (64, 64) ]:
+    reference = []
+    for h in range(0, image.shape[0], stride):
+      for w in range(0, image.shape[1], stride):
+        i = image[h:h+tile_size, w:w+tile_size]
+        reference.append(np.pad(i, ((0, tile_size - i.shape[0]), (0, tile_size - i.shape[1]), (0, 0))))
+
+    tiles = passion.segmentation.prediction.divide_img_tiles(image, tile_size, stride)
+    views = passion.segmentation.prediction.get_tile_views(image, tile_size, stride)
+
+    assert (tiles == np.array(reference)).all()
+    assert views.shape[:2] == (-(-image.shape[0] // stride), -(-image.shape[1] // stride))
+    assert not views.flags.writeable and not views.flags.owndata
+
+def test_postprocess_executor_per_dataset(tmp_path, monkeypatch):
+  '''The classes of every image must be post processed in a single pool per dataset, or serially.'''
+  input_path = tmp_path / 'satellite'
+  write_dataset(input_path, 3)
+  model = TinyModel(4)
+  kwargs = dict(tile_size=32, stride=32, opening_closing_kernel=1, erosion_kernel=1)
+
+  pools = []
+  class CountedThreadPoolExecutor(concurrent.futures.ThreadPoolExecutor):
+    def __init__(self, *args, **kwargs):
+      pools.append(self)
+      super().__init__(*args, **kwargs)
+  monkeypatch.setattr(concurrent.futures, 'ThreadPoolExecutor', CountedThreadPoolExecutor)
+  monkeypatch.setattr(os, 'cpu_count', lambda: 16)
+
+  for num_threads, expected in [ (None, 1), (1, 0), (2, 1) ]:
+    pools.clear()
+    passion.segmentation.prediction.segment_dataset(input_path, model, tmp_path / f'sequential_{num_threads}', 1,
+                                                    num_threads=num_threads, **kwargs)
+    assert len(pools) == expected
+    pools.clear()
+    passion.segmentation.prediction.segment_dataset_multi(input_path, [ model ], [ tmp_path / f'multi_{num_threads}' ],
+                                                          [ 1 ], tile_size=32, stride=32, opening_closing_kernels=[ 1 ],
+                                                          erosion_kernels=[ 1 ], num_threads=num_threads)
+    assert len(pools) == expected
+    pools.clear()
+    # The pipelined mode also has its pool of workers
+    passion.segmentation.prediction.segment_dataset(input_path, model, tmp_path / f'pipelined_{num_threads}', 1,
+                                                    pipelined=True, num_workers=2, num_threads=num_threads, **kwargs)
+    assert len(pools) == 1 + (0 if num_threads is None else expected)
+
+def postprocess_reference(image, opening_closing_kernel, erosion_kernel, background_class):
+  '''Class by class postprocessing over the full image.'''
+  out_image = np.full(image.shape, background_class)
+  opening_closing_kernel = np.ones((opening_closing_kernel, opening_closing_kernel), np.uint8)
+  erosion_kernel = np.ones((erosion_kernel, erosion_kernel), np.uint8)
+  for seg_class in np.unique(image)[np.unique(image) != background_class]:
+    image_class = (image == seg_class).astype(np.uint8)
+    image_class = cv2.morphologyEx(image_class, cv2.MORPH_OPEN, opening_closing_kernel)
+    image_class = cv2.morphologyEx(image_class, cv2.MORPH_CLOSE, opening_closing_kernel)
+    image_class = cv2.erode(image_class, erosion_kernel)
+    out_image[image_class == 1] = seg_class
+  return out_image
+
+def test_postprocess_output():
+  '''Postprocessing every class in its bounding box must not change the output.'''
+  rng = np.random.default_rng(0)
+  for num_classes, background_class, opening_closing_kernel, erosion_kernel in [ (2, 0, 7, 15), (18, 17, 7, 1), (9, 8, 4, 3) ]:
+    image = np.full((300, 400), background_class, dtype=np.uint8)
+    for _ in range(40):
+      y, x = rng.integers(-20, 300), rng.integers(-20, 400)
+      h, w = rng.integers(5, 60, size=2)
+      image[max(0, y):y+h, max(0, x):x+w] = rng.integers(0, num_classes)
+    noise = rng.random(image.shape) < 0.01
+    image[noise] = rng.integers(0, num_classes, size=noise.sum())
+
+    reference = postprocess_reference(image, opening_closing_kernel, erosion_kernel, background_class)
+    for num_threads in [ 1, 4 ]:
+      output = passion.segmentation.prediction.postprocess_output(image, opening_closing_kernel, erosion_kernel,
+                                                                  background_class, num_threads)
+      assert output.dtype == reference.dtype
+      assert (output == reference).all()
+    with passion.segmentation.prediction.get_postprocess_executor(4) as executor:
+      output = passion.segmentation.prediction.postprocess_output(image, opening_closing_kernel, erosion_kernel,
+                                                                  background_class, executor=executor)
+    assert (output == reference).all()
@@ -5,6 +5,7 @@ import random
 import pathlib
 import shutil
 import numpy as np
+import shapely.geometry
 
 def test_shapes():
   '''
@@ -34,3 +35,141 @@ def test_shapes():
 
   assert (blank_image == loaded_image).all()
   assert dicts == loaded_csv
+
+def test_xy_polys_to_latlon():
+  '''
+  Bulk conversion of polygons must match the conversion of each polygon
+  '''
+  polygon = shapely.geometry.Polygon([(0, 0), (100, 0), (100, 100), (0, 100)], [[(10, 10), (20, 10), (20, 20)]])
+  multipolygon = shapely.geometry.MultiPolygon([polygon, shapely.geometry.box(200, 200, 300, 300)])
+  polygons = [polygon, multipolygon, polygon]
+  centers = [(50.77, 6.08), (50.70, 6.00), (-33.86, 151.20)]
+
+  for lonlat_order in [False, True]:
+    polygons_latlon = passion.util.shapes.xy_polys_to_latlon(polygons, centers, (1475, 2000), 19, lonlat_order)
+    for polygon_xy, center, polygon_latlon in zip(polygons, centers, polygons_latlon):
+      expected = passion.util.shapes.xy_poly_to_latlon(polygon_xy, center, (1475, 2000), 19, lonlat_order)
+      assert polygon_latlon.geom_type == expected.geom_type
+      assert polygon_latlon.equals_exact(expected, 1e-12)
+
+def get_layout_reference(outline, panel_size, azimuth, spacing_factor, border_spacing, offset):
+  '''Cell by cell layout, rotating and testing every cell on its own.'''
+  from shapely import affinity
+  panel_width, panel_height = panel_size
+  cell_width, cell_height = panel_width * spacing_factor, panel_height * spacing_factor
+  xmin, ymin, xmax, ymax = [ bound + offset for bound in outline.bounds ]
+  bbox = shapely.geometry.Polygon([(xmin,ymin),(xmin,ymax),(xmax,ymax),(xmax,ymin),(xmin,ymin)])
+  outline = outline.buffer(-border_spacing)
+  panel_cells = []
+  for x0 in np.arange(xmin, xmax, cell_width):
+    for y0 in np.arange(ymin, ymax, cell_height):
+      new_cell = shapely.geometry.box(x0, y0, x0+cell_width, y0+cell_height)
+      new_cell = affinity.rotate(new_cell, -azimuth, origin=bbox.centroid)
+      panel_x0, panel_y0 = x0+((cell_width - panel_width)/2), y0+((cell_height - panel_height)/2)
+      panel_cell = shapely.geometry.box(panel_x0, panel_y0, panel_x0+panel_width, panel_y0+panel_height)
+      panel_cell = affinity.rotate(panel_cell, -azimuth, origin=bbox.centroid)
+      if new_cell.within(outline):
+        panel_cells.append(panel_cell)
+  return panel_cells
+
+def test_get_layout():
+  '''
+  Vectorized layouts must match the cell by cell layouts
+  '''
+  rng = np.random.default_rng(0)
+  outlines = [ shapely.geometry.Polygon([(0, 0), (120, 10), (100, 90), (10, 70)]),
+               shapely.geometry.Polygon([(0, 0), (100, 0), (100, 100), (0, 100)], [[(40, 40), (60, 40), (60, 60), (40, 60)]]),
+               shapely.geometry.box(0, 0, 3, 3) ]
+  for outline in outlines:
+    for azimuth in [ 0, 90, 180, 270, rng.uniform(0, 360) ]:
+      for panel_size, offset in [ ((9.5, 16.1), 0), ((16.1, 9.5), 4.3) ]:
+        layout = passion.util.shapes.get_layout(outline, panel_size, azimuth, 1.3, 2, offset)
+        reference = get_layout_reference(outline, panel_size, azimuth, 1.3, 2, offset)
+        assert len(layout) == len(reference)
+        assert all(panel.wkb == expected.wkb for panel, expected in zip(layout, reference))
+
+    panel_layout = passion.util.shapes.get_panel_layout(outline, (9.5, 16.1), 30, 1.3, 2, 7)
+    assert panel_layout.geom_type == 'MultiPolygon'
+
+def test_get_panel_layouts():
+  '''
+  Chunked and parallel layouts must match the layout of each outline
+  '''
+  rng = np.random.default_rng(1)
+  outlines, azimuths = [], []
+  for i in range(9):
+    angles = np.sort(rng.uniform(0, 2 * np.pi, 6))
+    radius = rng.uniform(20, 60)
+    outlines.append(shapely.geometry.Polygon(np.c_[radius * np.cos(angles), radius * np.sin(angles)]).convex_hull)
+    azimuths.append(rng.uniform(0, 360))
+  outlines.append(shapely.geometry.box(0, 0, 1, 1))
+  azimuths.append(180)
+  panel_sizes = [ (9.5, 16.1) ] * len(outlines)
+  centers = rng.uniform([50.7, 6.0], [50.8, 6.1], (len(outlines), 2))
+
+  expected_n_panels, expected_wkb = [], []
+  for outline, azimuth, center in zip(outlines, azimuths, centers):
+    layout = passion.util.shapes.get_panel_layout(outline, (9.5, 16.1), azimuth, 1.3, 2, 7)
+    layout_latlon = passion.util.shapes.xy_poly_to_latlon(layout, center, (1475, 2000), 19)
+    expected_n_panels.append(len(layout.geoms))
+    expected_wkb.append(shapely.to_wkb(layout_latlon))
+
+  outlines_wkb = shapely.to_wkb(outlines)
+  for n_workers, chunk_size in [ (1, 256), (1, 3), (2, 3) ]:
+    n_panels, layouts_wkb = passion.util.shapes.get_panel_layouts(outlines_wkb, panel_sizes, azimuths, 1.3, 2, 7,
+                                                                  centers, (1475, 2000), 19, n_workers, chunk_size)
+    assert n_panels.tolist() == expected_n_panels
+    assert layouts_wkb.tolist() == expected_wkb
+  assert expected_n_panels[-1] == 0
+
+def test_get_image_classes_xy():
+  '''Holes must be attached to the polygons at extraction time, keeping the
+  regions and islands inside them as separate polygons.
+  '''
+  image = np.zeros((40, 40), dtype=np.uint8)
+  image[5:30, 5:30] = 1
+  image[10:20, 10:20] = 0
+  image[13:16, 13:16] = 1
+  image[22:26, 22:26] = 2
+
+  classes, polygons = passion.util.shapes.get_image_classes_xy(image, 0)
+  classes, polygons = passion.util.shapes.filter_polygon_holes(classes, polygons)
+
+  assert sorted(classes) == [ 1, 1, 2 ]
+  outer = max(polygons, key=lambda p: p.area)
+  assert len(outer.interiors) == 2
+  assert outer.exterior.equals(shapely.geometry.box(5, 5, 29, 29).exterior)
+  assert any(p.equals(shapely.geometry.box(13, 13, 15, 15)) for p in polygons)
+  assert any(p.equals(shapely.geometry.box(22, 22, 25, 25)) for p in polygons)
+
+def filter_polygon_holes_reference(classes, polygons):
+  filter_polygons = []
+  final_polygons = []
+  for i, p_a in enumerate(polygons):
+    holes = []
+    for j, p_b in enumerate(polygons):
+      if i != j and p_a.contains(p_b):
+        filter_polygons.append(j)
+        holes.append(p_b.exterior.coords)
+    final_polygons.append(shapely.geometry.Polygon(p_a.exterior.coords, holes).buffer(0))
+  final_polygons = [p for i, p in enumerate(final_polygons) if i not in filter_polygons]
+  final_classes = [c for i, c in enumerate(classes) if i not in filter_polygons]
+  return final_classes, final_polygons
+
+def test_filter_polygon_holes():
+  '''Filtering with the spatial index must match the pairwise containment tests.'''
+  rng = np.random.default_rng(0)
+  polygons = []
+  for _ in range(300):
+    x, y = rng.uniform(0, 500, size=2)
+    w, h = rng.uniform(4, 60, size=2)
+    polygons.append(shapely.geometry.box(x, y, x + w, y + h))
+  polygons.append(polygons[0])
+  classes = rng.integers(1, 9, size=len(polygons)).tolist()
+
+  classes_result, polygons_result = passion.util.shapes.filter_polygon_holes(classes, polygons)
+  classes_reference, polygons_reference = filter_polygon_holes_reference(classes, polygons)
+
+  assert len(polygons_reference) < len(polygons)
+  assert classes_result == classes_reference
+  assert [ p.wkb for p in polygons_result ] == [ p.wkb for p in polygons_reference ]
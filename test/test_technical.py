@@ -0,0 +1,140 @@
+import passion
+import pytest
+rk = pytest.importorskip('reskit')
+import passion.technical.reskit
+
+import numpy as np
+import pandas as pd
+import xarray
+
+def fake_openfield_pv(placements_df, merra_path, solar_atlas_path, module, output_variables):
+  '''Deterministic stand-in of RESKit's simulation, depending on the location and orientation
+  of every placement, and numbering the locations of every call from 0 like RESKit.
+  '''
+  time = pd.date_range('2020-01-01', periods=48, freq='h')
+  sun = np.sin(np.arange(48) * np.pi / 24).clip(0)
+  orientation = (1 + 0.01 * placements_df['lat'].values - 0.002 * placements_df['tilt'].values
+                 + 0.0005 * np.cos(np.radians(placements_df['azimuth'].values))
+                 + 0.0001 * placements_df['elev'].values)
+  capacity_factor = np.outer(sun, 0.2 * orientation)
+  location = np.arange(len(placements_df))
+  return xarray.Dataset({
+    **{ var: ('location', placements_df[var].values) for var in output_variables if var in placements_df.columns },
+    'capacity_factor': (('time', 'location'), capacity_factor),
+    'total_system_generation': (('time', 'location'), capacity_factor * placements_df['capacity'].values)
+  }, coords={ 'time': time, 'location': location })
+
+def get_placements(n_placements, rng):
+  '''Random placements around Aachen.'''
+  return pd.DataFrame({
+    'lat': rng.uniform(50.7, 51.3, n_placements),
+    'lon': rng.uniform(6.0, 7.0, n_placements),
+    'elev': rng.uniform(100, 300, n_placements),
+    'capacity': rng.uniform(1, 10, n_placements),
+    'tilt': rng.uniform(0, 45, n_placements),
+    'azimuth': rng.choice(np.arange(16) * 22.5, n_placements)
+  })
+
+@pytest.fixture
+def fake_reskit(monkeypatch):
+  calls = []
+  def counted_openfield_pv(placements_df, *args, **kwargs):
+    calls.append(len(placements_df))
+    return fake_openfield_pv(placements_df, *args, **kwargs)
+  monkeypatch.setattr(rk.solar, 'openfield_pv_merra_ryberg2019', counted_openfield_pv)
+  return calls
+
+def test_simulate_placements_chunks(tmp_path, fake_reskit):
+  '''Simulating in chunks must give the same yearly values and locations as a single call,
+  and write the hourly series of every chunk.
+  '''
+  placements_df = get_placements(7, np.random.default_rng(0))
+  output_variables = [ 'lat', 'lon', 'capacity', 'tilt', 'azimuth' ]
+
+  full_ds = passion.technical.reskit.simulate_placements(placements_df, 'merra', 'atlas', 'model', output_variables)
+  chunked_ds = passion.technical.reskit.simulate_placements(placements_df, 'merra', 'atlas', 'model', output_variables,
+                                                            chunk_size=3, hourly_path=tmp_path / 'hourly')
+
+  assert fake_reskit == [ 7, 3, 3, 1 ]
+  assert 'time' not in chunked_ds.dims
+  np.testing.assert_array_equal(chunked_ds.location.values, full_ds.location.values)
+  for var in [ 'yearly_capacity_factor', 'yearly_system_generation', 'capacity' ]:
+    np.testing.assert_allclose(chunked_ds[var].values, full_ds[var].values, rtol=1e-12)
+
+  hourly_paths = sorted((tmp_path / 'hourly').glob('*.nc'))
+  assert [ p.name for p in hourly_paths ] == [ 'chunk_00000.nc', 'chunk_00001.nc', 'chunk_00002.nc' ]
+  hourly_ds = xarray.concat([ xarray.load_dataset(str(p)) for p in hourly_paths ], dim='location')
+  assert hourly_ds.total_system_generation.dims == ('time', 'location')
+  np.testing.assert_array_equal(hourly_ds.location.values, full_ds.location.values)
+  np.testing.assert_allclose(hourly_ds.total_system_generation.values, full_ds.total_system_generation.values)
+
+def write_datasets(path):
+  '''Writes stand-ins of the MERRA-2 folder and the Solar Atlas file, to be fingerprinted.'''
+  (path / 'merra').mkdir(parents=True)
+  (path / 'merra' / 'merra.nc4').write_bytes(b'merra')
+  (path / 'atlas.tif').write_bytes(b'atlas')
+  return path / 'merra', path / 'atlas.tif'
+
+def simulate_cached(placements_df, merra_path, solar_atlas_path, cache_path):
+  return passion.technical.reskit.simulate_placements_cached(placements_df, merra_path, solar_atlas_path, 'model',
+                                                             [ 'lat', 'capacity' ], cache_path, (0.5, 0.625),
+                                                             tilt_bin=5, elev_bin=100, chunk_size=4)
+
+def test_simulate_placements_cached(tmp_path, fake_reskit, capsys):
+  '''Cached simulations must be reused, scaled by the capacity of every placement, and
+  simulated again for other datasets or an old cache format.
+  '''
+  rng = np.random.default_rng(0)
+  placements_df = get_placements(60, rng).assign(tilt=rng.choice([ 10., 21., 34. ], 60),
+                                                 azimuth=rng.choice([ 135., 180., 225. ], 60))
+  placements_df.index = rng.permutation(1000)[:60]
+  merra_path, solar_atlas_path = write_datasets(tmp_path)
+  cache_path = tmp_path / 'cache' / 'simulation_cache.csv'
+
+  first_ds = simulate_cached(placements_df, merra_path, solar_atlas_path, cache_path)
+  n_profiles = sum(fake_reskit)
+  assert 0 < n_profiles < len(placements_df)
+  assert ' 0 hits, {0} misses'.format(n_profiles) in capsys.readouterr().out
+  np.testing.assert_array_equal(first_ds.lat.values, placements_df['lat'].values)
+
+  # Every placement takes the 1 kW profile of its group, simulated at the mean point of the group
+  keys = passion.technical.reskit.get_profile_keys(placements_df, 'model', '', (0.5, 0.625), 5, 100)
+  key_columns = list(keys.columns)
+  points = pd.concat([ keys, placements_df[[ 'lat', 'lon', 'elev' ]].reset_index(drop=True) ], axis=1)
+  points = points.groupby(key_columns)[[ 'lat', 'lon', 'elev' ]].transform('mean')
+  reference_df = points.assign(capacity=1.0, tilt=keys['tilt_bin'], azimuth=keys['azimuth_bin'])
+  reference_ds = fake_openfield_pv(reference_df, None, None, 'model', [])
+  np.testing.assert_allclose(first_ds.yearly_system_generation.values,
+                             reference_ds.total_system_generation.mean(dim='time').values * placements_df['capacity'].values)
+
+  # A second run only reads the cache
+  fake_reskit.clear()
+  second_ds = simulate_cached(placements_df, merra_path, solar_atlas_path, cache_path)
+  assert fake_reskit == []
+  assert '{0} hits, 0 misses'.format(n_profiles) in capsys.readouterr().out
+  xarray.testing.assert_identical(first_ds, second_ds)
+
+  # Generation scales with the capacity, the capacity factor does not
+  scaled_ds = simulate_cached(placements_df.assign(capacity=placements_df['capacity'] * 2),
+                              merra_path, solar_atlas_path, cache_path)
+  assert fake_reskit == []
+  np.testing.assert_allclose(scaled_ds.yearly_system_generation.values, 2 * first_ds.yearly_system_generation.values)
+  np.testing.assert_array_equal(scaled_ds.yearly_capacity_factor.values, first_ds.yearly_capacity_factor.values)
+
+  # Profiles of a changed dataset are discarded and simulated again
+  (merra_path / 'merra.nc4').write_bytes(b'other merra')
+  changed_ds = simulate_cached(placements_df, merra_path, solar_atlas_path, cache_path)
+  assert sum(fake_reskit) == n_profiles
+  assert 'discarding {0} profiles'.format(n_profiles) in capsys.readouterr().out
+  assert len(pd.read_csv(cache_path)) == n_profiles
+  xarray.testing.assert_identical(first_ds, changed_ds)
+
+  # A cache of an old format is simulated again
+  fake_reskit.clear()
+  pd.read_csv(cache_path).drop(columns=[ 'datasets', 'elev_bin' ]).to_csv(cache_path, index=False)
+  old_format_ds = simulate_cached(placements_df, merra_path, solar_atlas_path, cache_path)
+  assert sum(fake_reskit) == n_profiles
+  assert 'old format' in capsys.readouterr().out
+  assert set(pd.read_csv(cache_path)['datasets']) == { passion.technical.reskit.get_dataset_fingerprint(merra_path) + '-' +
+                                                        passion.technical.reskit.get_dataset_fingerprint(solar_atlas_path) }
+  xarray.testing.assert_identical(first_ds, old_format_ds)
@@ -0,0 +1,127 @@
+import passion.economic.uncertainty
+
+import pathlib
+import yaml
+import numpy as np
+import pytest
+import pandas as pd
+import scipy.stats
+import xarray
+
+def write_technical(path, flat, rng):
+  n_sections = len(flat)
+  n_panels = rng.integers(1, 20, n_sections)
+  technical_ds = xarray.Dataset({
+    'section_yearly_system_generation': ('location', n_panels * rng.uniform(300, 400, n_sections)),
+    'section_capacity': ('location', n_panels * 370.),
+    'section_n_panels': ('location', n_panels),
+    'section_modules_cost': ('location', n_panels * 350.),
+    'section_tilt': ('location', np.where(flat, 31., rng.uniform(10, 50, n_sections))),
+    'section_azimuth': ('location', rng.choice(np.arange(16) * 22.5, n_sections)),
+    'section_flat': ('location', flat),
+    'section_lat': ('location', rng.uniform(50.7, 50.8, n_sections)),
+    'section_lon': ('location', rng.uniform(6.0, 6.1, n_sections)),
+    'section_elev': ('location', rng.uniform(160, 240, n_sections))
+  }, coords={ 'location': np.arange(n_sections) })
+  technical_ds.to_netcdf(str(path))
+  return technical_ds
+
+def test_generate_uncertainty_deterministic(tmp_path):
+  '''
+  Without sampled parameters and tilts, every percentile must be the point LCOE
+  '''
+  rng = np.random.default_rng(0)
+  technical_ds = write_technical(tmp_path / 'technical.nc', np.ones(30, dtype=bool), rng)
+  tilt_distribution = scipy.stats.gaussian_kde(rng.uniform(10, 50, 100))
+
+  passion.economic.uncertainty.generate_uncertainty(tmp_path / 'technical.nc', tmp_path, 'uncertainty',
+                                                    tilt_distribution, n_samples=10, chunk_size=7, seed=0)
+
+  expected = passion.economic.lcoe.calculate_lcoe(technical_ds.section_yearly_system_generation,
+                                                  technical_ds.section_capacity,
+                                                  technical_ds.section_modules_cost,
+                                                  passion.economic.lcoe.DEFAULT_LCOE_PARAMS)
+  with xarray.open_dataset(str(tmp_path / 'uncertainty.nc')) as uncertainty_ds:
+    assert uncertainty_ds.section_lcoe.dims == ('location', 'percentile')
+    for percentile in uncertainty_ds.percentile.values:
+      bands = uncertainty_ds.sel(percentile=percentile)
+      np.testing.assert_allclose(bands.section_lcoe.values, expected.values, rtol=1e-12)
+      np.testing.assert_allclose(bands.section_yearly_system_generation.values,
+                                 technical_ds.section_yearly_system_generation.values)
+    np.testing.assert_allclose(uncertainty_ds.region_yearly_system_generation.values,
+                               technical_ds.section_yearly_system_generation.sum().item())
+
+def test_generate_uncertainty_bands(tmp_path):
+  '''
+  Sampled tilts and parameters must produce ordered bands, reproducible with the seed and chunk size
+  '''
+  rng = np.random.default_rng(1)
+  flat = rng.random(40) < 0.3
+  technical_ds = write_technical(tmp_path / 'technical.nc', flat, rng)
+  tilt_distribution = scipy.stats.gaussian_kde(rng.uniform(10, 50, 100))
+
+  # Profiles with a generation linear in the tilt for every orientation
+  lat_cells, lon_cells = passion.util.gis.get_weather_cells(technical_ds.section_lat.values, technical_ds.section_lon.values)
+  elev_bins = np.round(technical_ds.section_elev.values / 100) * 100
+  profiles = [ { 'pv_model': 'model', 'lat_cell': lat_cell, 'lon_cell': lon_cell, 'elev_bin': elev_bin,
+                 'tilt_bin': tilt, 'azimuth_bin': azimuth, 'capacity_factor': 0.1, 'generation_per_kw': 100 + tilt }
+               for lat_cell, lon_cell, elev_bin in set(zip(lat_cells, lon_cells, elev_bins))
+               for azimuth in np.arange(16) * 22.5 for tilt in [ 0., 90. ] ]
+  pd.DataFrame(profiles).to_csv(tmp_path / 'profiles.csv', index=False)
+
+  parameter_ranges = { 'discount_rate': [ 0.04, 0.1 ], 'module_price': [ 250, 450 ] }
+  for name, seed in [ ('a', 3), ('b', 3), ('c', 4) ]:
+    passion.economic.uncertainty.generate_uncertainty(tmp_path / 'technical.nc', tmp_path, name, tilt_distribution,
+                                                      parameter_ranges, n_samples=200, profiles_path=tmp_path / 'profiles.csv',
+                                                      pv_model_id='model', chunk_size=16, seed=seed)
+
+  with xarray.open_dataset(str(tmp_path / 'a.nc')) as a_ds, xarray.open_dataset(str(tmp_path / 'b.nc')) as b_ds, \
+       xarray.open_dataset(str(tmp_path / 'c.nc')) as c_ds:
+    xarray.testing.assert_identical(a_ds, b_ds)
+    assert not np.allclose(a_ds.section_lcoe.values, c_ds.section_lcoe.values)
+    generation = a_ds.section_yearly_system_generation.values
+    lcoe = a_ds.section_lcoe.values
+    assert (np.diff(lcoe, axis=1) >= 0).all()
+    assert (np.diff(a_ds.region_lcoe.values) > 0).all()
+    # Only sloped sections vary their generation
+    assert (generation[~flat, 2] > generation[~flat, 0]).all()
+    np.testing.assert_allclose(generation[flat, 0], generation[flat, 2])
+
+def test_generate_uncertainty_missing_profiles(tmp_path):
+  '''
+  Sloped sections without cached profiles must not silently lose their tilt uncertainty
+  '''
+  rng = np.random.default_rng(2)
+  write_technical(tmp_path / 'technical.nc', np.zeros(10, dtype=bool), rng)
+  tilt_distribution = scipy.stats.gaussian_kde(rng.uniform(10, 50, 100))
+
+  with pytest.raises(ValueError):
+    passion.economic.uncertainty.generate_uncertainty(tmp_path / 'technical.nc', tmp_path, 'uncertainty',
+                                                      tilt_distribution, n_samples=10,
+                                                      profiles_path=tmp_path / 'profiles.csv', seed=0)
+
+def test_get_tilt_factors():
+  '''
+  Tilt factors must follow the interpolated profile of each orientation
+  '''
+  profiles = { (1, 2, 200., 180.): (np.array([ 0., 30., 60. ]), np.array([ 100., 130., 100. ])) }
+  lat_cells, lon_cells = np.array([ 1, 1, 5, 1 ]), np.array([ 2, 2, 2, 2 ])
+  elev_bins, azimuth_bins = np.array([ 200., 200., 200., 200. ]), np.array([ 180., 180., 180., 180. ])
+  tilts = np.array([ 30., 15., 30., 30. ])
+  sampled_tilts = np.array([ [ 30., 45. ], [ 0., 60. ], [ 0., 60. ], [ 30., 75. ] ])
+
+  tilt_factors, missing, outside = passion.economic.uncertainty.get_tilt_factors(profiles, lat_cells, lon_cells,
+                                                                                 elev_bins, azimuth_bins, tilts,
+                                                                                 sampled_tilts)
+  np.testing.assert_allclose(tilt_factors, [ [ 1., 115 / 130 ], [ 100 / 115, 100 / 115 ], [ 1., 1. ], [ 1., 100 / 130 ] ])
+  np.testing.assert_array_equal(missing, [ False, False, True, False ])
+  np.testing.assert_array_equal(outside, [ 0, 0, 0, 1 ])
+
+def test_config_uncertainty_requires_simulation_cache():
+  '''
+  The workflow config must not enable the uncertainty analysis without the simulation cache
+  '''
+  with open(pathlib.Path(__file__).parents[1] / 'workflow' / 'config.yml', 'r') as stream:
+    config = yaml.safe_load(stream)
+  if config.get('UncertaintyAnalysis'):
+    assert config['TechnicalAnalysis'].get('simulation_cache', False)
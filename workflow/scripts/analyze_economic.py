@@ -46,4 +46,21 @@ passion.economic.lcoe.generate_economic(input_path / input_name,
                                         inverter_price_rate,
                                         other_costs,
                                         discount_rate,
-                                        yearly_degradation)
\ No newline at end of file
+                                        yearly_degradation)
+
+scenarios = economic_config.get('scenarios')
+if scenarios:
+    scenarios_name = economic_config.get('scenarios_file_name', output_name + '_scenarios')
+    lcoe_params = {
+        'panel_lifespan': panel_lifespan,
+        'inverter_lifespan': inverter_lifespan,
+        'inverter_price_rate': inverter_price_rate,
+        'other_costs': other_costs,
+        'discount_rate': discount_rate,
+        'yearly_degradation': yearly_degradation
+    }
+    passion.economic.lcoe.generate_economic_scenarios(input_path / input_name,
+                                                      output_path,
+                                                      scenarios_name,
+                                                      scenarios,
+                                                      lcoe_params)
@@ -41,6 +41,10 @@ simplification_distance = float(simplification_distance)
 
 merge_style = rooftop_config.get('merge_style')
 
+n_workers = int(rooftop_config.get('n_workers', 1))
+seed = rooftop_config.get('seed')
+tilt_sampling = rooftop_config.get('tilt_sampling', 'kde')
+
 passion.buildings.building_analysis.analyze_rooftops(rooftop_input_path,
                                                      section_input_path,
                                                      superstructure_input_path,
@@ -48,4 +52,7 @@ passion.buildings.building_analysis.analyze_rooftops(rooftop_input_path,
                                                      output_name,
                                                      tilt_distribution_path,
                                                      simplification_distance,
-                                                     merge_style)
\ No newline at end of file
+                                                     merge_style,
+                                                     n_workers,
+                                                     seed,
+                                                     tilt_sampling)
\ No newline at end of file
@@ -62,6 +62,21 @@ pv_spacing_factor = float(technical_config.get('pv_spacing_factor'))
 pv_border_spacing = float(technical_config.get('pv_border_spacing'))
 pv_n_offset = int(technical_config.get('pv_n_offset'))
 
+n_workers = int(technical_config.get('n_workers', 1))
+chunk_size = int(technical_config.get('chunk_size', 256))
+simulation_chunk_size = technical_config.get('simulation_chunk_size')
+if simulation_chunk_size is not None: simulation_chunk_size = int(simulation_chunk_size)
+save_hourly = bool(technical_config.get('save_hourly', False))
+
+simulation_cache = None
+if technical_config.get('simulation_cache', False):
+    simulation_cache = {
+        'path': results_path / technical_config.get('simulation_cache_path', 'reskit/simulation_cache.csv'),
+        'weather_cell_size': tuple(float(size) for size in technical_config.get('weather_cell_size', [0.5, 0.625])),
+        'tilt_bin': float(technical_config.get('tilt_bin', 1)),
+        'elev_bin': float(technical_config.get('elev_bin', 100))
+    }
+
 pv_panel_properties = {
     'id': pv_model_id,
     'name': pv_model_name,
@@ -80,4 +95,9 @@ passion.technical.reskit.generate_technical(input_path / input_name,
                                             merra_path,
                                             solar_atlas_path,
                                             minimum_section_area,
-                                            pv_panel_properties)
\ No newline at end of file
+                                            pv_panel_properties,
+                                            n_workers,
+                                            chunk_size,
+                                            simulation_chunk_size,
+                                            save_hourly,
+                                            simulation_cache)
\ No newline at end of file
@@ -0,0 +1,84 @@
+import passion
+import argparse, pathlib, yaml, pathlib
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--config', metavar='C', type=str, help='Config file path')
+args = vars(parser.parse_args())
+configfile = args['config']
+
+with open(configfile, "r") as stream:
+    try:
+        config = yaml.safe_load(stream)
+    except yaml.YAMLError as exc:
+        print(exc)
+        exit
+
+rooftop_config = config.get('RooftopAnalysis')
+technical_config = config.get('TechnicalAnalysis')
+economic_config = config.get('EconomicAnalysis')
+uncertainty_config = config.get('UncertaintyAnalysis')
+results_path = pathlib.Path(config.get('results_path'))
+zoom = config.get('ImageRetrieval').get('zoom')
+project_results_path = results_path / (f"{config.get('project_name')}-z{zoom}")
+
+input_folder = technical_config['output_folder']
+input_path = project_results_path / input_folder
+input_name = technical_config['file_name']
+if not input_name.endswith('.nc'):
+    input_name += '.nc'
+
+output_folder = uncertainty_config['output_folder']
+output_path = project_results_path / output_folder
+
+output_name = uncertainty_config['file_name']
+
+tilt_distribution_path = results_path / rooftop_config['tilt_rel_path']
+tilt_distribution = passion.util.io.load_pickle(tilt_distribution_path)
+if rooftop_config.get('tilt_sampling', 'kde') == 'table':
+    tilt_distribution = passion.buildings.building_analysis.get_tilt_table(tilt_distribution)
+
+if not technical_config.get('simulation_cache', False):
+    raise ValueError('UncertaintyAnalysis requires the simulation_cache of TechnicalAnalysis to be enabled.')
+profiles_path = results_path / technical_config.get('simulation_cache_path', 'reskit/simulation_cache.csv')
+weather_cell_size = tuple(float(size) for size in technical_config.get('weather_cell_size', [0.5, 0.625]))
+tilt_bin = float(technical_config.get('tilt_bin', 1))
+elev_bin = float(technical_config.get('elev_bin', 100))
+simulation_chunk_size = technical_config.get('simulation_chunk_size')
+if simulation_chunk_size is not None: simulation_chunk_size = int(simulation_chunk_size)
+merra_path = results_path / technical_config.get('merra_path')
+solar_atlas_path = results_path / technical_config.get('solar_atlas_path')
+
+# Simulate every tilt bin of the section orientations, so that sampled tilts are not clamped
+passion.technical.reskit.cache_tilt_profiles(input_path / input_name,
+                                             merra_path,
+                                             solar_atlas_path,
+                                             technical_config.get('pv_model_id'),
+                                             profiles_path,
+                                             weather_cell_size,
+                                             tilt_bin,
+                                             elev_bin,
+                                             simulation_chunk_size)
+
+lcoe_params = {
+    'panel_lifespan': float(economic_config['panel_lifespan']),
+    'inverter_lifespan': float(economic_config['inverter_lifespan']),
+    'inverter_price_rate': float(economic_config['inverter_price_rate']),
+    'other_costs': float(economic_config['other_costs']),
+    'discount_rate': float(economic_config['discount_rate']),
+    'yearly_degradation': float(economic_config['yearly_degradation'])
+}
+
+passion.economic.uncertainty.generate_uncertainty(input_path / input_name,
+                                                  output_path,
+                                                  output_name,
+                                                  tilt_distribution,
+                                                  uncertainty_config.get('parameter_ranges'),
+                                                  lcoe_params,
+                                                  int(uncertainty_config.get('n_samples', 1000)),
+                                                  uncertainty_config.get('percentiles', [5, 50, 95]),
+                                                  profiles_path,
+                                                  technical_config.get('pv_model_id'),
+                                                  weather_cell_size,
+                                                  elev_bin,
+                                                  int(uncertainty_config.get('chunk_size', 2000)),
+                                                  uncertainty_config.get('seed'))
@@ -31,9 +31,18 @@ if shape:
     sf = shapefile.Reader(shape)
     shape = sf.shapes()[0]
 
+max_workers = int(image_retrieval_config.get('max_workers', 1))
+requests_per_second = image_retrieval_config.get('requests_per_second')
+if requests_per_second:
+    requests_per_second = float(requests_per_second)
+dry_run = bool(image_retrieval_config.get('dry_run', False))
+
 project_results_path = pathlib.Path(config.get('results_path')) / (f"{config.get('project_name')}-z{str(zoom)}")
 output_folder = image_retrieval_config['output_folder']
 output_path = project_results_path / output_folder
 
 passion.satellite.image_retrieval.generate_dataset(api_key, service, output_path,
-                                    zoom = zoom, bbox=bbox, shapefile=shape)
+                                    zoom = zoom, bbox=bbox, shapefile=shape,
+                                    max_workers = max_workers,
+                                    requests_per_second = requests_per_second,
+                                    dry_run = dry_run)
@@ -0,0 +1,98 @@
+import passion
+import argparse, pathlib, yaml, pathlib
+import torch
+import requests
+from tqdm.auto import tqdm
+import shutil
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--config', metavar='C', type=str, help='Config file path')
+args = vars(parser.parse_args())
+configfile = args['config']
+
+MODEL_URLS = {
+    'RooftopSegmentation': 'https://zenodo.org/record/7886980/files/rooftops.pth?download=1',
+    'SectionSegmentation': 'https://zenodo.org/record/7886980/files/sections.pth?download=1',
+    'SuperstructureSegmentation': 'https://zenodo.org/record/7886980/files/superstructures.pth?download=1',
+}
+
+with open(configfile, "r") as stream:
+    try:
+        config = yaml.safe_load(stream)
+    except yaml.YAMLError as exc:
+        print(exc)
+        exit
+
+image_retrieval_config = config.get('ImageRetrieval')
+results_path = pathlib.Path(config.get('results_path'))
+zoom = image_retrieval_config.get('zoom')
+project_results_path = results_path / (f"{config.get('project_name')}-z{zoom}")
+
+input_folder = image_retrieval_config['output_folder']
+input_path = project_results_path / input_folder
+
+pipeline_config = config.get('Segmentation', {})
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+print(f'Using torch device: {device}')
+if device=='cuda': print(f'Name: {torch.cuda.get_device_name(0)}')
+
+rooftop_config = config.get('RooftopSegmentation')
+steps = list(MODEL_URLS.keys())
+if rooftop_config.get('osm'):
+    # Rooftops are retrieved from OpenStreetMap instead of segmented
+    osm_cache_path = None
+    if rooftop_config.get('osm_cache'):
+        osm_cache_path = project_results_path / rooftop_config.get('osm_cache_rel_path', 'osm/footprints.sqlite')
+    passion.segmentation.osm.generate_osm(input_path = input_path,
+                    output_path = project_results_path / rooftop_config['osm_output_folder'],
+                    osm_request_interval = int(rooftop_config.get('osm_request_interval')),
+                    num_retries = int(rooftop_config.get('num_retries')),
+                    osm_cache_path = osm_cache_path,
+                    osm_chunk_size = float(rooftop_config.get('osm_chunk_size', 0.05)))
+    steps.remove('RooftopSegmentation')
+
+models, output_paths, background_classes = [], [], []
+opening_closing_kernels, erosion_kernels = [], []
+tile_sizes, strides, batch_sizes = set(), set(), set()
+for step in steps:
+    segmentation_config = config.get(step)
+
+    model_path = results_path / segmentation_config['model_rel_path']
+    if not model_path.exists():
+        print(f'{step} model was not found. Downloading it from {MODEL_URLS[step]}. If the file exists, please check the location in the config.yml file.')
+        with requests.get(MODEL_URLS[step], stream=True) as r:
+            with tqdm.wrapattr(r.raw, "read", total=int(r.headers.get("Content-Length")), desc="")as raw:
+                with open(f"{str(model_path)}", 'wb')as output:
+                    shutil.copyfileobj(raw, output)
+
+    models.append(torch.load(str(model_path), map_location=torch.device(device)))
+    output_paths.append(project_results_path / segmentation_config['output_folder'])
+    background_classes.append(segmentation_config.get('background_class'))
+    opening_closing_kernels.append(int(segmentation_config.get('opening_closing_kernel')))
+    erosion_kernels.append(int(segmentation_config.get('erosion_kernel')))
+    tile_sizes.add(int(segmentation_config.get('tile_size')))
+    strides.add(int(segmentation_config.get('stride')))
+    batch_sizes.add(int(segmentation_config.get('batch_size', 8)))
+
+if len(tile_sizes) != 1 or len(strides) != 1:
+    raise ValueError('Single pass segmentation requires the same tile_size and stride for all models, got tile sizes {0} and strides {1}'.format(tile_sizes, strides))
+
+passion.segmentation.prediction.segment_dataset_multi(
+    input_path = input_path,
+    models = models,
+    output_paths = output_paths,
+    background_classes = background_classes,
+    tile_size = tile_sizes.pop(),
+    stride = strides.pop(),
+    opening_closing_kernels = opening_closing_kernels,
+    erosion_kernels = erosion_kernels,
+    batch_size = min(batch_sizes),
+    pipelined = pipeline_config.get('pipelined', False),
+    num_readers = int(pipeline_config.get('num_readers', 2)),
+    num_workers = int(pipeline_config.get('num_workers', 2)),
+    queue_size = int(pipeline_config.get('queue_size', 8)),
+    merge_mode = passion.segmentation.prediction.MERGE_MODE[pipeline_config.get('merge_mode', 'probabilities').upper()],
+    blending = pipeline_config.get('blending', 'gaussian'),
+    num_threads = int(pipeline_config.get('postprocess_threads', 1))
+    )
@@ -42,6 +42,8 @@ opening_closing_kernel = segmentation_config.get('opening_closing_kernel')
 opening_closing_kernel = int(opening_closing_kernel)
 erosion_kernel = segmentation_config.get('erosion_kernel')
 erosion_kernel = int(erosion_kernel)
+batch_size = int(segmentation_config.get('batch_size', 8))
+pipeline_config = config.get('Segmentation', {})
 
 osm_request_interval = segmentation_config.get('osm_request_interval')
 osm_request_interval = int(osm_request_interval)
@@ -49,11 +51,18 @@ osm_request_interval = int(osm_request_interval)
 num_retries = segmentation_config.get('num_retries')
 num_retries = int(num_retries)
 
+osm_cache_path = None
+if segmentation_config.get('osm_cache'):
+    osm_cache_path = project_results_path / segmentation_config.get('osm_cache_rel_path', 'osm/footprints.sqlite')
+osm_chunk_size = float(segmentation_config.get('osm_chunk_size', 0.05))
+
 if is_osm:
     passion.segmentation.osm.generate_osm(input_path = input_path,
                     output_path = osm_output_path,
                     osm_request_interval = osm_request_interval,
-                    num_retries = num_retries)
+                    num_retries = num_retries,
+                    osm_cache_path = osm_cache_path,
+                    osm_chunk_size = osm_chunk_size)
 else:
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     print(f'Using torch device: {device}')
@@ -77,4 +86,12 @@ else:
         output_path = output_path,
         background_class = background_class,
         opening_closing_kernel = opening_closing_kernel,
-        erosion_kernel = erosion_kernel)
+        erosion_kernel = erosion_kernel,
+        batch_size = batch_size,
+        pipelined = pipeline_config.get('pipelined', False),
+        num_readers = int(pipeline_config.get('num_readers', 2)),
+        num_workers = int(pipeline_config.get('num_workers', 2)),
+        queue_size = int(pipeline_config.get('queue_size', 8)),
+        merge_mode = passion.segmentation.prediction.MERGE_MODE[pipeline_config.get('merge_mode', 'probabilities').upper()],
+        blending = pipeline_config.get('blending', 'gaussian'),
+        num_threads = int(pipeline_config.get('postprocess_threads', 1)))
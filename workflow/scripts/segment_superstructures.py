@@ -37,6 +37,8 @@ opening_closing_kernel = segmentation_config.get('opening_closing_kernel')
 opening_closing_kernel = int(opening_closing_kernel)
 erosion_kernel = segmentation_config.get('erosion_kernel')
 erosion_kernel = int(erosion_kernel)
+batch_size = int(segmentation_config.get('batch_size', 8))
+pipeline_config = config.get('Segmentation', {})
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 print(f'Using torch device: {device}')
@@ -59,5 +61,13 @@ passion.segmentation.prediction.segment_dataset(
     output_path = output_path,
     background_class = background_class,
     opening_closing_kernel = opening_closing_kernel,
-    erosion_kernel = erosion_kernel
+    erosion_kernel = erosion_kernel,
+    batch_size = batch_size,
+    pipelined = pipeline_config.get('pipelined', False),
+    num_readers = int(pipeline_config.get('num_readers', 2)),
+    num_workers = int(pipeline_config.get('num_workers', 2)),
+    queue_size = int(pipeline_config.get('queue_size', 8)),
+    merge_mode = passion.segmentation.prediction.MERGE_MODE[pipeline_config.get('merge_mode', 'probabilities').upper()],
+    blending = pipeline_config.get('blending', 'gaussian'),
+    num_threads = int(pipeline_config.get('postprocess_threads', 1))
     )